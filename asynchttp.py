@@ -0,0 +1,214 @@
+import asyncio
+import ssl
+import time
+
+
+class Response(object):
+    def __init__(self, status, reason, headers, body):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+
+class _ResumingContext(ssl.SSLContext):
+    # asyncio cannot pass a TLS session to a new connection, so the context
+    # adds the last session of its pool to every connection it creates
+    session = None
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        return super(_ResumingContext, self).wrap_bio(incoming, outgoing, server_side, server_hostname,
+                                                      session or self.session)
+
+
+def create_ssl_context():
+    # Certificates are not verified, like in the rest of the scripts
+    context = _ResumingContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    return context
+
+
+# Minimal HTTP/1.1 client connection using asyncio streams. Supports only
+# what the image server needs: requests with a body given as a list of
+# buffers, and responses with Content-Length or chunked encoding.
+class HttpConnection(object):
+    # The body is written in slices, waiting for the transport to send each
+    # one, so the transport does not keep a copy of the whole body
+    WRITE_SIZE = 512 * 1024
+
+    def __init__(self, host, port, ssl_context=None):
+        self.host = host
+        self.port = port
+        self.ssl_context = ssl_context
+        self._reader = None
+        self._writer = None
+        self.requests = 0
+
+    @property
+    def closed(self):
+        # An idle connection may have been closed by the server
+        return self._writer is None or self._reader.at_eof()
+
+    @property
+    def ssl_object(self):
+        if self._writer is None:
+            return None
+        return self._writer.get_extra_info("ssl_object")
+
+    @property
+    def session_reused(self):
+        ssl_object = self.ssl_object
+        return ssl_object is not None and ssl_object.session_reused
+
+    async def connect(self):
+        self._reader, self._writer = await asyncio.open_connection(
+            self.host, self.port, ssl=self.ssl_context,
+            server_hostname=self.host if self.ssl_context is not None else None
+        )
+
+    async def close(self):
+        writer = self._writer
+        self._reader = self._writer = None
+        if writer is None:
+            return
+
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except (OSError, ConnectionError):
+            pass
+
+    # The buffers in `body` are not copied and must not change until the
+    # response is received.
+    async def request(self, method, path, body=None, headers=None):
+        if self._writer is None:
+            await self.connect()
+        self.requests += 1
+
+        if body is None:
+            body = []
+        elif isinstance(body, (bytes, bytearray, memoryview)):
+            body = [body]
+
+        length = sum(memoryview(buf).nbytes for buf in body)
+        lines = ["%s %s HTTP/1.1" % (method, path), "Host: %s:%d" % (self.host, self.port)]
+        for name, value in (headers or {}).items():
+            if name.lower() != "content-length":
+                lines.append("%s: %s" % (name, value))
+        if length or method in ("PUT", "POST", "PATCH"):
+            lines.append("Content-Length: %d" % length)
+
+        try:
+            self._writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+            for buf in body:
+                view = memoryview(buf).cast("B")
+                for start in range(0, len(view), self.WRITE_SIZE):
+                    self._writer.write(view[start:start + self.WRITE_SIZE])
+                    await self._writer.drain()
+            await self._writer.drain()
+            return await self._read_response(method)
+        except BaseException:
+            # The state of the connection is unknown
+            await self.close()
+            raise
+
+    async def _read_response(self, method):
+        status_line = await self._reader.readline()
+        if not status_line:
+            raise ConnectionError("Server closed the connection")
+
+        parts = status_line.decode("latin-1").rstrip("\r\n").split(" ", 2)
+        if len(parts) < 2 or not parts[0].startswith("HTTP/"):
+            raise ConnectionError("Invalid status line: %r" % status_line)
+        status = int(parts[1])
+        reason = parts[2] if len(parts) > 2 else ""
+
+        headers = {}
+        while True:
+            line = await self._reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        if method == "HEAD" or status in (204, 304) or 100 <= status < 200:
+            body = b""
+        elif headers.get("transfer-encoding", "").lower() == "chunked":
+            body = await self._read_chunked()
+        elif "content-length" in headers:
+            body = await self._reader.readexactly(int(headers["content-length"]))
+        else:
+            body = await self._reader.read()
+            headers["connection"] = "close"
+
+        if headers.get("connection", "").lower() == "close":
+            await self.close()
+
+        return Response(status, reason, headers, body)
+
+    async def _read_chunked(self):
+        chunks = []
+        while True:
+            size_line = await self._reader.readline()
+            size = int(size_line.split(b";", 1)[0].strip(), 16)
+            if size == 0:
+                # Skip the trailer
+                while (await self._reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                return b"".join(chunks)
+
+            chunks.append(await self._reader.readexactly(size))
+            await self._reader.readexactly(2)
+
+
+# Keeps the connections to one server open between requests, so the next
+# request, also of another transfer, does not need a new connection. New
+# connections resume the TLS session of the previous ones, which saves a
+# full handshake. Must be used from one event loop.
+class ConnectionPool(object):
+    IDLE_TIMEOUT = 30
+    MAX_IDLE = 16
+
+    def __init__(self, host, port, use_ssl=True):
+        self.host = host
+        self.port = port
+        self.ssl_context = create_ssl_context() if use_ssl else None
+        self._idle = []
+
+    async def get(self, timeout=None):
+        now = time.monotonic()
+        while self._idle:
+            connection, released = self._idle.pop()
+            if not connection.closed and now - released < self.IDLE_TIMEOUT:
+                return connection
+            await connection.close()
+
+        return await self.connect(timeout)
+
+    # Opens a new connection, which still resumes the TLS session
+    async def connect(self, timeout=None):
+        connection = HttpConnection(self.host, self.port, self.ssl_context)
+        await asyncio.wait_for(connection.connect(), timeout)
+        return connection
+
+    # Takes back a connection after its last request completed. A closed
+    # connection is dropped.
+    def put(self, connection):
+        if connection.closed:
+            return
+
+        ssl_object = connection.ssl_object
+        if ssl_object is not None and ssl_object.session is not None:
+            self.ssl_context.session = ssl_object.session
+
+        if len(self._idle) >= self.MAX_IDLE:
+            asyncio.ensure_future(connection.close())
+            return
+
+        self._idle.append((connection, time.monotonic()))
+
+    async def close(self):
+        idle, self._idle = self._idle, []
+        for connection, _ in idle:
+            await connection.close()
@@ -0,0 +1,388 @@
+import argparse
+import concurrent.futures as futures
+import convcache
+import json
+import logging
+import metrics
+import ovirtsdk4 as sdk
+import os
+import qos
+import signal
+import sys
+import threading
+import time
+import traceback
+
+import upload
+import vmextract
+
+
+class BatchOptions(object):
+    def __init__(self):
+        self.work_dir = None
+        self.extract_jobs = 1
+        self.extract_threads = 4
+        self.conversion_jobs = 1
+        self.uploads_per_domain = 1
+        self.max_vms = 2
+        self.no_extract = False
+        self.pipeline = False
+        self.conversion = vmextract.ConversionOptions()
+        self.upload = upload.UploadOptions()
+
+
+def read_manifest(manifest_file):
+    with open(manifest_file, "r") as f:
+        entries = json.load(f)
+
+    if not isinstance(entries, list):
+        raise RuntimeError("Manifest must contain a list of VMs")
+
+    # OVA paths are relative to the manifest
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_file))
+    for entry in entries:
+        for key in ("ova", "cluster", "domain"):
+            if key not in entry:
+                raise RuntimeError("Manifest entry %r is missing %r" % (entry, key))
+        entry["ova"] = os.path.join(manifest_dir, entry["ova"])
+
+    return entries
+
+
+class BatchRunner(object):
+    def __init__(self, entries, conn, options):
+        self._entries = entries
+        self._conn = upload.synchronized(conn)
+        self._options = options
+        self._extract_slots = threading.BoundedSemaphore(options.extract_jobs)
+        self._upload_slots = {}
+        self._upload_slots_lock = threading.Lock()
+
+    def _upload_slot(self, domain_id):
+        with self._upload_slots_lock:
+            if domain_id not in self._upload_slots:
+                self._upload_slots[domain_id] = threading.BoundedSemaphore(self._options.uploads_per_domain)
+            return self._upload_slots[domain_id]
+
+    def _work_dir(self, index, entry):
+        name = os.path.splitext(os.path.basename(entry["ova"]))[0]
+        base_dir = self._options.work_dir or os.path.dirname(entry["ova"])
+        # Every VM gets its own directory, so OVAs stored together do not
+        # overwrite each other's files
+        directory = os.path.join(base_dir, "%03d-%s" % (index, name))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        return directory
+
+    def _extract(self, index, entry):
+        directory = self._work_dir(index, entry)
+        with self._extract_slots:
+            _, ova_file, ova_index = vmextract.open_ova(entry["ova"], self._options.no_extract, directory,
+                                                         self._options.extract_threads)
+
+        ovf_file = vmextract.find_ovf(directory)
+        if ovf_file is None:
+            raise RuntimeError("OVA %s does not contain an OVF file" % entry["ova"])
+
+        return directory, vmextract.read_vm(ovf_file, ova_file, ova_index)
+
+    def _convert(self, disk, disk_def, directory):
+        vmextract.convert_disk(disk, self._options.conversion, directory)
+        if "checksum" in disk:
+            disk_def["checksum"] = disk["checksum"]
+
+        size = os.path.getsize(disk_def.get("qcow_file") or disk_def["raw_file"])
+        if size > disk_def["measured_size"]:
+            raise RuntimeError("Converted disk %s has %d bytes, more than the measured %d bytes" % (
+                disk["file"], size, disk_def["measured_size"]))
+
+    def _update_link_throughput(self, vm_def):
+        # The auto format of the following disks is chosen using the
+        # throughput of the last upload
+        throughput = metrics.metrics.sent_throughput([d["id"] for d in vm_def["disks"]])
+        if throughput is not None:
+            logging.debug("Measured upload throughput: %.1f MiB/s", throughput / 1024.0 ** 2)
+            self._options.conversion.link_throughput = throughput
+
+    def _run_vm(self, index, entry, conversion_executor):
+        report = entry["report"]
+        stage_start = time.time()
+
+        def finish_stage(stage):
+            now = time.time()
+            report["stages"][stage] = now - stage_start
+            return now
+
+        report["status"] = "extracting"
+        directory, vm = self._extract(index, entry)
+        report["directory"] = directory
+        stage_start = finish_stage("extract")
+
+        pipeline = self._options.pipeline and not self._options.conversion.native
+        if pipeline:
+            # The disks are sized up front, so the VM and its disks can be
+            # created while the disks are converted, and every disk is
+            # uploaded as soon as its conversion finishes
+            report["status"] = "measuring"
+            vmextract.measure_disks(vm, self._options.conversion, directory)
+            vm_file = vmextract.write_vm(vm, directory)
+            stage_start = finish_stage("measure")
+        else:
+            report["status"] = "converting"
+            vmextract.convert_disks(vm, False, self._options.conversion, directory, conversion_executor)
+            vm_file = vmextract.write_vm(vm, directory)
+            stage_start = finish_stage("conversion")
+
+        vm_def = upload.load_vm(vm_file)
+        if entry.get("name"):
+            vm_def["name"] = entry["name"]
+        report["name"] = vm_def["name"]
+        if "weight" in entry:
+            # Bandwidth share of the disks when the uploads are limited
+            for disk_def in vm_def["disks"]:
+                disk_def["weight"] = entry["weight"]
+        vm_def["cluster"] = entry["cluster_id"]
+        vm_def["storage_domain"] = entry["domain_id"]
+
+        conversions = None
+        if pipeline:
+            conversions = dict(
+                (disk["id"], conversion_executor.submit(self._convert, disk, disk_def, directory))
+                for disk, disk_def in zip(vm.disks, vm_def["disks"])
+            )
+
+        try:
+            report["status"] = "waiting for upload"
+            with self._upload_slot(vm_def["storage_domain"]):
+                stage_start = finish_stage("upload_queue")
+                report["status"] = "uploading"
+                upload.upload_vm(vm_def, self._conn, self._options.upload, conversions)
+                finish_stage("upload")
+                self._update_link_throughput(vm_def)
+        finally:
+            if conversions is not None:
+                for conversion in conversions.values():
+                    conversion.cancel()
+                futures.wait(conversions.values())
+
+        if pipeline:
+            # Now with the results of the conversions, vm.json can be used
+            # to resume the upload with upload.py
+            vmextract.write_vm(vm, directory)
+
+    def _fail(self, entry, error):
+        # A failed VM does not stop the others
+        report = entry["report"]
+        logging.error("VM from %s failed while %s: %s", entry["ova"], report["status"], error)
+        logging.debug("%s", traceback.format_exc())
+        report["failed_stage"] = report["status"]
+        report["error"] = "%s: %s" % (type(error).__name__, error)
+        report["status"] = "failed"
+
+    def _resolve(self, entry):
+        # Names are resolved before any OVA is extracted, so a wrong name
+        # fails the VM before its disks are converted. Lookups are cached,
+        # every name is resolved only once.
+        report = entry["report"]
+        report["status"] = "resolving"
+        try:
+            entry["cluster_id"] = upload.resolve_cluster(entry["cluster"], self._conn)
+            entry["domain_id"] = upload.resolve_domain(entry["domain"], self._conn)
+        except Exception as e:
+            self._fail(entry, e)
+            report["seconds"] = 0.0
+            return False
+
+        report["status"] = "queued"
+        return True
+
+    def _run_entry(self, index, entry, conversion_executor):
+        report = entry["report"]
+        start = time.time()
+        try:
+            self._run_vm(index, entry, conversion_executor)
+            report["status"] = "succeeded"
+            logging.info("VM from %s migrated in %.1f s", entry["ova"], time.time() - start)
+        except Exception as e:
+            self._fail(entry, e)
+        finally:
+            report["seconds"] = time.time() - start
+
+    def run(self):
+        for entry in self._entries:
+            entry["report"] = {
+                "ova": entry["ova"],
+                "name": entry.get("name"),
+                "status": "queued",
+                "stages": {}
+            }
+
+        resolved = [(index, entry) for index, entry in enumerate(self._entries) if self._resolve(entry)]
+
+        conversion_executor = futures.ThreadPoolExecutor(max_workers=self._options.conversion_jobs)
+        try:
+            with futures.ThreadPoolExecutor(max_workers=self._options.max_vms) as executor:
+                for index, entry in resolved:
+                    executor.submit(self._run_entry, index, entry, conversion_executor)
+        finally:
+            conversion_executor.shutdown()
+
+        return [entry["report"] for entry in self._entries]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Migrates the VMs listed in a manifest file from Xen OVA files to oVirt."
+    )
+    parser.add_argument("manifest",
+                        help="JSON file with a list of VMs. Each item has the keys 'ova', 'cluster', "
+                             "'domain' and optionally 'name'.")
+    parser.add_argument("-v", "--verbose", help="show debug messages", action="store_true")
+    parser.add_argument("--work-dir",
+                        help="directory for the extracted files of each VM (default: next to the OVA)")
+    parser.add_argument("--report", help="write the JSON report to this file instead of stdout")
+
+    stage_args = parser.add_argument_group("stage limits")
+    stage_args.add_argument("--max-vms", type=int, default=2,
+                            help="number of VMs processed at the same time (default: 2)")
+    stage_args.add_argument("--extract-jobs", type=int, default=1,
+                            help="number of OVA files extracted at the same time (default: 1)")
+    stage_args.add_argument("--extract-threads", type=int, default=4,
+                            help="number of threads copying the files out of one OVA (default: 4)")
+    stage_args.add_argument("--conversion-jobs", type=int, default=1,
+                            help="number of disks converted at the same time on this host (default: 1)")
+    stage_args.add_argument("--uploads-per-domain", type=int, default=1,
+                            help="number of VMs uploaded to one storage domain at the same time (default: 1)")
+
+    parser.add_argument("-n", "--no-extract", action="store_true",
+                        help="extract only the OVF file and convert disks directly from the OVA archive")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="create the VM and disks while the disks are converted and upload every "
+                             "disk as soon as it is converted")
+    parser.add_argument("--conversion-cache",
+                        help="directory where converted images are kept and reused when the same VHD "
+                             "is converted again")
+    parser.add_argument("--conversion-cache-size", type=float, default=100,
+                        help="size limit of the conversion cache in GiB (default: 100)")
+    parser.add_argument("--format", choices=vmextract.FORMATS, default="qcow2",
+                        help="format of the converted images, see vmextract.py --help (default: qcow2)")
+    parser.add_argument("--compression-type", choices=["zlib", "zstd"],
+                        help="compression of compressed qcow2 images")
+    parser.add_argument("--link-throughput", type=float,
+                        help="upload throughput in MiB/s used by the auto format until it is measured "
+                             "by the first upload")
+    parser.add_argument("--native-vhd", action="store_true",
+                        help="do not convert disks, upload the VHD images directly")
+    parser.add_argument("--max-transfers", type=int, default=1,
+                        help="maximum number of disks of one VM uploaded concurrently (default: 1)")
+    parser.add_argument("--connections", type=int, default=1,
+                        help="number of parallel HTTPS connections used to upload one disk (default: 1)")
+    parser.add_argument("--dense", action="store_true",
+                        help="upload every byte of the images, do not skip zero regions")
+    parser.add_argument("--transfer-path", choices=["host", "proxy", "probe"], default="host",
+                        help="where the data is sent, see upload.py --help (default: host)")
+
+    parser.add_argument("--max-bandwidth", type=float,
+                        help="upload bandwidth limit in MiB/s shared by all transfers")
+    parser.add_argument("--max-domain-bandwidth", type=float,
+                        help="upload bandwidth limit in MiB/s of each storage domain")
+    parser.add_argument("--max-transfer-bandwidth", type=float,
+                        help="upload bandwidth limit in MiB/s of each disk")
+    parser.add_argument("--bandwidth-file",
+                        help="JSON file with bandwidth limits and weights, read again when it changes or on SIGHUP")
+    parser.add_argument("--retries", type=int, default=5,
+                        help="number of times a failed upload request is sent again (default: 5)")
+    parser.add_argument("--verify", action="store_true",
+                        help="store checksums of converted images and verify the uploaded disks")
+    parser.add_argument("--engine-events", action="store_true",
+                        help="follow the engine events to notice state changes sooner")
+    parser.add_argument("--metrics-file",
+                        help="append phase timings, progress and a summary as JSON lines to this file")
+    parser.add_argument("--prometheus-file",
+                        help="write the metrics in Prometheus text format to this file when finished")
+
+    required_args = parser.add_argument_group("required arguments")
+    required_args.add_argument("--engine", help="URL of the oVirt engine API", required=True)
+    required_args.add_argument("--user", help="oVirt user name", required=True)
+    required_args.add_argument("--password", help="oVirt user password", required=True)
+
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(
+        logging.DEBUG if args.verbose else logging.INFO
+    )
+
+    options = BatchOptions()
+    options.work_dir = os.path.abspath(args.work_dir) if args.work_dir else None
+    options.max_vms = args.max_vms
+    options.extract_jobs = args.extract_jobs
+    options.extract_threads = args.extract_threads
+    options.conversion_jobs = args.conversion_jobs
+    options.uploads_per_domain = args.uploads_per_domain
+    options.no_extract = args.no_extract
+    options.pipeline = args.pipeline
+    if args.conversion_cache:
+        options.conversion.conversion_cache = convcache.ConversionCache(
+            os.path.abspath(args.conversion_cache),
+            int(args.conversion_cache_size * 1024 ** 3)
+        )
+    options.conversion.native = args.native_vhd
+    options.conversion.format = args.format
+    options.conversion.compression_type = args.compression_type
+    if args.link_throughput:
+        options.conversion.link_throughput = args.link_throughput * 1024 ** 2
+    options.upload.max_transfers = args.max_transfers
+    options.upload.connections = args.connections
+    options.upload.sparse = not args.dense
+    options.upload.transfer_path = args.transfer_path
+    options.conversion.checksum = args.verify
+    options.upload.verify = args.verify
+    options.upload.retries = args.retries
+
+    entries = read_manifest(args.manifest)
+    upload.bandwidth.configure(
+        qos.mib_per_second(args.max_bandwidth),
+        qos.mib_per_second(args.max_domain_bandwidth),
+        qos.mib_per_second(args.max_transfer_bandwidth),
+        args.bandwidth_file
+    )
+    if args.bandwidth_file:
+        # Without a control file, SIGHUP keeps its default action
+        signal.signal(signal.SIGHUP, lambda signum, frame: upload.bandwidth.reload())
+
+    connection = sdk.Connection(
+        url=args.engine,
+        username=args.user,
+        password=args.password,
+        insecure=True
+    )
+
+    connection.test(raise_exception=True)
+
+    connection = upload.synchronized(connection)
+    if args.engine_events:
+        events = upload.EventWatcher(connection)
+        if events.start():
+            upload.state_waiter.events = events
+
+    metrics.metrics.configure(args.metrics_file, args.prometheus_file, script="batch")
+    try:
+        reports = BatchRunner(entries, connection, options).run()
+    finally:
+        connection.close()
+        metrics.metrics.close()
+
+    output = json.dumps(reports, indent=4)
+    if args.report:
+        with open(args.report, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+    failed = [r for r in reports if r["status"] != "succeeded"]
+    logging.info("Migrated %d of %d VMs", len(reports) - len(failed), len(reports))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,271 @@
+import argparse
+import json
+import logging
+import os
+import random
+import re
+import socketserver
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from http import server
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import blkhash
+
+
+class TokenBucket(object):
+    def __init__(self, rate):
+        self.rate = rate
+        self._tokens = 0.0
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def consume(self, count):
+        if not self.rate:
+            return
+
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.rate, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= count
+            delay = -self._tokens / self.rate if self._tokens < 0 else 0
+
+        if delay:
+            time.sleep(delay)
+
+
+class ImageioHandler(server.BaseHTTPRequestHandler):
+    # Emulates the parts of the imageio proxy API used by upload.py:
+    # OPTIONS, PUT with Content-Range, PATCH zero/flush requests, and GET
+    # of data and checksums when the images are stored.
+    protocol_version = "HTTP/1.1"
+    BUFFER_SIZE = 1024 * 1024
+
+    def log_message(self, format, *args):
+        logging.debug(format, *args)
+
+    def _ticket(self):
+        match = re.match(r"/images/([^/?]+)", self.path)
+        return match.group(1) if match else None
+
+    def _reply(self, status, body=b"", content_type="application/json"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _image_file(self, ticket):
+        if self.server.image_dir is None:
+            return None
+        return os.path.join(self.server.image_dir, ticket)
+
+    def do_OPTIONS(self):
+        self._reply(200, json.dumps({
+            "features": ["extents", "zero", "flush"],
+            "unix_socket": None
+        }).encode("UTF-8"))
+
+    def do_GET(self):
+        ticket = self._ticket()
+        path = self._image_file(ticket)
+        if path is None:
+            self._reply(404, b'{"error": "image is not stored"}')
+            return
+
+        if self.path.endswith("/extents"):
+            size = self.server.volume_size(path)
+            self._reply(200, json.dumps([
+                {"start": 0, "length": size, "zero": False, "hole": False}
+            ]).encode("UTF-8"))
+            return
+
+        if self.path.endswith("/checksum"):
+            if not self.server.checksum or not os.path.exists(path):
+                self._reply(404, b'{"error": "not found"}')
+                return
+
+            # Like imageio, the checksum covers the whole volume
+            h = blkhash.Hash()
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(blkhash.BLOCK_SIZE), b""):
+                    h.update(block)
+            h.zero(self.server.volume_size(path) - os.path.getsize(path))
+            self._reply(200, json.dumps(h.to_dict()).encode("UTF-8"))
+            return
+
+        # Nothing was written yet to a new image
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        match = re.match(r"bytes=(\d+)-(\d+)", self.headers.get("Range", ""))
+        start, end = (int(match.group(1)), int(match.group(2)) + 1) if match else (0, size)
+        data = b""
+        if size:
+            with open(path, "rb") as f:
+                f.seek(start)
+                data = f.read(end - start)
+        # Data beyond the end of the file was zeroed
+        data += bytes(end - start - len(data))
+
+        self.server.bandwidth.consume(len(data))
+        self._delay()
+        self._reply(206 if match else 200, data, "application/octet-stream")
+
+    def do_PUT(self):
+        ticket = self._ticket()
+        match = re.match(r"bytes (\d+)-(\d+)/(\d+|\*)", self.headers.get("Content-Range", ""))
+        offset = int(match.group(1)) if match else 0
+        length = int(self.headers["Content-Length"])
+
+        path = self._image_file(ticket)
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o644) if path else None
+        try:
+            received = 0
+            while received < length:
+                data = self.rfile.read(min(self.BUFFER_SIZE, length - received))
+                if not data:
+                    raise RuntimeError("Client disconnected")
+
+                self.server.bandwidth.consume(len(data))
+                if fd is not None:
+                    os.pwrite(fd, data, offset + received)
+                received += len(data)
+        finally:
+            if fd is not None:
+                os.close(fd)
+
+        self.server.record(ticket, "put", length)
+        self._delay()
+        if self.server.failure_rate and random.random() < self.server.failure_rate:
+            # Half of the failures drop the connection, the others are
+            # server errors
+            self.server.record(ticket, "failed", length)
+            if random.random() < 0.5:
+                self.close_connection = True
+                return
+            self._reply(503, b'{"error": "injected failure"}')
+            return
+
+        self._reply(200)
+
+    def do_PATCH(self):
+        ticket = self._ticket()
+        length = int(self.headers["Content-Length"])
+        request = json.loads(self.rfile.read(length).decode("UTF-8"))
+
+        if request["op"] == "zero":
+            path = self._image_file(ticket)
+            if path is not None:
+                with open(path, "ab") as f:
+                    end = request["offset"] + request["size"]
+                    if f.tell() < end:
+                        f.truncate(end)
+            self.server.record(ticket, "zero", request["size"])
+        elif request["op"] != "flush":
+            self._reply(400, b'{"error": "unsupported operation"}')
+            return
+
+        self._delay()
+        self._reply(200)
+
+    def _delay(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+
+class ImageioServer(socketserver.ThreadingMixIn, server.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, cert_file, key_file, latency=0, bandwidth=0, image_dir=None, checksum=True,
+                 failure_rate=0, volume_alignment=0):
+        server.HTTPServer.__init__(self, address, ImageioHandler)
+        self.latency = latency
+        self.bandwidth = TokenBucket(bandwidth)
+        self.image_dir = image_dir
+        self.checksum = checksum
+        self.failure_rate = failure_rate
+        self.volume_alignment = volume_alignment
+        self.stats = {}
+        self._stats_lock = threading.Lock()
+
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(cert_file, key_file)
+        self.socket = context.wrap_socket(self.socket, server_side=True)
+
+    @property
+    def url(self):
+        return "https://%s:%d/images" % self.server_address[:2]
+
+    # Volumes on block storage are logical volumes allocated in extents, so
+    # they can be larger than the uploaded image
+    def volume_size(self, path):
+        size = os.path.getsize(path) if path is not None and os.path.exists(path) else 0
+        if self.volume_alignment:
+            size += -size % self.volume_alignment
+        return size
+
+    def record(self, ticket, op, length):
+        with self._stats_lock:
+            stats = self.stats.setdefault(ticket, {"put_requests": 0, "put_bytes": 0,
+                                                   "zero_requests": 0, "zero_bytes": 0,
+                                                   "failed_requests": 0, "failed_bytes": 0})
+            stats[op + "_requests"] += 1
+            stats[op + "_bytes"] += length
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+
+def create_certificate(directory):
+    cert_file = os.path.join(directory, "cert.pem")
+    key_file = os.path.join(directory, "key.pem")
+    subprocess.check_call([
+        "openssl", "req", "-x509",
+        "-newkey", "rsa:2048",
+        "-nodes",
+        "-keyout", key_file,
+        "-out", cert_file,
+        "-days", "1",
+        "-subj", "/CN=localhost"
+    ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return cert_file, key_file
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs a local HTTPS server emulating the imageio proxy.")
+    parser.add_argument("-v", "--verbose", help="show debug messages", action="store_true")
+    parser.add_argument("--port", type=int, default=54323, help="port to listen on (default: 54323)")
+    parser.add_argument("--latency", type=float, default=0, help="seconds added to every response")
+    parser.add_argument("--bandwidth", type=float, default=0, help="bandwidth cap in MiB/s")
+    parser.add_argument("--image-dir", help="store received images in this directory, otherwise data is discarded")
+    parser.add_argument("--no-checksum", action="store_true",
+                        help="do not support checksum requests, like older imageio versions")
+    parser.add_argument("--volume-alignment", type=float, default=0,
+                        help="round the volume size up to this many MiB, like logical volumes on block storage")
+    parser.add_argument("--failure-rate", type=float, default=0,
+                        help="fraction of PUT requests that fail with a server error or a dropped connection")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(
+        logging.DEBUG if args.verbose else logging.INFO
+    )
+
+    cert_dir = tempfile.mkdtemp()
+    cert_file, key_file = create_certificate(cert_dir)
+    imageio = ImageioServer(("127.0.0.1", args.port), cert_file, key_file,
+                            args.latency, args.bandwidth * 1024 * 1024, args.image_dir, not args.no_checksum,
+                            args.failure_rate, int(args.volume_alignment * 1024 * 1024))
+    logging.info("Listening on %s", imageio.url)
+    imageio.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
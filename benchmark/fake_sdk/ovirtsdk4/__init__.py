@@ -0,0 +1,283 @@
+# Minimal stand-in for the parts of ovirtsdk4 used by upload.py. The engine
+# state lives in this process. Image transfers point to the imageio server
+# given by the FAKE_IMAGEIO_URL environment variable.
+#
+# Optional environment variables:
+#   FAKE_IMAGEIO_HOST_URL - base of the transfer URL of image transfers,
+#                           FAKE_IMAGEIO_URL is used only as the proxy URL
+#   FAKE_ENGINE_LATENCY - seconds added to every API call
+#   FAKE_ENGINE_LOG     - file where every API call is logged as a JSON line
+#   FAKE_STORAGE_TYPE   - storage type of every storage domain (default: nfs),
+#                         raw sparse disks are rejected on iscsi and fcp
+
+import json
+import os
+import re
+import threading
+import time
+import uuid
+
+from ovirtsdk4 import types
+
+
+class Error(Exception):
+    pass
+
+
+class NotFoundError(Error):
+    pass
+
+
+_LATENCY = float(os.environ.get("FAKE_ENGINE_LATENCY", "0"))
+_LOG_FILE = os.environ.get("FAKE_ENGINE_LOG")
+_STORAGE_TYPE = os.environ.get("FAKE_STORAGE_TYPE", types.StorageType.NFS)
+_log_lock = threading.Lock()
+
+
+def _api_call(service, method, start):
+    if _LATENCY:
+        time.sleep(_LATENCY)
+
+    if _LOG_FILE is None:
+        return
+
+    with _log_lock:
+        with open(_LOG_FILE, "a") as f:
+            f.write(json.dumps({
+                "service": service,
+                "method": method,
+                "start": start,
+                "end": time.time()
+            }) + "\n")
+
+
+def _api(method):
+    def wrapper(self, *args, **kwargs):
+        start = time.time()
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            _api_call(self._name, method.__name__, start)
+    return wrapper
+
+
+def _match(obj, search):
+    # Supports "field=value" terms joined with "or"
+    for term in re.split(r"\s+or\s+", search.strip()):
+        field, value = term.split("=", 1)
+        if str(getattr(obj, field, None)) == value:
+            return True
+    return False
+
+
+class _Engine(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.clusters = {}
+        self.storage_domains = {}
+        self.vms = {}
+        self.disks = {}
+        self.transfers = {}
+        self.attachments = {}
+        self.events = []
+
+
+_engine = _Engine()
+
+
+class _CollectionService(object):
+    def __init__(self, name, objects):
+        self._name = name
+        self._objects = objects
+
+    @_api
+    def list(self, search=None, max=None, query=None, **kwargs):
+        if query and "search" in query:
+            search = query["search"]
+
+        with _engine.lock:
+            result = [o for o in self._objects.values() if search is None or _match(o, search)]
+
+        return result[:max] if max else result
+
+    @_api
+    def add(self, obj, **kwargs):
+        with _engine.lock:
+            if obj.id is None:
+                obj.id = str(uuid.uuid4())
+            self._added(obj)
+            self._objects[obj.id] = obj
+        return obj
+
+    def _added(self, obj):
+        pass
+
+    def service(self, id):
+        return _EntityService(self._name, self._objects, id)
+
+
+class _EntityService(object):
+    def __init__(self, name, objects, id):
+        self._name = name
+        self._objects = objects
+        self._id = id
+
+    def _get(self):
+        obj = self._objects.get(self._id)
+        if obj is None:
+            raise NotFoundError("%s %s not found" % (self._name, self._id))
+        return obj
+
+    @_api
+    def get(self, **kwargs):
+        with _engine.lock:
+            obj = self._get()
+            self._advance(obj)
+            return obj
+
+    @_api
+    def remove(self, **kwargs):
+        with _engine.lock:
+            self._get()
+            del self._objects[self._id]
+
+    def _advance(self, obj):
+        pass
+
+
+def _advance_disk(disk):
+    # A new disk is locked for the first poll, like on a real engine
+    if disk.status == types.DiskStatus.LOCKED:
+        if disk.locked_polls <= 0:
+            disk.status = types.DiskStatus.OK
+        disk.locked_polls -= 1
+
+
+class _DisksService(_CollectionService):
+    def list(self, *args, **kwargs):
+        disks = _CollectionService.list(self, *args, **kwargs)
+        with _engine.lock:
+            for disk in disks:
+                _advance_disk(disk)
+        return disks
+
+    def _added(self, disk):
+        if disk.format == types.DiskFormat.RAW and disk.sparse and _STORAGE_TYPE in (
+                types.StorageType.ISCSI, types.StorageType.FCP):
+            raise Error("Raw sparse disks are not supported on block storage domains")
+        disk.status = types.DiskStatus.LOCKED
+        disk.locked_polls = 1
+
+    def service(self, id):
+        return _DiskService(self._name, self._objects, id)
+
+
+class _DiskService(_EntityService):
+    def _advance(self, disk):
+        _advance_disk(disk)
+
+
+class _TransfersService(_CollectionService):
+    def _added(self, transfer):
+        disk = _engine.disks.get(transfer.disk.id)
+        if disk is None:
+            raise NotFoundError("Disk %s not found" % transfer.disk.id)
+
+        disk.status = types.DiskStatus.LOCKED
+        disk.locked_polls = 1<<30
+        transfer.phase = types.ImageTransferPhase.INITIALIZING
+        base_url = os.environ["FAKE_IMAGEIO_URL"].rstrip("/")
+        transfer.proxy_url = "%s/%s" % (base_url, transfer.id)
+        host_url = os.environ.get("FAKE_IMAGEIO_HOST_URL")
+        transfer.transfer_url = "%s/%s" % (host_url.rstrip("/"), transfer.id) if host_url else transfer.proxy_url
+        transfer.signed_ticket = "ticket-%s" % transfer.id
+
+    def service(self, id):
+        return _TransferService(self._name, self._objects, id)
+
+
+class _TransferService(_EntityService):
+    def _advance(self, transfer):
+        if transfer.phase == types.ImageTransferPhase.INITIALIZING:
+            transfer.phase = types.ImageTransferPhase.TRANSFERRING
+
+    @_api
+    def extend(self, **kwargs):
+        with _engine.lock:
+            self._get()
+
+    @_api
+    def finalize(self, **kwargs):
+        with _engine.lock:
+            transfer = self._get()
+            transfer.phase = types.ImageTransferPhase.FINISHED_SUCCESS
+            disk = _engine.disks[transfer.disk.id]
+            disk.status = types.DiskStatus.LOCKED
+            disk.locked_polls = 1
+
+    @_api
+    def cancel(self, **kwargs):
+        with _engine.lock:
+            transfer = self._get()
+            transfer.phase = types.ImageTransferPhase.CANCELLED
+            _engine.disks[transfer.disk.id].status = types.DiskStatus.OK
+
+
+class Connection(object):
+    def __init__(self, url=None, username=None, password=None, insecure=False, **kwargs):
+        self.url = url
+
+    def test(self, raise_exception=False):
+        return True
+
+    def close(self):
+        pass
+
+    def system_service(self):
+        return self
+
+    def service(self, path):
+        if path == "clusters":
+            return _CollectionService(path, _engine.clusters)
+        if path == "storagedomains":
+            return _CollectionService(path, _engine.storage_domains)
+        if path == "vms":
+            return _CollectionService(path, _engine.vms)
+        if path == "disks":
+            return _DisksService(path, _engine.disks)
+        if path == "imagetransfers":
+            return _TransfersService(path, _engine.transfers)
+        if path == "events":
+            return _CollectionService(path, {})
+
+        match = re.match(r"vms/([^/]+)/diskattachments\Z", path)
+        if match:
+            attachments = _engine.attachments.setdefault(match.group(1), {})
+            return _AttachmentsService(path, attachments)
+
+        raise NotFoundError("Unknown service: %s" % path)
+
+
+class _AttachmentsService(_CollectionService):
+    def _added(self, attachment):
+        attachment.id = attachment.disk.id
+
+
+def _add_default_objects():
+    # Every cluster and storage domain looked up by ID or name exists
+    class _AnyObjects(dict):
+        def __init__(self, kind, **values):
+            dict.__init__(self)
+            self.kind = kind
+            self.values = values
+
+        def get(self, id, default=None):
+            if id not in self:
+                self[id] = self.kind(id=id, name=id, **self.values)
+            return dict.get(self, id)
+
+    _engine.clusters = _AnyObjects(types.Cluster)
+    _engine.storage_domains = _AnyObjects(types.StorageDomain, storage=types.HostStorage(type=_STORAGE_TYPE))
+
+
+_add_default_objects()
@@ -0,0 +1,98 @@
+# Plain data classes standing in for ovirtsdk4.types
+
+
+class _Struct(object):
+    def __init__(self, **kwargs):
+        self.id = None
+        for key, value in kwargs.items():
+            setattr(self, key, value)
+
+    def __repr__(self):
+        return "%s(%s)" % (type(self).__name__, ", ".join(
+            "%s=%r" % item for item in sorted(self.__dict__.items())))
+
+
+class Vm(_Struct):
+    pass
+
+
+class Cluster(_Struct):
+    pass
+
+
+class Template(_Struct):
+    pass
+
+
+class Cpu(_Struct):
+    pass
+
+
+class CpuTopology(_Struct):
+    pass
+
+
+class Disk(_Struct):
+    pass
+
+
+class StorageDomain(_Struct):
+    pass
+
+
+class HostStorage(_Struct):
+    pass
+
+
+class DiskAttachment(_Struct):
+    pass
+
+
+class ImageTransfer(_Struct):
+    pass
+
+
+class Event(_Struct):
+    pass
+
+
+class DiskFormat(object):
+    COW = "cow"
+    RAW = "raw"
+
+
+class StorageType(object):
+    FCP = "fcp"
+    ISCSI = "iscsi"
+    NFS = "nfs"
+
+
+class DiskStatus(object):
+    ILLEGAL = "illegal"
+    LOCKED = "locked"
+    OK = "ok"
+
+
+class DiskInterface(object):
+    IDE = "ide"
+    VIRTIO = "virtio"
+    VIRTIO_SCSI = "virtio_scsi"
+
+
+class ImageTransferDirection(object):
+    DOWNLOAD = "download"
+    UPLOAD = "upload"
+
+
+class ImageTransferPhase(object):
+    CANCELLED = "cancelled"
+    FINALIZING_FAILURE = "finalizing_failure"
+    FINALIZING_SUCCESS = "finalizing_success"
+    FINISHED_FAILURE = "finished_failure"
+    FINISHED_SUCCESS = "finished_success"
+    INITIALIZING = "initializing"
+    PAUSED_SYSTEM = "paused_system"
+    PAUSED_USER = "paused_user"
+    RESUMING = "resuming"
+    TRANSFERRING = "transferring"
+    UNKNOWN = "unknown"
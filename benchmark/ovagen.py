@@ -0,0 +1,237 @@
+import argparse
+import io
+import logging
+import os
+import random
+import struct
+import tarfile
+import time
+import uuid
+
+import lxml.etree as et
+
+
+NAMESPACES = {
+    "ovf": "http://schemas.dmtf.org/ovf/envelope/1",
+    "rasd": "http://schemas.dmtf.org/wbem/wscim/1/cim-schema/2/CIM_ResourceAllocationSettingData",
+    "vssd": "http://schemas.dmtf.org/wbem/wscim/1/cim-schema/2/CIM_VirtualSystemSettingData",
+    "xsi": "http://www.w3.org/2001/XMLSchema-instance",
+    "xenovf": "http://schemas.citrix.com/ovf/envelope/1"
+}
+
+SECTOR_SIZE = 512
+BLOCK_SIZE = 2 * 1024 * 1024
+
+
+def parse_size(value):
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+    if value[-1].upper() in units:
+        return int(float(value[:-1]) * units[value[-1].upper()])
+    return int(value)
+
+
+def ns(prefix, name):
+    return "{%s}%s" % (NAMESPACES[prefix], name)
+
+
+def vhd_checksum(data, checksum_offset):
+    total = sum(data[:checksum_offset]) + sum(data[checksum_offset + 4:])
+    return ~total & 0xFFFFFFFF
+
+
+def vhd_footer(virtual_size, disk_type, data_offset):
+    footer = bytearray(512)
+    footer[0:8] = b"conectix"
+    struct.pack_into(">I", footer, 8, 2)
+    struct.pack_into(">I", footer, 12, 0x00010000)
+    struct.pack_into(">Q", footer, 16, data_offset)
+    struct.pack_into(">I", footer, 24, int(time.time()) - 946684800)
+    footer[28:32] = b"xen "
+    struct.pack_into(">Q", footer, 40, virtual_size)
+    struct.pack_into(">Q", footer, 48, virtual_size)
+    struct.pack_into(">I", footer, 60, disk_type)
+    footer[68:84] = uuid.uuid4().bytes
+    struct.pack_into(">I", footer, 64, vhd_checksum(footer, 64))
+    return bytes(footer)
+
+
+class DynamicVhdStream(object):
+    # Generates a dynamic VHD on the fly, so it can be written to the tar
+    # archive without a temporary file. `allocated` is the fraction of
+    # blocks that contain data.
+    def __init__(self, virtual_size, allocated, seed):
+        rand = random.Random(seed)
+        self.virtual_size = virtual_size
+        self.block_count = (virtual_size + BLOCK_SIZE - 1) // BLOCK_SIZE
+        self.allocated_blocks = sorted(rand.sample(range(self.block_count),
+                                                   int(self.block_count * allocated)))
+        self._pattern = bytes(rand.getrandbits(8) for _ in range(4096)) * (BLOCK_SIZE // 4096)
+
+        footer = vhd_footer(virtual_size, 3, 512)
+        bat_size = (self.block_count * 4 + SECTOR_SIZE - 1) // SECTOR_SIZE * SECTOR_SIZE
+        bitmap_size = SECTOR_SIZE
+
+        header = bytearray(1024)
+        header[0:8] = b"cxsparse"
+        struct.pack_into(">Q", header, 8, 0xFFFFFFFFFFFFFFFF)
+        struct.pack_into(">Q", header, 16, 512 + 1024)
+        struct.pack_into(">I", header, 24, 0x00010000)
+        struct.pack_into(">I", header, 28, self.block_count)
+        struct.pack_into(">I", header, 32, BLOCK_SIZE)
+        struct.pack_into(">I", header, 36, vhd_checksum(header, 36))
+
+        bat = [0xFFFFFFFF] * self.block_count
+        data_start = 512 + 1024 + bat_size
+        for index, block in enumerate(self.allocated_blocks):
+            bat[block] = (data_start + index * (bitmap_size + BLOCK_SIZE)) // SECTOR_SIZE
+
+        bat_bytes = struct.pack(">%dI" % self.block_count, *bat)
+        self._head = footer + bytes(header) + bat_bytes + bytes(bat_size - len(bat_bytes))
+        self._footer = footer
+        self.size = len(self._head) + len(self.allocated_blocks) * (bitmap_size + BLOCK_SIZE) + len(footer)
+        self._parts = self._generate()
+        self._part = b""
+        self._part_offset = 0
+
+    def _generate(self):
+        yield self._head
+        bitmap = b"\xff" * (BLOCK_SIZE // SECTOR_SIZE // 8)
+        bitmap += bytes(SECTOR_SIZE - len(bitmap))
+        for block in self.allocated_blocks:
+            yield bitmap
+            # Make every block different, but cheap to generate
+            yield struct.pack(">Q", block) + self._pattern[8:]
+        yield self._footer
+
+    def read(self, size=-1):
+        chunks = []
+        while size != 0:
+            if self._part_offset == len(self._part):
+                self._part = next(self._parts, None)
+                self._part_offset = 0
+                if self._part is None:
+                    self._part = b""
+                    break
+
+            count = len(self._part) - self._part_offset
+            if size > 0:
+                count = min(count, size)
+                size -= count
+            chunks.append(self._part[self._part_offset:self._part_offset + count])
+            self._part_offset += count
+
+        return b"".join(chunks)
+
+
+def build_ovf(vm_name, disks, cpu_count, memory_mb, extra_items):
+    envelope = et.Element(ns("ovf", "Envelope"), nsmap=NAMESPACES)
+
+    references = et.SubElement(envelope, ns("ovf", "References"))
+    disk_section = et.SubElement(envelope, ns("ovf", "DiskSection"))
+    et.SubElement(disk_section, ns("ovf", "Info")).text = "Disks"
+    for disk in disks:
+        et.SubElement(references, ns("ovf", "File"), {
+            ns("ovf", "id"): disk["file_id"],
+            ns("ovf", "href"): disk["file"],
+            ns("ovf", "size"): str(disk["file_size"])
+        })
+        et.SubElement(disk_section, ns("ovf", "Disk"), {
+            ns("ovf", "diskId"): disk["id"],
+            ns("ovf", "fileRef"): disk["file_id"],
+            ns("ovf", "capacity"): str(disk["capacity"]),
+            ns("ovf", "format"): "http://www.microsoft.com/technet/virtualserver/downloads/vhdspec.mspx",
+            ns("xenovf", "isBootable"): "true" if disk["bootable"] else "false"
+        })
+
+    system = et.SubElement(envelope, ns("ovf", "VirtualSystem"), {ns("ovf", "id"): str(uuid.uuid4())})
+    et.SubElement(system, ns("ovf", "Info")).text = "Synthetic Xen VM"
+    et.SubElement(system, ns("ovf", "Name")).text = vm_name
+
+    hardware = et.SubElement(system, ns("ovf", "VirtualHardwareSection"))
+    et.SubElement(hardware, ns("ovf", "Info")).text = "Virtual hardware"
+
+    def add_item(resource_type, instance_id, name, **values):
+        item = et.SubElement(hardware, ns("ovf", "Item"))
+        et.SubElement(item, ns("rasd", "ElementName")).text = name
+        et.SubElement(item, ns("rasd", "InstanceID")).text = instance_id
+        et.SubElement(item, ns("rasd", "ResourceType")).text = str(resource_type)
+        for key, value in sorted(values.items()):
+            et.SubElement(item, ns("rasd", key)).text = str(value)
+
+    add_item(3, str(uuid.uuid4()), "CPU", VirtualQuantity=cpu_count)
+    add_item(4, str(uuid.uuid4()), "Memory", AllocationUnits="byte * 2^20", VirtualQuantity=memory_mb)
+    for disk in disks:
+        add_item(19, disk["id"], disk["name"])
+
+    # Network items only make the OVF larger, they are ignored by the reader
+    for index in range(extra_items):
+        add_item(10, str(uuid.uuid4()), "Network %d" % index, Connection="xenbr0")
+
+    other = et.SubElement(hardware, ns("xenovf", "VirtualSystemOtherConfigurationData"), {"Name": "platform"})
+    et.SubElement(other, ns("xenovf", "Value")).text = "cores-per-socket=2;nx=true;"
+
+    # Xen writes the declaration with double quotes
+    return b'<?xml version="1.0" encoding="UTF-8"?>\n' + et.tostring(envelope, pretty_print=True)
+
+
+def generate_ova(path, disk_count, disk_size, allocated, extra_items=0, seed=0):
+    vm_name = os.path.splitext(os.path.basename(path))[0]
+    disks = []
+    streams = []
+    for index in range(disk_count):
+        stream = DynamicVhdStream(disk_size, allocated, seed + index)
+        streams.append(stream)
+        disks.append({
+            "id": str(uuid.uuid4()),
+            "file_id": "file%d" % index,
+            "file": "disk%d.vhd" % index,
+            "file_size": stream.size,
+            "name": "Disk %d" % index,
+            "capacity": disk_size,
+            "bootable": index == 0
+        })
+
+    ovf = build_ovf(vm_name, disks, 4, 4096, extra_items)
+
+    with tarfile.open(path, "w", format=tarfile.GNU_FORMAT) as tar:
+        info = tarfile.TarInfo("%s.ovf" % vm_name)
+        info.size = len(ovf)
+        info.mtime = int(time.time())
+        tar.addfile(info, io.BytesIO(ovf))
+
+        for disk, stream in zip(disks, streams):
+            logging.info("Writing %s, %d bytes", disk["file"], stream.size)
+            info = tarfile.TarInfo(disk["file"])
+            info.size = stream.size
+            info.mtime = int(time.time())
+            tar.addfile(info, stream)
+
+    return {
+        "ova": path,
+        "ovf_bytes": len(ovf),
+        "disks": [{"file": d["file"], "capacity": d["capacity"], "vhd_bytes": d["file_size"]} for d in disks]
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generates a synthetic Xen OVA file for benchmarks.")
+    parser.add_argument("-v", "--verbose", help="show debug messages", action="store_true")
+    parser.add_argument("--disks", type=int, default=2, help="number of disks (default: 2)")
+    parser.add_argument("--size", default="1G", help="virtual size of each disk, like 10G (default: 1G)")
+    parser.add_argument("--allocated", type=float, default=0.25,
+                        help="fraction of disk blocks containing data (default: 0.25)")
+    parser.add_argument("--ovf-items", type=int, default=0,
+                        help="number of extra items added to the OVF to make it larger")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument("filename", help="output OVA file")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(
+        logging.DEBUG if args.verbose else logging.INFO
+    )
+
+    generate_ova(args.filename, args.disks, parse_size(args.size), args.allocated, args.ovf_items, args.seed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+import argparse
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import uuid
+
+import ovagen
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Appended, so another vmextract.py can be compared using PYTHONPATH
+sys.path.append(os.path.dirname(BENCHMARK_DIR))
+
+import vmextract
+
+
+def write_ovf(path, disk_count, extra_items):
+    disks = []
+    for index in range(disk_count):
+        disks.append({
+            "id": str(uuid.uuid4()),
+            "file_id": "file%d" % index,
+            "file": "disk%d.vhd" % index,
+            "file_size": 1024 * 1024,
+            "name": "Disk %d" % index,
+            "capacity": 1024 * 1024 * 1024,
+            "bootable": index == 0
+        })
+
+    ovf = ovagen.build_ovf("bench-vm", disks, 4, 4096, extra_items)
+    with open(path, "wb") as f:
+        f.write(ovf)
+
+    return len(ovf)
+
+
+def measure(path, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        vm = vmextract.read_vm(path)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best, len(vm.disks)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measures the time vmextract.py needs to read OVF files with many disks and items."
+    )
+    parser.add_argument("--disks", default="1,10,100,500",
+                        help="comma separated numbers of disks (default: 1,10,100,500)")
+    parser.add_argument("--ovf-items", type=int, default=500,
+                        help="number of extra items in every OVF (default: 500)")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="number of measurements, the best one is reported (default: 5)")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.ERROR)
+
+    results = []
+    work_dir = tempfile.mkdtemp(prefix="ovf-bench-")
+    for disk_count in [int(d) for d in args.disks.split(",")]:
+        path = os.path.join(work_dir, "bench-%d.ovf" % disk_count)
+        ovf_bytes = write_ovf(path, disk_count, args.ovf_items)
+        seconds, disks_read = measure(path, args.repeat)
+        if disks_read != disk_count:
+            raise RuntimeError("Read %d disks, expected %d" % (disks_read, disk_count))
+
+        results.append({
+            "disks": disk_count,
+            "ovf_items": args.ovf_items,
+            "ovf_bytes": ovf_bytes,
+            "seconds": seconds
+        })
+        os.unlink(path)
+
+    os.rmdir(work_dir)
+    print(json.dumps({"vmextract": vmextract.__file__, "results": results}, indent=4))
+
+
+if __name__ == '__main__':
+    main()
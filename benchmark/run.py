@@ -0,0 +1,231 @@
+import argparse
+import json
+import logging
+import os
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+
+import fake_imageio
+import ovagen
+
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+
+# Any IDs work with the fake engine
+CLUSTER_ID = "00000000-0000-0000-0000-0000000000c1"
+DOMAIN_ID = "00000000-0000-0000-0000-0000000000d1"
+
+
+def run_phase(name, cmd, env=None, log_file=None):
+    logging.info("Running %s: %s", name, " ".join(shlex.quote(c) for c in cmd))
+    with open(log_file or os.devnull, "w") as log:
+        start = time.time()
+        process = subprocess.Popen(cmd, env=env, stdout=log, stderr=subprocess.STDOUT)
+        _, status, rusage = os.wait4(process.pid, 0)
+        elapsed = time.time() - start
+
+    # The child was reaped by wait4, do not let Popen wait for it again
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise RuntimeError("%s failed with exit code %d, see %s" % (name, process.returncode, log_file))
+
+    return {
+        "seconds": elapsed,
+        "user_cpu_seconds": rusage.ru_utime,
+        "system_cpu_seconds": rusage.ru_stime,
+        # ru_maxrss is in KiB on Linux
+        "peak_rss_bytes": rusage.ru_maxrss * 1024
+    }
+
+
+def read_engine_log(path):
+    calls = []
+    if os.path.exists(path):
+        with open(path) as f:
+            calls = [json.loads(line) for line in f]
+    return calls
+
+
+def upload_phases(calls, upload_start, upload_end):
+    transfer_calls = [c for c in calls if c["service"] == "imagetransfers"]
+    if not transfer_calls:
+        return {}
+
+    first_transfer = min(c["start"] for c in transfer_calls)
+    last_finalize = max(c["end"] for c in transfer_calls)
+    return {
+        "setup_seconds": first_transfer - upload_start,
+        "transfer_seconds": last_finalize - first_transfer,
+        "finish_seconds": upload_end - last_finalize
+    }
+
+
+def api_summary(calls):
+    summary = {}
+    for call in calls:
+        key = "%s.%s" % (call["service"], call["method"])
+        count, seconds = summary.get(key, (0, 0.0))
+        summary[key] = (count + 1, seconds + call["end"] - call["start"])
+
+    return dict((key, {"count": count, "seconds": seconds}) for key, (count, seconds) in summary.items())
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Generates a synthetic Xen OVA, runs vmextract.py and upload.py against local "
+                    "stand-ins of the oVirt engine and imageio proxy and reports the results as JSON."
+    )
+    parser.add_argument("-v", "--verbose", help="show debug messages", action="store_true")
+    parser.add_argument("--work-dir", help="directory for the generated files (default: a temporary directory)")
+    parser.add_argument("--output", help="write the JSON report to this file instead of stdout")
+
+    ova_args = parser.add_argument_group("OVA options")
+    ova_args.add_argument("--disks", type=int, default=2, help="number of disks (default: 2)")
+    ova_args.add_argument("--size", default="1G", help="virtual size of each disk (default: 1G)")
+    ova_args.add_argument("--allocated", type=float, default=0.25,
+                          help="fraction of disk blocks containing data (default: 0.25)")
+    ova_args.add_argument("--ovf-items", type=int, default=0, help="number of extra OVF items")
+
+    server_args = parser.add_argument_group("server options")
+    server_args.add_argument("--latency", type=float, default=0,
+                             help="seconds added to every imageio response")
+    server_args.add_argument("--bandwidth", type=float, default=0, help="imageio bandwidth cap in MiB/s")
+    server_args.add_argument("--engine-latency", type=float, default=0,
+                             help="seconds added to every engine API call")
+    server_args.add_argument("--store-images", action="store_true",
+                             help="store the uploaded images, needed to verify them with upload.py --verify")
+    server_args.add_argument("--failure-rate", type=float, default=0,
+                             help="fraction of imageio PUT requests that fail, to measure the cost of retries")
+    server_args.add_argument("--volume-alignment", type=float, default=0,
+                             help="round the volume size reported by imageio up to this many MiB, "
+                                  "like logical volumes on block storage")
+    server_args.add_argument("--host-url",
+                             help="base of the transfer URL of image transfers, e.g. an unreachable address "
+                                  "to test the fallback to the proxy (default: the imageio server)")
+
+    parser.add_argument("--extract-args", default="--no-extract --native-vhd",
+                        help="arguments passed to vmextract.py (default: '--no-extract --native-vhd')")
+    parser.add_argument("--upload-args", default="", help="arguments passed to upload.py")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(
+        logging.DEBUG if args.verbose else logging.INFO
+    )
+
+    work_dir = os.path.abspath(args.work_dir or tempfile.mkdtemp(prefix="xen-ova-bench-"))
+    if not os.path.isdir(work_dir):
+        os.makedirs(work_dir)
+
+    report = {
+        "parameters": {
+            "disks": args.disks,
+            "size": ovagen.parse_size(args.size),
+            "allocated": args.allocated,
+            "ovf_items": args.ovf_items,
+            "latency": args.latency,
+            "bandwidth_mib": args.bandwidth,
+            "engine_latency": args.engine_latency,
+            "failure_rate": args.failure_rate,
+            "volume_alignment_mib": args.volume_alignment,
+            "extract_args": args.extract_args,
+            "upload_args": args.upload_args
+        },
+        "phases": {}
+    }
+
+    ova_file = os.path.join(work_dir, "bench-vm.ova")
+    start = time.time()
+    report["ova"] = ovagen.generate_ova(ova_file, args.disks, ovagen.parse_size(args.size),
+                                        args.allocated, args.ovf_items)
+    report["phases"]["generate"] = {"seconds": time.time() - start}
+
+    report["phases"]["extract"] = run_phase(
+        "vmextract.py",
+        [sys.executable, os.path.join(REPO_DIR, "vmextract.py"), "--verbose"] +
+        shlex.split(args.extract_args) + [ova_file],
+        log_file=os.path.join(work_dir, "vmextract.log")
+    )
+
+    vm_file = os.path.join(work_dir, "vm.json")
+    with open(vm_file) as f:
+        vm = json.load(f)
+
+    conversion_seconds = [d["conversion"]["seconds"] for d in vm["disks"] if "conversion" in d]
+    if conversion_seconds:
+        report["phases"]["extract"]["conversion_seconds"] = conversion_seconds
+
+    cert_file, key_file = fake_imageio.create_certificate(work_dir)
+    image_dir = None
+    if args.store_images:
+        image_dir = os.path.join(work_dir, "images")
+        if not os.path.isdir(image_dir):
+            os.makedirs(image_dir)
+
+    imageio = fake_imageio.ImageioServer(("127.0.0.1", 0), cert_file, key_file,
+                                         args.latency, args.bandwidth * 1024 * 1024, image_dir,
+                                         failure_rate=args.failure_rate,
+                                         volume_alignment=int(args.volume_alignment * 1024 * 1024))
+    imageio.start()
+
+    engine_log = os.path.join(work_dir, "engine-calls.jsonl")
+    if os.path.exists(engine_log):
+        os.unlink(engine_log)
+
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([os.path.join(BENCHMARK_DIR, "fake_sdk"), REPO_DIR])
+    env["FAKE_IMAGEIO_URL"] = imageio.url
+    env["FAKE_ENGINE_LOG"] = engine_log
+    env["FAKE_ENGINE_LATENCY"] = str(args.engine_latency)
+    if args.host_url:
+        env["FAKE_IMAGEIO_HOST_URL"] = args.host_url
+
+    upload_start = time.time()
+    report["phases"]["upload"] = run_phase(
+        "upload.py",
+        [sys.executable, os.path.join(REPO_DIR, "upload.py"), "--verbose",
+         "--engine", "https://engine.invalid/ovirt-engine/api",
+         "--user", "admin@internal",
+         "--password", "password",
+         "--cluster", CLUSTER_ID,
+         "--domain", DOMAIN_ID] + shlex.split(args.upload_args) + [vm_file],
+        env=env,
+        log_file=os.path.join(work_dir, "upload.log")
+    )
+    upload_end = time.time()
+    imageio.shutdown()
+
+    calls = read_engine_log(engine_log)
+    report["phases"]["upload"].update(upload_phases(calls, upload_start, upload_end))
+    report["engine_calls"] = api_summary(calls)
+
+    put_bytes = sum(s["put_bytes"] for s in imageio.stats.values())
+    zero_bytes = sum(s["zero_bytes"] for s in imageio.stats.values())
+    virtual_bytes = sum(d["capacity"] for d in vm["disks"])
+    transfer_seconds = report["phases"]["upload"].get("transfer_seconds") or report["phases"]["upload"]["seconds"]
+    report["throughput"] = {
+        "put_bytes": put_bytes,
+        "put_requests": sum(s["put_requests"] for s in imageio.stats.values()),
+        "zero_bytes": zero_bytes,
+        "zero_requests": sum(s["zero_requests"] for s in imageio.stats.values()),
+        "failed_requests": sum(s["failed_requests"] for s in imageio.stats.values()),
+        "virtual_bytes": virtual_bytes,
+        "wire_bytes_per_second": put_bytes / transfer_seconds,
+        "virtual_bytes_per_second": virtual_bytes / transfer_seconds
+    }
+    report["total_seconds"] = sum(p["seconds"] for p in report["phases"].values())
+    report["work_dir"] = work_dir
+
+    output = json.dumps(report, indent=4, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+import hashlib
+
+# Block hash: every block is hashed separately and the digests of the blocks
+# are hashed again. Zero blocks, which are most of a sparse disk, cost only
+# one update of the outer hash. This is the construction imageio uses for its
+# checksum API.
+BLOCK_SIZE = 4 * 1024 * 1024
+ALGORITHM = "blake2b"
+DIGEST_SIZE = 32
+
+_ZEROS = memoryview(bytes(BLOCK_SIZE))
+
+
+class Hash(object):
+    def __init__(self, block_size=BLOCK_SIZE, algorithm=ALGORITHM, digest_size=DIGEST_SIZE):
+        if block_size > BLOCK_SIZE:
+            raise ValueError("Block size %d is larger than %d" % (block_size, BLOCK_SIZE))
+
+        self.block_size = block_size
+        self.algorithm = algorithm
+        self.digest_size = digest_size
+        self._outer = self._new()
+        self._block = None
+        self._block_fill = 0
+        self._zero_digest = None
+
+    def _new(self):
+        return hashlib.new(self.algorithm, digest_size=self.digest_size)
+
+    def _feed(self, data):
+        # Adds data to the current block, data must fit in it
+        if self._block is None:
+            self._block = self._new()
+        self._block.update(data)
+        self._block_fill += len(data)
+        if self._block_fill == self.block_size:
+            self._outer.update(self._block.digest())
+            self._block = None
+            self._block_fill = 0
+
+    def update(self, data):
+        data = memoryview(data).cast("B")
+        pos = 0
+        while pos < len(data):
+            count = min(self.block_size - self._block_fill, len(data) - pos)
+            self._feed(data[pos:pos + count])
+            pos += count
+
+    # Same as update() with `count` zero bytes, without hashing them
+    def zero(self, count):
+        if self._block_fill:
+            fill = min(self.block_size - self._block_fill, count)
+            self._feed(_ZEROS[:fill])
+            count -= fill
+
+        if count >= self.block_size:
+            if self._zero_digest is None:
+                block = self._new()
+                block.update(_ZEROS[:self.block_size])
+                self._zero_digest = block.digest()
+
+            for _ in range(count // self.block_size):
+                self._outer.update(self._zero_digest)
+            count %= self.block_size
+
+        if count:
+            self._feed(_ZEROS[:count])
+
+    def hexdigest(self):
+        outer = self._outer.copy()
+        if self._block is not None:
+            # The last block can be shorter
+            outer.update(self._block.digest())
+        return outer.hexdigest()
+
+    def to_dict(self):
+        return {
+            "algorithm": self.algorithm,
+            "block_size": self.block_size,
+            "checksum": self.hexdigest()
+        }
+
+
+def is_compatible(checksum):
+    # Checksums can be compared only if they use the same parameters
+    return checksum.get("algorithm") == ALGORITHM and checksum.get("block_size") == BLOCK_SIZE
+
@@ -0,0 +1,192 @@
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+
+import vhd
+
+# Fingerprints read evenly spaced samples of the source, including its first
+# and last bytes. The VHD footer at the end has the unique ID of the image.
+SAMPLE_COUNT = 64
+SAMPLE_SIZE = 64 * 1024
+READ_SIZE = 1024 * 1024
+
+QCOW2_MAGIC = b"QFI\xfb"
+
+# ioctl to clone a file on copy-on-write filesystems (btrfs, xfs)
+FICLONE = 0x40049409
+
+
+def fingerprint(path, offset=0, size=None, full_hash=False):
+    if size is None:
+        size = os.path.getsize(path) - offset
+
+    with vhd.VhdReader(path, offset, size) as reader:
+        unique_id = reader.unique_id.hex()
+        virtual_size = reader.virtual_size
+
+    h = hashlib.blake2b(digest_size=32)
+    with open(path, "rb") as f:
+        if full_hash or size <= SAMPLE_COUNT * SAMPLE_SIZE:
+            f.seek(offset)
+            remaining = size
+            while remaining:
+                data = f.read(min(READ_SIZE, remaining))
+                if not data:
+                    raise RuntimeError("Image %r is truncated" % path)
+                h.update(data)
+                remaining -= len(data)
+        else:
+            step = (size - SAMPLE_SIZE) // (SAMPLE_COUNT - 1)
+            for index in range(SAMPLE_COUNT):
+                f.seek(offset + index * step)
+                h.update(f.read(SAMPLE_SIZE))
+
+    return {
+        "size": size,
+        "unique_id": unique_id,
+        "virtual_size": virtual_size,
+        "hash": "full" if full_hash else "sampled",
+        "digest": h.hexdigest()
+    }
+
+
+def _clone(src, dst):
+    # Copy-on-write clone, the copy does not share later changes
+    with open(src, "rb") as s, open(dst, "wb") as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+
+
+def link_file(src, dst):
+    # Reflink when the filesystem supports it, then a hard link, then a copy
+    tmp = dst + ".tmp"
+    for method in (_clone, os.link, shutil.copyfile):
+        if os.path.lexists(tmp):
+            os.unlink(tmp)
+        try:
+            method(src, tmp)
+        except OSError as e:
+            logging.debug("Cannot %s %r to %r: %s", method.__name__, src, tmp, e)
+            continue
+
+        os.replace(tmp, dst)
+        return method.__name__
+
+    raise RuntimeError("Cannot copy %r to %r" % (src, dst))
+
+
+# Stores converted images in a directory, keyed by the fingerprint of the
+# source image and the conversion options that change the output. Entries
+# are evicted in least recently used order when the cache is larger than
+# `max_size`. Several processes can share one cache.
+class ConversionCache(object):
+    def __init__(self, directory, max_size, full_hash=False):
+        self.directory = directory
+        self.max_size = max_size
+        self.full_hash = full_hash
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def key(self, fingerprint, variant):
+        data = json.dumps({"source": fingerprint, "variant": variant}, sort_keys=True)
+        return hashlib.blake2b(data.encode("UTF-8"), digest_size=20).hexdigest()
+
+    def _image_path(self, key):
+        return os.path.join(self.directory, key + ".img")
+
+    def _entry_path(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    def _lock(self):
+        f = open(os.path.join(self.directory, ".lock"), "w")
+        fcntl.flock(f, fcntl.LOCK_EX)
+        return f
+
+    def _read_entry(self, key):
+        try:
+            with open(self._entry_path(key), "r") as f:
+                entry = json.load(f)
+            st = os.stat(self._image_path(key))
+            with open(self._image_path(key), "rb") as f:
+                magic = f.read(len(QCOW2_MAGIC))
+        except (OSError, ValueError):
+            return None
+
+        # The image must be the one that was stored. A hard link to it may
+        # have been changed outside of the cache.
+        if (entry.get("key") != key or st.st_size != entry.get("image_size") or
+                st.st_mtime_ns != entry.get("image_mtime_ns") or
+                (entry.get("format") == "qcow2" and magic != QCOW2_MAGIC)):
+            return None
+
+        return entry
+
+    def _remove(self, key):
+        for path in (self._entry_path(key), self._image_path(key)):
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+    # Links the cached image to `out_path` and returns the entry, or None
+    # if there is no valid entry for the key
+    def lookup(self, key, out_path):
+        with self._lock():
+            if not os.path.exists(self._entry_path(key)):
+                return None
+
+            entry = self._read_entry(key)
+            if entry is None:
+                logging.warn("Conversion cache entry %s is stale, removing it", key)
+                self._remove(key)
+                return None
+
+            method = link_file(self._image_path(key), out_path)
+            # The time of the entry file is the last use
+            os.utime(self._entry_path(key))
+
+        logging.debug("Cached image %s linked to %r using %s", key, out_path, method)
+        return entry
+
+    def store(self, key, image_path, values):
+        with self._lock():
+            link_file(image_path, self._image_path(key))
+            st = os.stat(self._image_path(key))
+            entry = dict(values, key=key, image_size=st.st_size, image_mtime_ns=st.st_mtime_ns,
+                         stored=time.time())
+
+            tmp_path = self._entry_path(key) + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(entry, f, indent=4)
+            os.replace(tmp_path, self._entry_path(key))
+
+            self._evict(keep=key)
+
+    def _evict(self, keep):
+        entries = []
+        total = 0
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+
+            key = name[:-len(".json")]
+            try:
+                used = os.stat(self._entry_path(key)).st_mtime
+                size = os.stat(self._image_path(key)).st_blocks * 512
+            except OSError:
+                continue
+            entries.append((used, key, size))
+            total += size
+
+        for used, key, size in sorted(entries):
+            if total <= self.max_size:
+                break
+            if key == keep:
+                continue
+
+            logging.info("Evicting conversion cache entry %s, %d bytes", key, size)
+            self._remove(key)
+            total -= size
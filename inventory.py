@@ -0,0 +1,235 @@
+import argparse
+import concurrent.futures as futures
+import csv
+import json
+import logging
+import os
+import sys
+import tarfile
+
+import vmextract
+
+
+CACHE_VERSION = 1
+
+CSV_FIELDS = ["ova", "name", "id", "cpu_count", "cores_per_socket", "memory_bytes", "disk_count",
+              "capacity_bytes", "vhd_bytes", "ova_bytes", "error"]
+
+TOTAL_FIELDS = ["cpu_count", "memory_bytes", "disk_count", "capacity_bytes", "vhd_bytes", "ova_bytes"]
+
+
+def find_ovas(paths):
+    ovas = []
+    for path in paths:
+        if os.path.isfile(path):
+            ovas.append(os.path.abspath(path))
+            continue
+
+        for directory, _, files in os.walk(path):
+            for name in files:
+                if name.lower().endswith(".ova"):
+                    ovas.append(os.path.abspath(os.path.join(directory, name)))
+
+    return sorted(set(ovas))
+
+
+def scan_ova(path):
+    # Only the tar headers and the OVF member are read. For an uncompressed
+    # archive, the disk images are skipped by seeking over them.
+    with tarfile.open(path) as tar_file:
+        index = vmextract.index_ova(tar_file)
+        ovf_members = [m for name, m in index.items() if name.lower().endswith(".ovf")]
+        if not ovf_members:
+            raise RuntimeError("OVA does not contain an OVF file")
+
+        f = tar_file.extractfile(ovf_members[0])
+        try:
+            vm = vmextract.OvfReader().read_xen_ovf(vmextract.parse_ovf(f))
+        finally:
+            f.close()
+
+    disks = []
+    for disk in vm.disks:
+        member = index.get(disk["file"])
+        disks.append({
+            "id": disk["id"],
+            "name": disk["name"],
+            "file": disk["file"],
+            "capacity_bytes": disk["capacity"],
+            "vhd_bytes": member.size if member is not None else None,
+            "bootable": disk["bootable"]
+        })
+
+    return {
+        "name": vm.name,
+        "id": vm.id,
+        "cpu_count": vm.cpu_count,
+        "cores_per_socket": vm.cores_pre_socket,
+        "memory_bytes": vm.memory_bytes,
+        "disk_count": len(disks),
+        "capacity_bytes": sum(d["capacity_bytes"] for d in disks),
+        "vhd_bytes": sum(d["vhd_bytes"] or 0 for d in disks),
+        "disks": disks
+    }
+
+
+def scan_entry(path):
+    # Runs in a worker process, errors are returned with the result
+    try:
+        return scan_ova(path)
+    except Exception as e:
+        return {"error": "%s: %s" % (type(e).__name__, e)}
+
+
+class InventoryCache(object):
+    # Results of scanned OVAs, keyed by path. An entry is used only if the
+    # size and modification time of the file did not change.
+    def __init__(self, path):
+        self.path = path
+        self._entries = {}
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path, "r") as f:
+                    data = json.load(f)
+                if data.get("version") == CACHE_VERSION:
+                    self._entries = data["entries"]
+            except (OSError, ValueError, KeyError) as e:
+                logging.warn("Cannot read inventory cache %r, ignoring it: %s", path, e)
+
+    def get(self, path, st):
+        entry = self._entries.get(path)
+        if entry is None or entry["size"] != st.st_size or entry["mtime_ns"] != st.st_mtime_ns:
+            return None
+        return entry["result"]
+
+    def put(self, path, st, result):
+        self._entries[path] = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "result": result}
+
+    def save(self):
+        if self.path is None:
+            return
+
+        # Entries of deleted files are dropped
+        entries = dict((path, entry) for path, entry in self._entries.items() if os.path.exists(path))
+        directory = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"version": CACHE_VERSION, "entries": entries}, f)
+        os.replace(tmp_path, self.path)
+
+
+def scan(paths, cache, jobs=None):
+    ovas = find_ovas(paths)
+    results = {}
+    stats = {}
+    pending = []
+    for path in ovas:
+        try:
+            st = os.stat(path)
+        except OSError as e:
+            results[path] = {"error": "%s: %s" % (type(e).__name__, e)}
+            continue
+
+        stats[path] = st
+        cached = cache.get(path, st)
+        if cached is not None:
+            results[path] = cached
+        else:
+            pending.append(path)
+
+    logging.info("Found %d OVA files, %d cached, %d to scan", len(ovas), len(ovas) - len(pending), len(pending))
+    if pending:
+        with futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+            for count, (path, result) in enumerate(zip(pending, executor.map(scan_entry, pending, chunksize=8)), 1):
+                results[path] = result
+                cache.put(path, stats[path], result)
+                if "error" in result:
+                    logging.warn("Cannot read %s: %s", path, result["error"])
+                if count % 100 == 0:
+                    logging.info("Scanned %d of %d OVA files", count, len(pending))
+
+    vms = []
+    for path in ovas:
+        vm = dict(results[path], ova=path)
+        if path in stats:
+            vm["ova_bytes"] = stats[path].st_size
+        vms.append(vm)
+
+    return vms
+
+
+def summarize(vms):
+    total = {"vms": 0, "failed": 0}
+    for field in TOTAL_FIELDS:
+        total[field] = 0
+
+    for vm in vms:
+        if "error" in vm:
+            total["failed"] += 1
+            continue
+
+        total["vms"] += 1
+        for field in TOTAL_FIELDS:
+            total[field] += vm.get(field) or 0
+
+    return total
+
+
+def write_csv(f, vms, total):
+    writer = csv.DictWriter(f, fieldnames=CSV_FIELDS, extrasaction="ignore")
+    writer.writeheader()
+    for vm in vms:
+        writer.writerow(vm)
+    writer.writerow(dict(total, ova="TOTAL", name="%d VMs, %d failed" % (total["vms"], total["failed"])))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Reads the CPU, memory and disk information of many Xen OVA files without extracting them."
+    )
+    parser.add_argument("paths", nargs="+", help="OVA files or directories searched for OVA files")
+    parser.add_argument("-v", "--verbose", help="show debug messages", action="store_true")
+    parser.add_argument("-j", "--jobs", type=int,
+                        help="number of processes reading OVA files (default: number of CPUs)")
+    parser.add_argument("--cache", default=os.path.expanduser("~/.cache/xen-ova-inventory.json"),
+                        help="file with the results of previous scans, unchanged OVA files are not read "
+                             "again (default: %(default)s)")
+    parser.add_argument("--no-cache", action="store_true", help="do not read or write the cache")
+    parser.add_argument("--json", help="write the JSON report to this file instead of stdout")
+    parser.add_argument("--csv", help="write a CSV report with one row per VM and a total row to this file")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(
+        logging.DEBUG if args.verbose else logging.INFO
+    )
+
+    cache = InventoryCache(None if args.no_cache else args.cache)
+    vms = scan(args.paths, cache, args.jobs)
+    cache.save()
+
+    total = summarize(vms)
+    logging.info("%d VMs, %d CPUs, %.1f GiB memory, %d disks, %.1f GiB capacity, %.1f GiB of VHD files",
+                 total["vms"], total["cpu_count"], total["memory_bytes"] / 1024.0 ** 3, total["disk_count"],
+                 total["capacity_bytes"] / 1024.0 ** 3, total["vhd_bytes"] / 1024.0 ** 3)
+    if total["failed"]:
+        logging.warn("%d OVA files could not be read", total["failed"])
+
+    if args.csv:
+        with open(args.csv, "w", newline="") as f:
+            write_csv(f, vms, total)
+
+    output = json.dumps({"vms": vms, "total": total}, indent=4)
+    if args.json:
+        with open(args.json, "w") as f:
+            f.write(output)
+    elif not args.csv:
+        print(output)
+
+    return 1 if total["failed"] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,263 @@
+import contextlib
+import json
+import os
+import re
+import resource
+import threading
+import time
+
+
+PROMETHEUS_PREFIX = "xen_ova_"
+
+_ID_PATTERN = re.compile(r"[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}")
+
+
+def peak_rss():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def service_name(path):
+    # IDs in service paths are replaced, so all VMs share the same names
+    return _ID_PATTERN.sub("*", path)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Metrics(object):
+    # Collects phase timers, engine API call statistics and disk throughput.
+    # Events are written as JSON lines when an events file is configured,
+    # the totals are written as a Prometheus textfile on close().
+    PROGRESS_INTERVAL = 1.0
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._events_file = None
+        self._prometheus_file = None
+        self.labels = {}
+        self.phases = {}
+        self.api_calls = {}
+        self.disks = {}
+        self.connections = {}
+
+    def configure(self, events_file=None, prometheus_file=None, **labels):
+        with self._lock:
+            if events_file is not None:
+                self._events_file = open(events_file, "a")
+            self._prometheus_file = prometheus_file
+            self.labels.update(labels)
+
+    def event(self, name, **values):
+        with self._lock:
+            self._write_event(name, values)
+
+    def _write_event(self, name, values):
+        if self._events_file is None:
+            return
+
+        event = {"time": time.time(), "event": name}
+        event.update(self.labels)
+        event.update(values)
+        self._events_file.write(json.dumps(event) + "\n")
+        self._events_file.flush()
+
+    @contextlib.contextmanager
+    def phase(self, name, **labels):
+        start = time.time()
+        error = None
+        try:
+            yield
+        except BaseException as e:
+            error = str(e) or type(e).__name__
+            raise
+        finally:
+            seconds = time.time() - start
+            with self._lock:
+                count, total = self.phases.get(name, (0, 0.0))
+                self.phases[name] = (count + 1, total + seconds)
+                values = dict(labels, phase=name, start=start, seconds=seconds)
+                if error is not None:
+                    values["error"] = error
+                self._write_event("phase", values)
+
+    def api_call(self, service, method, seconds, lock_seconds=0.0, failed=False):
+        key = (service_name(service), method)
+        with self._lock:
+            stats = self.api_calls.get(key)
+            if stats is None:
+                stats = self.api_calls[key] = {"count": 0, "errors": 0, "seconds": 0.0,
+                                               "max_seconds": 0.0, "lock_seconds": 0.0}
+            stats["count"] += 1
+            stats["errors"] += 1 if failed else 0
+            stats["seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+            stats["lock_seconds"] += lock_seconds
+
+    def disk_started(self, disk, total, **labels):
+        with self._lock:
+            now = time.time()
+            self.disks[disk] = {"total": total, "done": 0, "sent": 0, "start": now,
+                                "sample_time": now, "sample_done": 0, "updated": now, "throttled": 0.0,
+                                "retries": 0, "reconnects": 0, "labels": labels}
+
+    # Time the upload of a disk waited for the bandwidth limits
+    def disk_throttled(self, disk, seconds):
+        with self._lock:
+            stats = self.disks.get(disk)
+            if stats is not None:
+                stats["throttled"] += seconds
+
+    # A request of a disk that was sent again, on a new connection if the
+    # old one was closed
+    def disk_retried(self, disk, reconnected=False):
+        with self._lock:
+            stats = self.disks.get(disk)
+            if stats is not None:
+                stats["retries"] += 1
+                stats["reconnects"] += 1 if reconnected else 0
+
+    def connection_opened(self, server, resumed=False):
+        with self._lock:
+            stats = self.connections.get(server)
+            if stats is None:
+                stats = self.connections[server] = {"count": 0, "resumed": 0}
+            stats["count"] += 1
+            stats["resumed"] += 1 if resumed else 0
+
+    # Records progress of a disk. Throughput is reported at most once per
+    # PROGRESS_INTERVAL, as bytes per second since the previous report.
+    def disk_progress(self, disk, done, sent, skipped=False):
+        with self._lock:
+            stats = self.disks.get(disk)
+            if stats is None:
+                return
+
+            stats["done"] += done
+            stats["sent"] += sent
+            if skipped:
+                # Data uploaded before a resume does not count to throughput
+                stats["sample_done"] += done
+                return
+
+            now = time.time()
+            stats["updated"] = now
+            finished = stats["done"] >= stats["total"]
+            if now - stats["sample_time"] < self.PROGRESS_INTERVAL and not finished:
+                return
+
+            elapsed = max(now - stats["sample_time"], 1e-6)
+            values = dict(stats["labels"], disk=disk, done=stats["done"], sent=stats["sent"],
+                          total=stats["total"],
+                          bytes_per_second=(stats["done"] - stats["sample_done"]) / elapsed)
+            stats["sample_time"] = now
+            stats["sample_done"] = stats["done"]
+            self._write_event("progress", values)
+
+    # Bytes sent per second by a group of disks, from the start of the first
+    # to the last progress of any of them, or None if nothing was sent
+    def sent_throughput(self, disks):
+        with self._lock:
+            stats = [self.disks[disk] for disk in disks if disk in self.disks]
+            sent = sum(s["sent"] for s in stats)
+            if not sent:
+                return None
+            elapsed = max(s["updated"] for s in stats) - min(s["start"] for s in stats)
+            return sent / elapsed if elapsed > 0 else None
+
+    def summary(self):
+        with self._lock:
+            return {
+                "phases": dict((name, {"count": count, "seconds": seconds})
+                               for name, (count, seconds) in self.phases.items()),
+                "api_calls": dict(("%s.%s" % key, dict(stats)) for key, stats in self.api_calls.items()),
+                "disks": dict((disk, dict(
+                    stats["labels"],
+                    total=stats["total"],
+                    done=stats["done"],
+                    sent=stats["sent"],
+                    throttled_seconds=stats["throttled"],
+                    retries=stats["retries"],
+                    reconnects=stats["reconnects"],
+                    bytes_per_second=stats["done"] / max(time.time() - stats["start"], 1e-6)
+                )) for disk, stats in self.disks.items()),
+                "throttled_seconds": sum(stats["throttled"] for stats in self.disks.values()),
+                "retries": sum(stats["retries"] for stats in self.disks.values()),
+                "reconnects": sum(stats["reconnects"] for stats in self.disks.values()),
+                "connections": dict((server, dict(stats)) for server, stats in self.connections.items()),
+                "peak_rss_bytes": peak_rss()
+            }
+
+    def close(self):
+        summary = self.summary()
+        self.event("summary", **summary)
+        if self._prometheus_file is not None:
+            self._write_prometheus(summary)
+
+        with self._lock:
+            if self._events_file is not None:
+                self._events_file.close()
+                self._events_file = None
+
+    def _write_prometheus(self, summary):
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            name = PROMETHEUS_PREFIX + name
+            lines.append("# HELP %s %s" % (name, help_text))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for labels, value in samples:
+                labels = dict(self.labels, **labels)
+                label_str = ",".join('%s="%s"' % (k, _escape(v)) for k, v in sorted(labels.items()))
+                lines.append("%s{%s} %r" % (name, label_str, float(value)) if label_str else
+                             "%s %r" % (name, float(value)))
+
+        phases = sorted(summary["phases"].items())
+        metric("phase_seconds_total", "counter", "Time spent in each phase.",
+               [({"phase": name}, p["seconds"]) for name, p in phases])
+        metric("phase_count_total", "counter", "Number of times each phase ran.",
+               [({"phase": name}, p["count"]) for name, p in phases])
+
+        calls = sorted(self.api_calls.items())
+        metric("api_calls_total", "counter", "Engine API calls.",
+               [({"service": s, "method": m}, c["count"]) for (s, m), c in calls])
+        metric("api_call_errors_total", "counter", "Failed engine API calls.",
+               [({"service": s, "method": m}, c["errors"]) for (s, m), c in calls])
+        metric("api_call_seconds_total", "counter", "Time spent in engine API calls.",
+               [({"service": s, "method": m}, c["seconds"]) for (s, m), c in calls])
+        metric("api_lock_wait_seconds_total", "counter", "Time engine API calls waited for the connection.",
+               [({"service": s, "method": m}, c["lock_seconds"]) for (s, m), c in calls])
+
+        disks = [(dict(self.disks[disk]["labels"], disk=disk), d) for disk, d in sorted(summary["disks"].items())]
+        metric("disk_bytes_total", "counter", "Bytes of each disk that were uploaded or zeroed.",
+               [(labels, d["done"]) for labels, d in disks])
+        metric("disk_sent_bytes_total", "counter", "Bytes of each disk sent over the network.",
+               [(labels, d["sent"]) for labels, d in disks])
+        metric("disk_bytes_per_second", "gauge", "Average upload throughput of each disk.",
+               [(labels, d["bytes_per_second"]) for labels, d in disks])
+        metric("disk_throttled_seconds_total", "counter", "Time each disk waited for the bandwidth limits.",
+               [(labels, d["throttled_seconds"]) for labels, d in disks])
+        metric("disk_retries_total", "counter", "Requests of each disk that were sent again.",
+               [(labels, d["retries"]) for labels, d in disks])
+        metric("disk_reconnects_total", "counter", "Connections of each disk opened again after a failure.",
+               [(labels, d["reconnects"]) for labels, d in disks])
+
+        connections = sorted(summary["connections"].items())
+        metric("connections_total", "counter", "Connections opened to each image server.",
+               [({"server": server}, c["count"]) for server, c in connections])
+        metric("tls_resumed_connections_total", "counter",
+               "Connections to each image server that resumed a TLS session.",
+               [({"server": server}, c["resumed"]) for server, c in connections])
+
+        metric("peak_rss_bytes", "gauge", "Peak resident memory of the process.",
+               [({}, summary["peak_rss_bytes"])])
+
+        # Written atomically, the textfile collector may read it at any time
+        tmp_path = self._prometheus_file + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, self._prometheus_file)
+
+
+metrics = Metrics()
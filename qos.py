@@ -0,0 +1,292 @@
+import asyncio
+import heapq
+import itertools
+import json
+import logging
+import os
+import time
+
+MiB = 1024 * 1024
+
+
+def mib_per_second(value):
+    # Converts a limit given in MiB/s, 0 or None means unlimited
+    return int(value * MiB) if value else None
+
+
+class TokenBucket(object):
+    # Fills with `rate` bytes per second up to one second of data. A request
+    # larger than the bucket is allowed when the bucket is full, the bucket
+    # then goes into debt and the following requests wait longer.
+    def __init__(self, rate=None):
+        self.rate = None
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        self._refill()
+        self.rate = rate or None
+        if self.rate is not None:
+            self.tokens = min(self.tokens, self.rate)
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate is not None:
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Seconds until `count` bytes can be taken
+    def delay(self, count):
+        if self.rate is None:
+            return 0.0
+        self._refill()
+        needed = min(count, self.rate) - self.tokens
+        return max(needed / self.rate, 0.0)
+
+    def take(self, count):
+        if self.rate is not None:
+            self._refill()
+            self.tokens -= count
+
+
+class Flow(object):
+    # Data of one transfer, shared by all its connections
+    def __init__(self, scheduler, key, name, domain, weight):
+        self._scheduler = scheduler
+        self.key = key
+        self.name = name
+        self.domain = domain
+        self.base_weight = weight
+        self.weight = weight
+        self.bucket = TokenBucket()
+        self.finish_tag = 0.0
+        self.throttled = 0.0
+
+    async def acquire(self, count):
+        await self._scheduler.acquire(self, count)
+
+    def close(self):
+        self._scheduler.remove_flow(self)
+
+
+# Shares the upload bandwidth of all transfers in the process. There is a
+# global limit, a limit per storage domain and a limit per transfer. When
+# transfers compete for the global limit, they get bandwidth in proportion
+# to their weights (weighted fair queueing on the bytes sent).
+#
+# Limits are in bytes per second, None means unlimited. They can be
+# changed at runtime in a JSON control file, which is read again when it
+# changes, while requests wait for the limits, or when reload() is called,
+# e.g. from a SIGHUP handler.
+#
+# All methods except reload() must be called from the event loop.
+class BandwidthScheduler(object):
+    CONTROL_CHECK_INTERVAL = 2.0
+
+    def __init__(self):
+        self.max_bandwidth = None
+        self.max_domain_bandwidth = None
+        self.max_transfer_bandwidth = None
+        self.control_file = None
+        self.throttled = 0.0
+        self._domain_limits = {}
+        self._domain_default = None
+        self._transfer_default = None
+        self._weights = {}
+        self._global = TokenBucket()
+        self._domains = {}
+        self._flows = set()
+        self._waiters = []
+        self._order = itertools.count()
+        self._virtual_time = 0.0
+        self._timer = None
+        self._loop = None
+        self._control_mtime = None
+        self._control_checked = 0.0
+        self._reload_requested = False
+
+    def configure(self, max_bandwidth=None, max_domain_bandwidth=None, max_transfer_bandwidth=None,
+                  control_file=None):
+        self.max_bandwidth = max_bandwidth
+        self.max_domain_bandwidth = max_domain_bandwidth
+        self.max_transfer_bandwidth = max_transfer_bandwidth
+        self.control_file = control_file
+        self._control_mtime = self._control_file_mtime()
+        self._control_checked = time.monotonic()
+        self._apply()
+
+    def reload(self):
+        # Safe to call from a signal handler or another thread. The file is
+        # read in the event loop, so waiting requests get the new limits
+        # without waiting for the next request.
+        self._reload_requested = True
+        if self._loop is not None:
+            try:
+                self._loop.call_soon_threadsafe(self._poll)
+            except RuntimeError:
+                # The loop was closed, the uploads are finished
+                pass
+
+    @property
+    def limited(self):
+        return any(bucket.rate is not None for bucket in self._buckets())
+
+    def _buckets(self):
+        return [self._global] + list(self._domains.values()) + [f.bucket for f in self._flows]
+
+    def _control_file_mtime(self):
+        try:
+            return os.stat(self.control_file).st_mtime_ns
+        except (OSError, TypeError):
+            return None
+
+    def _read_control_file(self):
+        now = time.monotonic()
+        if not self._reload_requested and now - self._control_checked < self.CONTROL_CHECK_INTERVAL:
+            return
+        self._control_checked = now
+
+        mtime = self._control_file_mtime()
+        if mtime == self._control_mtime and not self._reload_requested:
+            return
+        self._reload_requested = False
+        self._control_mtime = mtime
+        self._apply()
+
+    def _load_control(self):
+        if self.control_file is None or not os.path.exists(self.control_file):
+            return {}
+
+        try:
+            with open(self.control_file, "r") as f:
+                control = json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warn("Cannot read bandwidth control file %r, keeping the current limits: %s",
+                         self.control_file, e)
+            return None
+
+        logging.info("Bandwidth limits read from %r: %s", self.control_file, control)
+        return control
+
+    def _apply(self):
+        control = self._load_control()
+        if control is None:
+            return
+
+        def limit(key, default):
+            # Limits in the control file are in MiB/s
+            if key in control:
+                return mib_per_second(control[key])
+            return default
+
+        self._global.set_rate(limit("max_bandwidth", self.max_bandwidth))
+        self._domain_limits = dict((domain, mib_per_second(value))
+                                   for domain, value in control.get("domains", {}).items())
+        self._domain_default = limit("max_domain_bandwidth", self.max_domain_bandwidth)
+        self._transfer_default = limit("max_transfer_bandwidth", self.max_transfer_bandwidth)
+        self._weights = control.get("weights", {})
+
+        for domain, bucket in self._domains.items():
+            bucket.set_rate(self._domain_limits.get(domain, self._domain_default))
+        for flow in self._flows:
+            self._configure_flow(flow)
+
+        self._dispatch()
+
+    def _configure_flow(self, flow):
+        flow.bucket.set_rate(self._transfer_default)
+        # Weights are given by disk ID or name
+        weight = self._weights.get(flow.key, self._weights.get(flow.name))
+        flow.weight = float(weight) if weight is not None else flow.base_weight
+
+    def add_flow(self, key, name, domain=None, weight=1.0):
+        self._loop = asyncio.get_event_loop()
+        if self.control_file is not None:
+            self._read_control_file()
+
+        flow = Flow(self, key, name, domain, weight)
+        flow.finish_tag = self._virtual_time
+        if domain not in self._domains:
+            self._domains[domain] = TokenBucket(self._domain_limits.get(domain, self._domain_default))
+        self._configure_flow(flow)
+        self._flows.add(flow)
+        return flow
+
+    def remove_flow(self, flow):
+        self._flows.discard(flow)
+        self.throttled += flow.throttled
+
+    async def acquire(self, flow, count):
+        if self.control_file is not None:
+            self._read_control_file()
+
+        if not self.limited:
+            return
+
+        # Every request gets a virtual finish time. Requests of flows with a
+        # larger weight advance their finish time more slowly and are served
+        # more often.
+        tag = max(self._virtual_time, flow.finish_tag) + count / max(flow.weight, 1e-3)
+        flow.finish_tag = tag
+        future = asyncio.get_event_loop().create_future()
+        heapq.heappush(self._waiters, (tag, next(self._order), flow, count, future))
+
+        start = time.monotonic()
+        self._dispatch()
+        try:
+            await future
+        finally:
+            if not future.done():
+                # Cancelled while waiting, the request is skipped
+                future.cancel()
+        flow.throttled += time.monotonic() - start
+
+    def _dispatch(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+        # Requests are served in the order of their finish times. A request
+        # limited by its own transfer or domain does not hold back the
+        # others, but the global limit is shared in order.
+        delay = None
+        remaining = []
+        while self._waiters:
+            entry = heapq.heappop(self._waiters)
+            tag, _, flow, count, future = entry
+            if future.done():
+                continue
+
+            own_delay = max(flow.bucket.delay(count), self._domains[flow.domain].delay(count))
+            if own_delay > 0:
+                remaining.append(entry)
+                delay = own_delay if delay is None else min(delay, own_delay)
+                continue
+
+            global_delay = self._global.delay(count)
+            if global_delay > 0:
+                remaining.append(entry)
+                delay = global_delay if delay is None else min(delay, global_delay)
+                break
+
+            flow.bucket.take(count)
+            self._domains[flow.domain].take(count)
+            self._global.take(count)
+            self._virtual_time = tag
+            future.set_result(None)
+
+        for entry in remaining:
+            heapq.heappush(self._waiters, entry)
+
+        if delay is not None:
+            if self.control_file is not None:
+                # Waiting requests must see changes of the control file
+                delay = min(delay, self.CONTROL_CHECK_INTERVAL)
+            self._timer = asyncio.get_event_loop().call_later(delay, self._poll)
+
+    def _poll(self):
+        self._timer = None
+        if self.control_file is not None:
+            self._read_control_file()
+        self._dispatch()
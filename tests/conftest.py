@@ -0,0 +1,12 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+try:
+    import ovirtsdk4  # noqa: F401
+except ImportError:
+    # upload.py needs the SDK only to talk to the engine, the stand-in used
+    # by the benchmarks is enough for the unit tests
+    sys.path.append(os.path.join(ROOT, "benchmark", "fake_sdk"))
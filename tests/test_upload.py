@@ -0,0 +1,154 @@
+import json
+import os
+
+import upload
+
+MiB = 1024 * 1024
+
+
+def sizer(size=8 * MiB, adaptive=True):
+    return upload.ChunkSizer("disk", size, 4 * MiB, 32 * MiB, adaptive)
+
+
+def test_chunk_sizer_grows_on_fast_requests():
+    s = sizer()
+    s.record(8 * MiB, 8 * MiB, 0.1)
+    assert s.size == 16 * MiB
+    s.record(16 * MiB, 16 * MiB, 0.1)
+    assert s.size == 32 * MiB
+    s.record(32 * MiB, 32 * MiB, 0.1)
+    assert s.size == 32 * MiB
+
+
+def test_chunk_sizer_shrinks_on_slow_requests():
+    s = sizer()
+    s.record(8 * MiB, 8 * MiB, 10.0)
+    assert s.size == 4 * MiB
+    s.record(4 * MiB, 4 * MiB, 10.0)
+    assert s.size == 4 * MiB
+
+
+def test_chunk_sizer_keeps_size_in_between():
+    s = sizer()
+    s.record(8 * MiB, 8 * MiB, 4.0)
+    assert s.size == 8 * MiB
+
+
+def test_chunk_sizer_nearly_full_chunk():
+    # A chunk at the end of an extent counts when it is long enough, the
+    # time of a full chunk is estimated from its throughput
+    s = sizer()
+    s.record(8 * MiB, 5 * MiB, 0.1)
+    assert s.size == 16 * MiB
+
+
+def test_chunk_sizer_ignores_short_chunks():
+    s = sizer(16 * MiB)
+    s.record(16 * MiB, 1 * MiB, 10.0)
+    assert s.size == 16 * MiB
+
+
+def test_chunk_sizer_ignores_chunks_of_old_size():
+    s = sizer()
+    s.record(8 * MiB, 8 * MiB, 0.1)
+    assert s.size == 16 * MiB
+    # Sent before the change, a slow chunk of the old size does not
+    # shrink the new size
+    s.record(8 * MiB, 8 * MiB, 10.0)
+    assert s.size == 16 * MiB
+
+
+def test_chunk_sizer_fixed():
+    s = sizer(adaptive=False)
+    s.record(8 * MiB, 8 * MiB, 0.1)
+    s.record(8 * MiB, 8 * MiB, 10.0)
+    assert s.size == 8 * MiB
+
+
+def test_chunk_sizer_history():
+    s = sizer()
+    s.record(8 * MiB, 8 * MiB, 0.5)
+    s.record(8 * MiB, 2 * MiB, 0.5)
+    s.record(16 * MiB, 16 * MiB, 2.0)
+    assert s.history == {8 * MiB: (10 * MiB, 1.0), 16 * MiB: (16 * MiB, 2.0)}
+
+
+SOURCE = {"path": "/images/disk.raw", "offset": 0, "size": 100, "mtime": 1, "inode": 2}
+EXTENTS = [(0, 40, False), (40, 20, True), (60, 40, False)]
+
+
+def journal(tmp_path, vm_id="vm", resume=False):
+    return upload.UploadJournal(str(tmp_path / upload.JOURNAL_FILE), vm_id, resume)
+
+
+def test_journal_nothing_uploaded(tmp_path):
+    assert journal(tmp_path).missing_extents("disk", SOURCE, EXTENTS) == EXTENTS
+
+
+def test_journal_missing_extents(tmp_path):
+    j = journal(tmp_path)
+    j.add("disk", SOURCE, 0, 10)
+    j.add("disk", SOURCE, 30, 20)
+    j.add("disk", SOURCE, 90, 10)
+    assert j.missing_extents("disk", SOURCE, EXTENTS) == [
+        (10, 20, False),
+        (50, 10, True),
+        (60, 30, False),
+    ]
+
+
+def test_journal_merges_ranges(tmp_path):
+    j = journal(tmp_path)
+    j.add("disk", SOURCE, 40, 20)
+    j.add("disk", SOURCE, 0, 40)
+    j.add("disk", SOURCE, 50, 30)
+    j.save()
+    with open(j.path) as f:
+        assert json.load(f)["disks"]["disk"]["ranges"] == [[0, 80]]
+    assert j.missing_extents("disk", SOURCE, EXTENTS) == [(80, 20, False)]
+
+
+def test_journal_resume(tmp_path):
+    j = journal(tmp_path)
+    j.add("disk", SOURCE, 0, 60)
+    j.set_finished("other", SOURCE)
+
+    resumed = journal(tmp_path, resume=True)
+    assert resumed.missing_extents("disk", SOURCE, EXTENTS) == [(60, 40, False)]
+    assert resumed.is_finished("other")
+    assert not resumed.is_finished("disk")
+
+
+def test_journal_not_resumed(tmp_path):
+    j = journal(tmp_path)
+    j.add("disk", SOURCE, 0, 100)
+    j.save()
+
+    assert journal(tmp_path).missing_extents("disk", SOURCE, EXTENTS) == EXTENTS
+    assert journal(tmp_path, vm_id="other", resume=True).missing_extents("disk", SOURCE, EXTENTS) == EXTENTS
+
+
+def test_journal_changed_image(tmp_path):
+    j = journal(tmp_path)
+    j.add("disk", SOURCE, 0, 100)
+    j.save()
+
+    resumed = journal(tmp_path, resume=True)
+    changed = dict(SOURCE, mtime=3)
+    assert resumed.missing_extents("disk", changed, EXTENTS) == EXTENTS
+
+
+def test_journal_save_throttled(tmp_path):
+    j = journal(tmp_path)
+    j.add("disk", SOURCE, 0, 10)
+    assert not os.path.exists(j.path)
+
+    j.save()
+    j.add("disk", SOURCE, 10, 10)
+    with open(j.path) as f:
+        assert json.load(f)["disks"]["disk"]["ranges"] == [[0, 10]]
+
+    j._saved -= upload.UploadJournal.SAVE_INTERVAL
+    j.add("disk", SOURCE, 20, 10)
+    with open(j.path) as f:
+        assert json.load(f)["disks"]["disk"]["ranges"] == [[0, 30]]
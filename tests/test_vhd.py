@@ -0,0 +1,186 @@
+import struct
+
+import pytest
+
+import vhd
+
+MiB = 1024 * 1024
+BLOCK_SIZE = 2 * MiB
+
+
+def footer(virtual_size, disk_type, data_offset):
+    data = bytearray(vhd.FOOTER_SIZE)
+    data[0:8] = b"conectix"
+    struct.pack_into(">Q", data, 16, data_offset)
+    struct.pack_into(">Q", data, 40, virtual_size)
+    struct.pack_into(">Q", data, 48, virtual_size)
+    struct.pack_into(">I", data, 60, disk_type)
+    data[68:84] = b"0123456789abcdef"
+    struct.pack_into(">I", data, 64, vhd.vhd_checksum(data, 64))
+    return bytes(data)
+
+
+def fixed_image(disk):
+    return bytes(disk) + footer(len(disk), vhd.DiskType.FIXED, 0xFFFFFFFFFFFFFFFF)
+
+
+# Builds a dynamic image. blocks maps a block index to (bitmap, data), the
+# other blocks are not allocated.
+def dynamic_image(virtual_size, blocks):
+    entries = (virtual_size + BLOCK_SIZE - 1) // BLOCK_SIZE
+    table_offset = vhd.FOOTER_SIZE + vhd.DYNAMIC_HEADER_SIZE
+    table_size = (entries * 4 + vhd.SECTOR_SIZE - 1) // vhd.SECTOR_SIZE * vhd.SECTOR_SIZE
+
+    header = bytearray(vhd.DYNAMIC_HEADER_SIZE)
+    header[0:8] = b"cxsparse"
+    struct.pack_into(">Q", header, 8, 0xFFFFFFFFFFFFFFFF)
+    struct.pack_into(">Q", header, 16, table_offset)
+    struct.pack_into(">I", header, 28, entries)
+    struct.pack_into(">I", header, 32, BLOCK_SIZE)
+    struct.pack_into(">I", header, 36, vhd.vhd_checksum(header, 36))
+
+    bitmap_size = vhd.SECTOR_SIZE
+    bat = [vhd.UNALLOCATED] * entries
+    body = bytearray()
+    pos = table_offset + table_size
+    for block in sorted(blocks):
+        bitmap, data = blocks[block]
+        bat[block] = pos // vhd.SECTOR_SIZE
+        chunk = bitmap.ljust(bitmap_size, b"\0") + data.ljust(BLOCK_SIZE, b"\0")
+        body += chunk
+        pos += len(chunk)
+
+    table = struct.pack(">%dI" % entries, *bat).ljust(table_size, b"\xff")
+    tail = footer(virtual_size, vhd.DiskType.DYNAMIC, vhd.FOOTER_SIZE)
+    return tail + bytes(header) + table + bytes(body) + tail
+
+
+def write(tmp_path, data, name="disk.vhd"):
+    path = str(tmp_path / name)
+    with open(path, "wb") as f:
+        f.write(data)
+    return path
+
+
+def read_extents(reader):
+    return [(offset, length, bytes(buf)) for offset, length, buf in reader.extents()]
+
+
+def test_fixed(tmp_path):
+    disk = bytearray(6 * MiB)
+    disk[0:4096] = b"a" * 4096
+    disk[4 * MiB + 512:4 * MiB + 1024] = b"b" * 512
+    path = write(tmp_path, fixed_image(disk))
+
+    with vhd.VhdReader(path) as reader:
+        assert reader.disk_type == vhd.DiskType.FIXED
+        assert reader.virtual_size == 6 * MiB
+        assert read_extents(reader) == [
+            (0, 2 * MiB, bytes(disk[0:2 * MiB])),
+            (4 * MiB, 2 * MiB, bytes(disk[4 * MiB:6 * MiB])),
+        ]
+        assert reader.allocation_map() == [
+            (0, 2 * MiB, False),
+            (2 * MiB, 2 * MiB, True),
+            (4 * MiB, 2 * MiB, False),
+        ]
+
+
+def test_fixed_partial_chunk(tmp_path):
+    disk = bytearray(3 * MiB)
+    disk[-1] = 1
+    path = write(tmp_path, fixed_image(disk))
+
+    with vhd.VhdReader(path) as reader:
+        assert read_extents(reader) == [(2 * MiB, MiB, bytes(disk[2 * MiB:]))]
+        assert reader.allocation_map() == [(0, 2 * MiB, True), (2 * MiB, MiB, False)]
+
+
+def test_dynamic_unallocated_blocks(tmp_path):
+    full = b"\xff" * (BLOCK_SIZE // vhd.SECTOR_SIZE // 8)
+    first = b"x" * BLOCK_SIZE
+    third = b"y" * BLOCK_SIZE
+    path = write(tmp_path, dynamic_image(4 * BLOCK_SIZE, {0: (full, first), 2: (full, third)}))
+
+    with vhd.VhdReader(path) as reader:
+        assert reader.disk_type == vhd.DiskType.DYNAMIC
+        assert reader.virtual_size == 4 * BLOCK_SIZE
+        assert read_extents(reader) == [
+            (0, BLOCK_SIZE, first),
+            (2 * BLOCK_SIZE, BLOCK_SIZE, third),
+        ]
+        assert reader.allocation_map() == [
+            (0, BLOCK_SIZE, False),
+            (BLOCK_SIZE, BLOCK_SIZE, True),
+            (2 * BLOCK_SIZE, BLOCK_SIZE, False),
+            (3 * BLOCK_SIZE, BLOCK_SIZE, True),
+        ]
+
+
+def test_dynamic_adjacent_blocks_merged(tmp_path):
+    full = b"\xff" * (BLOCK_SIZE // vhd.SECTOR_SIZE // 8)
+    path = write(tmp_path, dynamic_image(2 * BLOCK_SIZE, {0: (full, b"a" * BLOCK_SIZE),
+                                                         1: (full, b"b" * BLOCK_SIZE)}))
+
+    with vhd.VhdReader(path) as reader:
+        assert [(offset, length) for offset, length, _ in read_extents(reader)] == [
+            (0, BLOCK_SIZE),
+            (BLOCK_SIZE, BLOCK_SIZE),
+        ]
+        assert reader.allocation_map() == [(0, 2 * BLOCK_SIZE, False)]
+
+
+def test_dynamic_partial_bitmap(tmp_path):
+    # Sectors 0-7 and 12 are allocated, sectors 8-11 and 13-15 are not.
+    # The rest of the block is not allocated.
+    bitmap = b"\xff\x08"
+    data = bytes(bytearray(range(256)) * 32)
+    path = write(tmp_path, dynamic_image(BLOCK_SIZE, {0: (bitmap, data)}))
+
+    with vhd.VhdReader(path) as reader:
+        assert read_extents(reader) == [
+            (0, 8 * 512, data[:8 * 512]),
+            (12 * 512, 512, data[12 * 512:13 * 512]),
+        ]
+        assert reader.allocation_map() == [
+            (0, 8 * 512, False),
+            (8 * 512, 4 * 512, True),
+            (12 * 512, 512, False),
+            (13 * 512, BLOCK_SIZE - 13 * 512, True),
+        ]
+
+
+def test_offset_in_ova(tmp_path):
+    bitmap = b"\x80"
+    data = b"z" * 512
+    image = dynamic_image(2 * BLOCK_SIZE, {1: (bitmap, data)})
+    header = b"h" * 1536
+    path = write(tmp_path, header + image + b"t" * 1024, name="vm.ova")
+
+    with vhd.VhdReader(path, offset=len(header), size=len(image)) as reader:
+        assert read_extents(reader) == [(BLOCK_SIZE, 512, data)]
+        assert reader.allocation_map() == [
+            (0, BLOCK_SIZE, True),
+            (BLOCK_SIZE, 512, False),
+            (BLOCK_SIZE + 512, BLOCK_SIZE - 512, True),
+        ]
+
+
+def test_footer_checksum_mismatch(tmp_path):
+    image = bytearray(fixed_image(bytearray(MiB)))
+    image[-vhd.FOOTER_SIZE + 48] ^= 1
+    path = write(tmp_path, bytes(image))
+
+    with pytest.raises(RuntimeError, match="checksum mismatch"):
+        vhd.VhdReader(path)
+
+
+def test_is_zero():
+    assert vhd.is_zero(b"")
+    assert vhd.is_zero(bytes(3 * MiB + 1))
+    assert vhd.is_zero(memoryview(bytearray(MiB + 7)))
+    data = bytearray(3 * MiB)
+    data[-1] = 1
+    assert not vhd.is_zero(bytes(data))
+    assert not vhd.is_zero(memoryview(data))
+    assert not vhd.is_zero(b"\0\1")
@@ -1,20 +1,113 @@
 
 import argparse
+import asyncio
+import asynchttp
+import blkhash
+import concurrent.futures as futures
+import functools
 import json
-import http.client
 import logging
+import metrics
 import ovirtsdk4 as sdk
 import os
+import qos
 import string
-import ssl
 import random
 import re
+import signal
+import subprocess
+import threading
 import time
 import six.moves.urllib.parse as url_parse
 import uuid
+import vhd
 
 
 NAME_PATTERN_FULL_STR = re.compile("[\w.-]*\Z")
+ID_PATTERN = re.compile(r"[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}")
+
+JOURNAL_FILE = "upload-journal.json"
+
+# The SDK connection is shared by all upload threads, but it is not thread safe.
+_sdk_lock = threading.Lock()
+
+
+class _SynchronizedService(object):
+    # Also records the count and latency of the calls
+    def __init__(self, service, path):
+        self._service = service
+        self._path = path
+
+    def service(self, id, *args, **kwargs):
+        return _SynchronizedService(self._service.service(id, *args, **kwargs), "%s/%s" % (self._path, id))
+
+    def __getattr__(self, name):
+        attr = getattr(self._service, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            start = time.time()
+            failed = True
+            with _sdk_lock:
+                locked = time.time()
+                try:
+                    result = attr(*args, **kwargs)
+                    failed = False
+                    return result
+                finally:
+                    metrics.metrics.api_call(self._path, name, time.time() - locked, locked - start, failed)
+        return call
+
+
+class SynchronizedConnection(object):
+    # Serializes the calls of services created by the connection, so it
+    # can be used by several threads.
+    def __init__(self, connection):
+        self._connection = connection
+
+    def service(self, path):
+        return _SynchronizedService(self._connection.service(path), path)
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+
+def synchronized(conn):
+    if isinstance(conn, SynchronizedConnection):
+        return conn
+    return SynchronizedConnection(conn)
+
+
+class LookupCache(object):
+    # Results of engine lookups that do not change during a run, like the
+    # cluster and storage domain IDs. Shared by all VMs uploaded by the
+    # process.
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, load):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and time.time() - entry[1] < self.ttl:
+                return entry[0]
+
+        value = load()
+        with self._lock:
+            self._entries[key] = (value, time.time())
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+lookup_cache = LookupCache()
+
+# Maximum number of terms joined with "or" in one search query
+SEARCH_BATCH_SIZE = 50
 
 
 def is_string_uuid(val):
@@ -57,7 +150,110 @@ def get_domain_id_by_name(domain_name, conn):
     return domains[0].id
 
 
-def add_vm_to_ovirt(vm_def, conn):
+def resolve_cluster(cluster, conn):
+    def lookup():
+        if is_string_uuid(cluster):
+            check_cluster_exists(cluster, conn)
+            return cluster
+
+        # Search returns only existing clusters, no need to check again
+        return get_cluster_id_by_name(cluster, conn)
+
+    return lookup_cache.get(("cluster", cluster), lookup)
+
+
+def resolve_domain(domain, conn):
+    def lookup():
+        if is_string_uuid(domain):
+            check_domain_exists(domain, conn)
+            return domain
+
+        return get_domain_id_by_name(domain, conn)
+
+    return lookup_cache.get(("storage_domain", domain), lookup)
+
+
+def is_block_domain(domain_id, conn):
+    def lookup():
+        storage = conn.service("storagedomains").service(domain_id).get().storage
+        return storage is not None and storage.type in (sdk.types.StorageType.ISCSI, sdk.types.StorageType.FCP)
+
+    return lookup_cache.get(("block_domain", domain_id), lookup)
+
+
+def search_disks(disks_service, field, values):
+    # Finds the disks having one of the values, using one query for
+    # up to SEARCH_BATCH_SIZE values
+    found = {}
+    values = list(values)
+    for start in range(0, len(values), SEARCH_BATCH_SIZE):
+        terms = ["%s=%s" % (field, value) for value in values[start:start + SEARCH_BATCH_SIZE]]
+        for disk in disks_service.list(query={"search": " or ".join(terms)}):
+            found[getattr(disk, field)] = disk
+
+    return found
+
+
+# Aliases generated by this process, so VMs uploaded in parallel do not
+# pick the same one before their disks are created
+_generated_aliases = set()
+_generated_aliases_lock = threading.Lock()
+
+
+def generate_disk_aliases(count, disks_service):
+    aliases = []
+    while len(aliases) < count:
+        # Twice as many candidates as needed, so one search is usually enough
+        candidates = set()
+        with _generated_aliases_lock:
+            while len(candidates) < 2 * (count - len(aliases)):
+                random_str = ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(6))
+                candidate = "xen-disk-" + random_str
+                if candidate not in _generated_aliases:
+                    candidates.add(candidate)
+
+        logging.debug("Checking if disk names exist: %s", ", ".join(sorted(candidates)))
+        used = search_disks(disks_service, "alias", sorted(candidates))
+
+        with _generated_aliases_lock:
+            for candidate in sorted(candidates - set(used)):
+                if len(aliases) == count:
+                    break
+                if candidate not in _generated_aliases:
+                    _generated_aliases.add(candidate)
+                    aliases.append(candidate)
+
+    return aliases
+
+
+def load_vm(vm_file):
+    with open(vm_file, "r") as f:
+        vm = json.load(f)
+
+    # Image paths in vm.json are relative to its directory
+    vm_dir = os.path.dirname(os.path.abspath(vm_file))
+    vm['directory'] = vm_dir
+    for disk in vm['disks']:
+        for key in ('qcow_file', 'raw_file', 'vhd_file'):
+            if key in disk:
+                disk[key] = os.path.join(vm_dir, disk[key])
+
+    return vm
+
+
+def vm_exists(vm_id, conn):
+    try:
+        conn.service("vms").service(vm_id).get()
+        return True
+    except sdk.NotFoundError:
+        return False
+
+
+def add_vm_to_ovirt(vm_def, conn, resume=False):
+    if resume and vm_exists(vm_def['id'], conn):
+        logging.info("VM %r already exists, skipping", vm_def['name'])
+        return
+
     # Check if name is valid
     if not NAME_PATTERN_FULL_STR.match(vm_def['name']):
         raise RuntimeError("Vm name can only contain alpha-numeric characters, '_', '-' or '.'. Vm name: %r" % vm_def['name'])
@@ -88,50 +284,303 @@ def add_vm_to_ovirt(vm_def, conn):
     logging.info("VM added")
 
 
-def wait_for_disk_unlocked(disk_service):
-    while True:
-        disk = disk_service.get()
-        if disk.status == sdk.types.DiskStatus.OK:
-            break
+class TransferEngine(object):
+    # Runs the image transfers of all disks and VMs on one event loop in a
+    # background thread. Blocking SDK calls run in a single thread and image
+    # reads in a small thread pool, so many transfers need only a few threads.
+    READ_THREADS = 4
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loop = None
+        self._sdk_executor = None
+        self._read_executor = None
+        self._pools = {}
+
+    def _start(self):
+        with self._lock:
+            if self._loop is None:
+                self._sdk_executor = futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="sdk")
+                self._read_executor = futures.ThreadPoolExecutor(max_workers=self.READ_THREADS,
+                                                                 thread_name_prefix="image-read")
+                loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=loop.run_forever, name="transfer-engine")
+                thread.daemon = True
+                thread.start()
+                self._loop = loop
+
+            return self._loop
+
+    # Runs the coroutine on the engine and waits for its result. Must not
+    # be called from the engine thread.
+    def run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._start()).result()
+
+    async def call(self, func, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(
+            self._sdk_executor, functools.partial(func, *args, **kwargs))
+
+    async def read(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._read_executor, func, *args)
+
+    # Connections to the image servers are kept open for the following
+    # requests and transfers. Must be called from the engine thread.
+    def connection_pool(self, url):
+        key = (url.hostname, url.port or 443)
+        if key not in self._pools:
+            self._pools[key] = asynchttp.ConnectionPool(*key)
+        return self._pools[key]
+
+
+transfer_engine = TransferEngine()
+
+
+def _set_result(future, value):
+    if not future.done():
+        future.set_result(value)
+
+
+# Objects linked from engine events
+EVENT_OBJECTS = ("disk", "vm", "storage_domain", "template", "cluster", "host")
+
+
+def event_object_ids(event):
+    ids = set()
+    for name in EVENT_OBJECTS:
+        obj = getattr(event, name, None)
+        if obj is not None and getattr(obj, "id", None):
+            ids.add(obj.id)
+
+    # Some events name their objects only in the description
+    ids.update(ID_PATTERN.findall(getattr(event, "description", None) or ""))
+    return ids
+
+
+class EventWatcher(object):
+    # Follows the engine event log in a background thread and wakes up the
+    # waiters of the objects named in new events, so a change of state is
+    # noticed without polling it often.
+    def __init__(self, conn, interval=2.0):
+        self.interval = interval
+        self._events_service = conn.service('events')
+        self._lock = threading.Lock()
+        self._waiters = []
+        self._last_id = None
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        try:
+            # Only events newer than the last one are interesting
+            events = self._events_service.list(max=1)
+        except Exception as e:
+            logging.warn("Engine events are not available, using polling only: %s", e)
+            return False
+
+        self._last_id = events[0].id if events else None
+        self._thread = threading.Thread(target=self._run, name="event-watcher")
+        self._thread.daemon = True
+        self._thread.start()
+        return True
 
-        if disk.status == sdk.types.DiskStatus.LOCKED:
-            logging.debug("Waiting for disk %r to be unlocked.", disk.alias)
-            time.sleep(5)
-            continue
+    def stop(self):
+        self._stop_event.set()
+
+    def _run(self):
+        while not self._stop_event.wait(self.interval):
+            try:
+                if self._last_id is None:
+                    events = self._events_service.list(max=1)
+                else:
+                    events = self._events_service.list(from_=self._last_id)
+            except Exception as e:
+                logging.warn("Failed to read engine events, using polling only: %s", e)
+                break
+
+            events = [e for e in events if e.id != self._last_id]
+            if not events:
+                continue
 
-        raise RuntimeError("Disk %r in illegal status: %s" % (disk.alias, disk.status))
+            logging.debug("Received %d engine events", len(events))
+            self._last_id = max(events, key=lambda e: int(e.id)).id
+            ids = set()
+            for event in events:
+                ids.update(event_object_ids(event))
+            self._wake(True, ids)
+
+        with self._lock:
+            self._thread = None
+        self._wake(False)
+
+    # Wakes the waiters of any of `ids`, or all waiters if `ids` is None
+    def _wake(self, value, ids=None):
+        with self._lock:
+            woken = [w for w in self._waiters if ids is None or w[2] is None or not ids.isdisjoint(w[2])]
+            self._waiters = [w for w in self._waiters if w not in woken]
+
+        for loop, waiter, _ in woken:
+            loop.call_soon_threadsafe(_set_result, waiter, value)
+
+    # Returns True if events about the objects with `ids` arrived before the
+    # timeout. Without `ids`, any event wakes the waiter.
+    async def wait(self, timeout, ids=None):
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        # Copied, the caller may change its set from another thread
+        entry = (loop, waiter, frozenset(ids) if ids is not None else None)
+        with self._lock:
+            running = self._thread is not None
+            if running:
+                self._waiters.append(entry)
+
+        if not running:
+            await asyncio.sleep(timeout)
+            return False
 
+        try:
+            return await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            with self._lock:
+                if entry in self._waiters:
+                    self._waiters.remove(entry)
+
+
+class StateWaiter(object):
+    # Polls the engine until a condition holds. The delay between polls
+    # starts short and doubles up to max_delay. Jitter spreads the polls of
+    # waiters running in parallel.
+    def __init__(self, initial_delay=0.5, max_delay=10.0, timeout=3600, jitter=0.2):
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.jitter = jitter
+        self.events = None
+
+    # `ids` are the IDs of the objects whose events should cause an earlier
+    # check
+    async def wait(self, check, description, abort_event=None, ids=None):
+        deadline = time.time() + self.timeout
+        delay = self.initial_delay
+        while True:
+            if abort_event is not None and abort_event.is_set():
+                raise RuntimeError("Stopped waiting for %s" % description)
 
-def add_disks_to_ovirt(vm, conn):
+            if await check():
+                return
+
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise RuntimeError("Timed out waiting for %s" % description)
+
+            sleep_time = min(delay * random.uniform(1 - self.jitter, 1 + self.jitter), remaining)
+            logging.debug("Waiting %.1f s for %s", sleep_time, description)
+            woken = False
+            if self.events is not None:
+                woken = await self.events.wait(sleep_time, ids)
+            else:
+                await asyncio.sleep(sleep_time)
+
+            if woken:
+                # Something changed on one of the objects, check soon again
+                delay = self.initial_delay
+            else:
+                delay = min(delay * 2, self.max_delay)
+
+
+state_waiter = StateWaiter()
+
+# Shared by the transfers of all VMs uploaded by the process
+bandwidth = qos.BandwidthScheduler()
+
+
+async def wait_for_disks_unlocked_async(disk_ids, conn):
     disks_service = conn.service('disks')
+    pending = set(disk_ids)
 
-    new_disks = []
-    for disk_def in vm['disks']:
-        if disks_service.list(query={"search": "id=%s" % disk_def["id"]}):
-            raise RuntimeError("Disk with id %r already exists. Disk name: %r" % (disk_def['id'], disk_def['name']))
+    # One search checks all the disks that are still locked
+    async def check():
+        disks = await transfer_engine.call(search_disks, disks_service, "id", sorted(pending))
+        for disk_id in sorted(pending):
+            disk = disks.get(disk_id)
+            if disk is None:
+                raise RuntimeError("Disk %s was not found" % disk_id)
 
-        if not NAME_PATTERN_FULL_STR.match(disk_def['name']):
-            logging.warn("Disk name is not compatible with oVirt: %r", disk_def['name'])
+            if disk.status == sdk.types.DiskStatus.OK:
+                pending.discard(disk_id)
+            elif disk.status != sdk.types.DiskStatus.LOCKED:
+                raise RuntimeError("Disk %r in illegal status: %s" % (disk.alias, disk.status))
+
+        return not pending
+
+    with metrics.metrics.phase("wait_disks_unlocked", disks=len(pending)):
+        await state_waiter.wait(check, "%d disks to be unlocked" % len(pending), ids=pending)
+
+
+def wait_for_disks_unlocked(disk_ids, conn):
+    transfer_engine.run(wait_for_disks_unlocked_async(disk_ids, conn))
 
-            # Generate random name and check if it is free
-            while True:
-                random_str = ''.join(random.choice(string.ascii_uppercase + string.digits) for _ in range(6))
-                new_name = "xen-disk-" + random_str
-                logging.debug("Checking if disk name %r exists", new_name)
-                if not disks_service.list(query={"search": "alias=%s" % new_name}):
-                    break
 
+def qcow_size(disk_def):
+    # In pipelined mode the image may still be converting, its size was
+    # measured before the conversion started
+    if 'measured_size' in disk_def:
+        return disk_def['measured_size']
+    return os.path.getsize(disk_def['qcow_file'])
+
+
+def add_disks_to_ovirt(vm, conn, resume=False):
+    disks_service = conn.service('disks')
+
+    existing_disks = search_disks(disks_service, "id", [d['id'] for d in vm['disks']])
+    if existing_disks and not resume:
+        disk_def = next(d for d in vm['disks'] if d['id'] in existing_disks)
+        raise RuntimeError("Disk with id %r already exists. Disk name: %r" % (disk_def['id'], disk_def['name']))
+
+    invalid_names = [d for d in vm['disks']
+                     if d['id'] not in existing_disks and not NAME_PATTERN_FULL_STR.match(d['name'])]
+    if invalid_names:
+        for disk_def, new_name in zip(invalid_names, generate_disk_aliases(len(invalid_names), disks_service)):
+            logging.warn("Disk name is not compatible with oVirt: %r", disk_def['name'])
             disk_def['name'] = new_name
             logging.warn("Using generated name: %r", disk_def['name'])
 
-        disk_def["qcow_size"] = os.path.getsize(disk_def['qcow_file'])
+    new_disks = []
+    for disk_def in vm['disks']:
+        if disk_def['id'] in existing_disks:
+            existing_disk = existing_disks[disk_def['id']]
+            logging.info("Disk %r already exists, skipping", existing_disk.alias)
+            disk_def['name'] = existing_disk.alias
+            if 'qcow_file' in disk_def:
+                disk_def["qcow_size"] = qcow_size(disk_def)
+            new_disks.append(existing_disk)
+            continue
+
+        if 'vhd_file' in disk_def or 'raw_file' in disk_def:
+            # Data is uploaded as raw, from a raw image or directly from
+            # the VHD image. Only the allocated data is written.
+            disk_format = sdk.types.DiskFormat.RAW
+            sparse = True
+            initial_size = None
+            if is_block_domain(vm['storage_domain'], conn):
+                # Raw disks cannot be sparse on block storage
+                sparse = False
+        else:
+            # A compressed image stays compressed on the storage, the disk
+            # starts with the size of the image
+            disk_def["qcow_size"] = qcow_size(disk_def)
+            disk_format = sdk.types.DiskFormat.COW
+            sparse = None
+            initial_size = disk_def['qcow_size']
 
         disk = sdk.types.Disk(
             id=disk_def['id'],
             alias=disk_def['name'],
-            format=sdk.types.DiskFormat.COW,
+            format=disk_format,
+            sparse=sparse,
             provisioned_size=disk_def['capacity'],
-            initial_size=disk_def['qcow_size'],
+            initial_size=initial_size,
             bootable=disk_def['bootable'],
             storage_domains=[
                 sdk.types.StorageDomain(
@@ -144,15 +593,51 @@ def add_disks_to_ovirt(vm, conn):
         new_disks.append(disks_service.add(disk))
         logging.info("Disk added")
 
-    for disk in new_disks:
-        disk_service = disks_service.service(disk.id)
-        wait_for_disk_unlocked(disk_service)
+    if resume and existing_disks:
+        finalize_stale_transfers(existing_disks, conn)
+
+    wait_for_disks_unlocked([disk.id for disk in new_disks], conn)
+
+
+# Phases of a transfer that keeps its disk locked until it is finalized
+ACTIVE_TRANSFER_PHASES = (
+    sdk.types.ImageTransferPhase.INITIALIZING,
+    sdk.types.ImageTransferPhase.TRANSFERRING,
+    sdk.types.ImageTransferPhase.RESUMING,
+    sdk.types.ImageTransferPhase.PAUSED_SYSTEM,
+    sdk.types.ImageTransferPhase.PAUSED_USER,
+    sdk.types.ImageTransferPhase.UNKNOWN,
+)
+
+
+def finalize_stale_transfers(disk_ids, conn):
+    # A transfer of an upload that was killed keeps running and keeps its
+    # disk locked. It is finalized, not cancelled, so the data recorded in
+    # the journal stays on the disk.
+    transfers_service = conn.service('imagetransfers')
+    for transfer in transfers_service.list():
+        if transfer.disk is None or transfer.disk.id not in disk_ids:
+            continue
+        if transfer.phase not in ACTIVE_TRANSFER_PHASES:
+            continue
+
+        logging.warn("Finalizing image transfer %s of disk %s left by an interrupted upload",
+                     transfer.id, transfer.disk.id)
+        transfers_service.service(transfer.id).finalize()
 
 
-def attach_disks_to_vm(vm_def, conn):
+def attach_disks_to_vm(vm_def, conn, resume=False):
     attachments_service = conn.service('vms/%s/diskattachments' % vm_def['id'])
 
+    attached_ids = set()
+    if resume:
+        attached_ids = set(a.id for a in attachments_service.list())
+
     for disk in vm_def['disks']:
+        if disk['id'] in attached_ids:
+            logging.info("Disk %r is already attached to VM", disk['name'])
+            continue
+
         logging.info("Attaching disk %r to VM", disk['name'])
         attachments_service.add(sdk.types.DiskAttachment(
             active=True,
@@ -165,16 +650,326 @@ def attach_disks_to_vm(vm_def, conn):
         logging.debug("Disk attached")
 
 
-class DiskUploader(object):
-    CHUNK_SIZE = 32 * 1024 * 1024
+def get_file_extents(path):
+    # Only raw images are mapped, their offsets are the disk offsets
+    try:
+        output = subprocess.check_output([
+            "qemu-img",
+            "map",
+            "--output=json",
+            "-f", "raw",
+            path
+        ])
+    except (OSError, subprocess.CalledProcessError) as e:
+        logging.warn("Cannot read allocation map of %r: %s", path, e)
+        return None
+
+    extents = []
+    for extent in json.loads(output.decode("UTF-8")):
+        zero = extent["zero"] or not extent["data"]
+        if extents and extents[-1][2] == zero and extents[-1][0] + extents[-1][1] == extent["start"]:
+            start, length, _ = extents.pop()
+            extents.append((start, length + extent["length"], zero))
+        else:
+            extents.append((extent["start"], extent["length"], zero))
+
+    return extents
+
+
+class QcowImage(object):
+    uses_buffers = True
+
+    def __init__(self, path, image_format="qcow2"):
+        self.path = path
+        self.format = image_format
+        self.size = os.path.getsize(path)
+        self._fd = os.open(path, os.O_RDONLY)
+
+    def get_extents(self):
+        # A qcow2 file is uploaded as it is. Its map describes the guest
+        # disk, not the file, and zero regions of the disk are not stored
+        # in the file, so the whole file is sent.
+        if self.format != "raw":
+            return None
+        return get_file_extents(self.path)
+
+    def read(self, offset, length, buf):
+        view = memoryview(buf)[:length]
+        pos = 0
+        while pos < length:
+            count = os.preadv(self._fd, [view[pos:]], offset + pos)
+            if count == 0:
+                raise RuntimeError("Unexpected end of file %r" % self.path)
+            pos += count
+
+        return [view]
+
+    def close(self):
+        os.close(self._fd)
+
+
+class VhdImage(object):
+    # Data is returned as views of the mapped image, no buffers are needed
+    uses_buffers = False
+
+    def __init__(self, path, offset, size):
+        self._reader = vhd.VhdReader(path, offset, size)
+        self.size = self._reader.virtual_size
+
+    def get_extents(self):
+        return self._reader.allocation_map()
+
+    def read(self, offset, length, buf=None):
+        return self._reader.read(offset, length, prefetch=True)
+
+    def close(self):
+        self._reader.close()
+
+
+def image_source(disk, size):
+    # Identifies the image of a disk in the upload journal, so data of
+    # another image of the same size is not taken as uploaded
+    if 'vhd_file' in disk:
+        path, offset = disk['vhd_file'], disk.get('vhd_offset', 0)
+    else:
+        path, offset = disk.get('raw_file') or disk['qcow_file'], 0
+
+    stat = os.stat(path)
+    return {"path": os.path.abspath(path), "offset": offset, "size": size,
+            "mtime": stat.st_mtime_ns, "inode": stat.st_ino}
+
+
+def open_image(disk):
+    if 'vhd_file' in disk:
+        return VhdImage(disk['vhd_file'], disk.get('vhd_offset', 0), disk.get('vhd_size'))
+
+    # A raw image is read the same way as a qcow2 image, as a plain file
+    if 'raw_file' in disk:
+        return QcowImage(disk['raw_file'], "raw")
+
+    return QcowImage(disk['qcow_file'])
+
+
+class UploadJournal(object):
+    # Records the byte ranges of each disk confirmed by the server, so an
+    # interrupted upload can be resumed. The ranges are kept only while the
+    # source image, as returned by image_source(), stays the same. The file is replaced atomically, at
+    # most every SAVE_INTERVAL seconds while ranges are added and on save().
+    SAVE_INTERVAL = 5.0
+
+    def __init__(self, path, vm_id, resume=False):
+        self.path = path
+        self._lock = threading.Lock()
+        self._saved = time.monotonic()
+        self._data = {"vm_id": vm_id, "disks": {}}
+
+        if resume and os.path.exists(path):
+            with open(path, "r") as f:
+                data = json.load(f)
+
+            if data.get("vm_id") == vm_id:
+                self._data = data
+            else:
+                logging.warn("Upload journal %r belongs to a different VM, ignoring it", path)
+
+    def _disk(self, disk_id, source):
+        disk = self._data["disks"].get(disk_id)
+        if disk is None or disk.get("source") != source:
+            if disk is not None and disk["ranges"]:
+                logging.warn("Disk %s: the image changed since the interrupted upload, uploading all "
+                             "of it again", disk_id)
+            disk = {"source": source, "ranges": [], "finished": False}
+            self._data["disks"][disk_id] = disk
+        return disk
+
+    def is_finished(self, disk_id):
+        disk = self._data["disks"].get(disk_id)
+        return disk is not None and disk["finished"]
+
+    def missing_extents(self, disk_id, source, extents):
+        with self._lock:
+            confirmed = list(self._disk(disk_id, source)["ranges"])
+
+        missing = []
+        for start, length, zero in extents:
+            pos = start
+            end = start + length
+            for range_start, range_end in confirmed:
+                if range_end <= pos or range_start >= end:
+                    continue
+                if range_start > pos:
+                    missing.append((pos, range_start - pos, zero))
+                pos = max(pos, range_end)
+            if pos < end:
+                missing.append((pos, end - pos, zero))
+
+        return missing
+
+    def add(self, disk_id, source, start, length):
+        with self._lock:
+            disk = self._disk(disk_id, source)
+            ranges = sorted(disk["ranges"] + [[start, start + length]])
+            merged = [ranges[0]]
+            for range_start, range_end in ranges[1:]:
+                if range_start <= merged[-1][1]:
+                    merged[-1][1] = max(merged[-1][1], range_end)
+                else:
+                    merged.append([range_start, range_end])
+            disk["ranges"] = merged
+            if time.monotonic() - self._saved >= self.SAVE_INTERVAL:
+                self._save()
+
+    def set_finished(self, disk_id, source):
+        with self._lock:
+            self._disk(disk_id, source)["finished"] = True
+            self._save()
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self._data, f)
+        os.replace(tmp_path, self.path)
+        self._saved = time.monotonic()
+
+
+class UploadOptions(object):
+    def __init__(self):
+        self.max_transfers = 1
+        self.connections = 1
+        self.sparse = True
+        self.resume = False
+        self.chunk_size = 32 * 1024 * 1024
+        self.adaptive_chunks = False
+        self.min_chunk_size = 4 * 1024 * 1024
+        self.max_chunk_size = 128 * 1024 * 1024
+        self.verify = False
+        # A failed request is sent again up to `retries` times
+        self.retries = 5
+        self.request_timeout = 300
+        # "host" uses the imageio daemon on the host when it can be reached,
+        # "proxy" always uses the engine proxy, "probe" uses the faster one
+        self.transfer_path = "host"
+
+
+class ChunkSizer(object):
+    # Chooses the size of the next chunk. In adaptive mode the size doubles
+    # while requests finish quickly, so the per-request overhead is small,
+    # and halves when requests are slow, so a failed request loses less work.
+    FAST_REQUEST = 1.0
+    SLOW_REQUEST = 8.0
+
+    def __init__(self, name, size, minimum, maximum, adaptive):
+        self.name = name
+        self.size = size
+        self.minimum = minimum
+        self.maximum = maximum
+        self.adaptive = adaptive
+        self.history = {}
+        self._lock = threading.Lock()
+
+    # `size` is the chunk size in effect when the chunk was created, the
+    # chunk is shorter at the end of an extent
+    def record(self, size, length, seconds):
+        with self._lock:
+            total_length, total_seconds = self.history.get(size, (0, 0.0))
+            self.history[size] = (total_length + length, total_seconds + seconds)
+
+            # Only chunks that are nearly full show the throughput of the
+            # size, in small chunks the request latency dominates. Chunks
+            # created before the last change are not used again.
+            if not self.adaptive or size != self.size or length < min(size // 2, self.minimum):
+                return
+
+            # Time a full chunk takes at the throughput of this one
+            bytes_per_second = length / max(seconds, 1e-6)
+            expected = size / bytes_per_second
+
+            new_size = self.size
+            if expected < self.FAST_REQUEST and self.size < self.maximum:
+                new_size = min(self.size * 2, self.maximum)
+            elif expected > self.SLOW_REQUEST and self.size > self.minimum:
+                new_size = max(self.size // 2, self.minimum)
+
+            if new_size != self.size:
+                logging.debug(
+                    "Disk %r: chunk size %d -> %d (full chunk takes %.2f s, %.2f MiB/s)",
+                    self.name, self.size, new_size, expected, bytes_per_second / (1024 * 1024)
+                )
+                self.size = new_size
+
+    def log_summary(self):
+        for size in sorted(self.history):
+            total_length, total_seconds = self.history[size]
+            logging.info(
+                "Disk %r: chunk size %d: sent %d bytes, %.2f MiB/s",
+                self.name, size, total_length, total_length / max(total_seconds, 1e-6) / (1024 * 1024)
+            )
+
+
+def check_response(response):
+    if response.status >= 400:
+        logging.error("HTTP response status: %s", response.status)
+        logging.error("HTTP response reason: %s", response.reason)
+        logging.error("HTTP response data: %r", response.body.decode("UTF-8", "replace"))
+        raise RuntimeError("Error uploading disk")
 
-    def __init__(self, disk, transfers_service):
+    return response.body
+
+
+class _BufferPool(object):
+    # Chunk buffers are allocated when first needed and reused. A buffer is
+    # replaced when the chunk size grows past it or shrinks to half of it,
+    # so buffers follow the chunk size instead of starting at the largest
+    # one. The pool also limits how far the read-ahead can get in front of
+    # the connections.
+    def __init__(self, count):
+        self._allocated = 0
+        self._count = count
+        self._free = asyncio.Queue()
+
+    async def get(self, size):
+        if self._free.empty() and self._allocated < self._count:
+            self._allocated += 1
+            return bytearray(size)
+
+        buf = await self._free.get()
+        if len(buf) < size or (size and len(buf) >= 2 * size):
+            # The old buffer is released before the new one is allocated
+            buf = None
+            buf = bytearray(size)
+        return buf
+
+    def put(self, buf):
+        self._free.put_nowait(buf)
+
+
+class DiskUploader(object):
+    # The transfer runs on the shared transfer engine, upload() blocks until
+    # it finishes. upload_async() can be awaited on the engine directly.
+    READ_AHEAD = 1
+    EXTEND_INTERVAL = 60
+    CONNECT_TIMEOUT = 10
+    PROBE_SIZE = 8 * 1024 * 1024
+
+    def __init__(self, disk, transfers_service, options=None, abort_event=None, journal=None, domain=None):
         self.disk = disk
         self.transfers_service = transfers_service
+        self.options = options if options is not None else UploadOptions()
+        self.abort_event = abort_event if abort_event is not None else threading.Event()
+        self.journal = journal
+        self.domain = domain
 
     def upload(self):
+        transfer_engine.run(self.upload_async())
+
+    async def upload_async(self):
         logging.debug("Creating image transfer for disk %r", self.disk['name'])
-        transfer = self.transfers_service.add(
+        transfer = await transfer_engine.call(
+            self.transfers_service.add,
             sdk.types.ImageTransfer(
                 disk=sdk.types.Disk(
                     id=self.disk['id']
@@ -185,88 +980,687 @@ class DiskUploader(object):
 
         transfer_service = self.transfers_service.service(transfer.id)
         try:
-            self._wait_for_transfer_ready(transfer_service)
-            self._transfer_disk(transfer, transfer_service)
+            with metrics.metrics.phase("transfer_ready", disk=self.disk['name']):
+                await self._wait_for_transfer_ready(transfer_service, transfer.id)
+            with metrics.metrics.phase("transfer_data", disk=self.disk['name']):
+                await self._transfer_disk(transfer, transfer_service)
         finally:
-            transfer_service.finalize()
-            logging.info("Transfer finished")
+            with metrics.metrics.phase("transfer_finalize", disk=self.disk['name']):
+                await transfer_engine.call(transfer_service.finalize)
+            logging.info("Transfer of disk %r finished", self.disk['name'])
 
-    def _wait_for_transfer_ready(self, transfer_service):
-        while True:
-            transfer = transfer_service.get()
+        if self.journal is not None:
+            self.journal.set_finished(self.disk['id'], self._source)
+
+    def _check_aborted(self):
+        if self.abort_event.is_set():
+            raise RuntimeError("Upload of disk %r aborted" % self.disk['name'])
+
+    async def _wait_for_transfer_ready(self, transfer_service, transfer_id):
+        async def check():
+            transfer = await transfer_engine.call(transfer_service.get)
             if transfer.phase == sdk.types.ImageTransferPhase.TRANSFERRING:
-                return
+                return True
 
             if transfer.phase in [
                 sdk.types.ImageTransferPhase.INITIALIZING,
                 sdk.types.ImageTransferPhase.RESUMING
             ]:
-                logging.debug("Waiting for image transfer to be ready...")
-                time.sleep(1)
-                continue
+                return False
 
             # TODO - cleanup on error
             raise RuntimeError("Image transfer in invalid phase: %s" % transfer.phase)
 
-    def _transfer_disk(self, transfer, transfer_service):
-        logging.debug("Creating proxy connection")
-        url = url_parse.urlparse(transfer.proxy_url)
-        proxy_connection = http.client.HTTPSConnection(
-            url.hostname,
-            url.port,
-            context=ssl._create_unverified_context()
+        await state_waiter.wait(check, "image transfer of disk %r to be ready" % self.disk['name'],
+                                self.abort_event, ids=[self.disk['id'], transfer_id])
+
+    async def _transfer_disk(self, transfer, transfer_service):
+        path, url, features = await self._select_url(transfer)
+
+        logging.info("Transferring disk %r through the %s...", self.disk['name'],
+                     "host" if path == "host" else "engine proxy")
+
+        image = await transfer_engine.read(open_image, self.disk)
+        try:
+            await self._transfer_image(image, url, transfer, transfer_service, features, path)
+        finally:
+            image.close()
+
+    async def _select_url(self, transfer):
+        # The transfer URL points to the imageio daemon on the host, which
+        # avoids the hop through the proxy on the engine. The proxy is used
+        # when the host cannot be reached.
+        candidates = []
+        if self.options.transfer_path != "proxy" and transfer.transfer_url:
+            candidates.append(("host", transfer.transfer_url))
+        if transfer.proxy_url:
+            candidates.append(("proxy", transfer.proxy_url))
+        if not candidates:
+            raise RuntimeError("Image transfer of disk %r has no URL" % self.disk['name'])
+
+        selected = None
+        for path, transfer_url in candidates:
+            url = url_parse.urlparse(transfer_url)
+            try:
+                features = await self._server_features(url, transfer)
+            except (OSError, EOFError, asyncio.TimeoutError) as e:
+                logging.warn("Disk %r: cannot reach the image server %s: %s", self.disk['name'],
+                             url.netloc, e or type(e).__name__)
+                continue
+
+            if features is None and path != candidates[-1][0]:
+                logging.warn("Disk %r: image server %s rejected the ticket", self.disk['name'], url.netloc)
+                continue
+
+            throughput = None
+            if self.options.transfer_path == "probe":
+                throughput = await self._probe_throughput(url, transfer)
+                logging.info("Disk %r: %s image server reads %s",
+                             self.disk['name'], path,
+                             "%.1f MiB/s" % (throughput / 1024 ** 2) if throughput else "failed")
+
+            if selected is None or (throughput or 0) > (selected[3] or 0):
+                selected = (path, url, features, throughput)
+            if self.options.transfer_path != "probe":
+                break
+
+        if selected is None:
+            raise RuntimeError("Disk %r: no image server can be reached" % self.disk['name'])
+
+        path, url, features, throughput = selected
+        metrics.metrics.event("transfer_url", disk=self.disk['name'], path=path, server=url.netloc,
+                              bytes_per_second=throughput)
+        return path, url, features
+
+    async def _probe_throughput(self, url, transfer):
+        # Reads the start of the new disk. Reading does not change the disk,
+        # so the probe is safe also when resuming an upload.
+        size = min(self.PROBE_SIZE, self.disk['capacity'])
+        proxy_connection = await self._connect(url, new=True)
+        try:
+            start = time.time()
+            response = await proxy_connection.request(
+                'GET',
+                url.path,
+                headers={
+                    'Authorization': transfer.signed_ticket,
+                    'Range': 'bytes=%d-%d' % (0, size - 1)
+                }
+            )
+            elapsed = time.time() - start
+        except (OSError, EOFError) as e:
+            logging.debug("Probe of %s failed: %s", url.netloc, e)
+            return None
+        finally:
+            self._release(url, proxy_connection)
+
+        if response.status not in (200, 206):
+            logging.debug("Probe of %s failed, status: %s", url.netloc, response.status)
+            return None
+
+        return len(response.body) / max(elapsed, 1e-6)
+
+    async def _transfer_image(self, image, url, transfer, transfer_service, features, path):
+        file_size = image.size
+        self._source = image_source(self.disk, file_size)
+        logging.debug("File size: %s", file_size)
+
+        extents = None
+        if self.options.sparse and "zero" in (features or []):
+            extents = await transfer_engine.read(image.get_extents)
+
+        if extents is None:
+            logging.debug("Using dense upload for disk %r", self.disk['name'])
+            extents = [(0, file_size, False)]
+
+        self._progress = _Progress(self.disk['id'], self.disk['name'], file_size, transfer_path=path)
+        self._flow = bandwidth.add_flow(self.disk['id'], self.disk['name'], self.domain,
+                                        self.disk.get('weight', 1.0))
+        # The data is hashed in the read-ahead task, in order, as it is sent
+        self._hash = blkhash.Hash() if self.options.verify else None
+        if self.journal is not None:
+            missing = self.journal.missing_extents(self.disk['id'], self._source, extents)
+            done = sum(length for _, length, _ in extents) - sum(length for _, length, _ in missing)
+            if done:
+                logging.info("Disk %r: %d bytes were already uploaded, skipping them", self.disk['name'], done)
+                self._progress.update(done, sent=0, log=False)
+                # Skipped data is not read, so it cannot be hashed
+                self._hash = None
+            extents = missing
+
+        # The read-ahead task fills buffers from the pool while the
+        # connections send the previous chunks. Connections take chunks
+        # from a shared queue, so a slow connection does not hold back the
+        # others.
+        connections = self.options.connections
+        chunk_size = self.options.chunk_size
+        if self.options.adaptive_chunks:
+            chunk_size = min(chunk_size, self.options.max_chunk_size)
+        pool = _BufferPool(connections + self.READ_AHEAD)
+        self._chunk_sizer = ChunkSizer(
+            self.disk['name'],
+            chunk_size,
+            self.options.min_chunk_size,
+            self.options.max_chunk_size,
+            self.options.adaptive_chunks
+        )
+        ready = asyncio.Queue()
+        # Zeroed ranges that no flush confirmed yet
+        self._unflushed = []
+
+        extender = asyncio.ensure_future(self._extend_ticket(transfer_service))
+        tasks = [asyncio.ensure_future(self._read_ahead(image, extents, ready, pool, connections))]
+        tasks += [
+            asyncio.ensure_future(self._send_chunks(index, url, transfer, file_size, ready, pool))
+            for index in range(connections)
+        ]
+        try:
+            await asyncio.gather(*tasks)
+            if self._unflushed:
+                channel = _Channel(self, url)
+                try:
+                    await self._flush(channel, url, transfer)
+                finally:
+                    channel.close()
+                self._confirm_flushed(self._unflushed)
+                self._unflushed = []
+        finally:
+            # On failure, the remaining tasks are stopped
+            for task in tasks + [extender]:
+                task.cancel()
+            await asyncio.gather(extender, *tasks, return_exceptions=True)
+            self._flow.close()
+            if self.journal is not None:
+                self.journal.save()
+            metrics.metrics.disk_throttled(self.disk['id'], self._flow.throttled)
+
+        if self._flow.throttled:
+            logging.info("Disk %r waited %.1f s for the bandwidth limits", self.disk['name'], self._flow.throttled)
+
+        logging.info(
+            "Disk %r: sent %d bytes, %.2f%% of virtual size %d",
+            self.disk['name'], self._progress.sent, 100.0 * self._progress.sent / self.disk['capacity'],
+            self.disk['capacity']
+        )
+        self._chunk_sizer.log_summary()
+
+        if self.options.verify:
+            with metrics.metrics.phase("verify", disk=self.disk['name']):
+                await self._verify(url, transfer, file_size)
+
+    async def _extend_ticket(self, transfer_service):
+        # Extends the transfer ticket periodically while the data is sent
+        while True:
+            await asyncio.sleep(self.EXTEND_INTERVAL)
+            try:
+                await transfer_engine.call(transfer_service.extend)
+            except Exception as e:
+                logging.warn("Failed to extend image transfer ticket: %s", e)
+
+    def _iter_chunks(self, extents):
+        for start, length, zero in extents:
+            if zero:
+                yield start, length, True, None
+                continue
+
+            # The chunk size is read for every chunk, it can change while
+            # the extent is being sent.
+            start_pos = start
+            while start_pos < start + length:
+                size = self._chunk_sizer.size
+                chunk_size = min(size, start + length - start_pos)
+                yield start_pos, chunk_size, False, size
+                start_pos += chunk_size
+
+    async def _read_ahead(self, image, extents, ready, pool, connections):
+        for start_pos, length, zero, size in self._iter_chunks(extents):
+            if zero:
+                if self._hash is not None:
+                    self._hash.zero(length)
+                ready.put_nowait((start_pos, length, True, None, None, None))
+                continue
+
+            # Images read without buffers take empty ones, the pool then
+            # only limits the read-ahead
+            buf = await pool.get(size if image.uses_buffers else 0)
+            try:
+                data = await transfer_engine.read(self._read_chunk, image, start_pos, length, buf)
+            except Exception:
+                pool.put(buf)
+                raise
+
+            ready.put_nowait((start_pos, length, False, data, buf, size))
+            data = buf = None
+
+        for _ in range(connections):
+            ready.put_nowait(None)
+
+    def _read_chunk(self, image, start_pos, length, buf):
+        data = image.read(start_pos, length, buf)
+        if self._hash is not None:
+            for view in data:
+                self._hash.update(view)
+        return data
+
+    async def _verify(self, url, transfer, file_size):
+        expected = self.disk.get('checksum')
+        if self._hash is not None:
+            sent = self._hash.to_dict()
+            if expected is not None and expected != sent:
+                raise RuntimeError("Disk %r: checksum of the sent data %s does not match the checksum "
+                                   "in vm.json %s, the image changed" % (
+                                       self.disk['name'], sent['checksum'], expected['checksum']))
+            expected = sent
+
+        if expected is None:
+            logging.warn("Disk %r: no checksum of the image is known, cannot verify the upload",
+                         self.disk['name'])
+            return
+
+        channel = _Channel(self, url)
+        try:
+            await self._flush(channel, url, transfer)
+
+            # The server checksum covers the whole volume, which can be
+            # larger than the image, e.g. a qcow2 image on a logical volume
+            actual = None
+            volume_size = await self._volume_size(channel, url, transfer)
+            if volume_size == file_size:
+                actual = await self._server_checksum(channel, url, transfer)
+            else:
+                logging.debug("Disk %r: volume size %s differs from the image size %d",
+                              self.disk['name'], volume_size, file_size)
+            if actual is None or not blkhash.is_compatible(actual):
+                # Without a usable checksum from the server, the data is read back
+                logging.info("Disk %r: server checksum cannot be used, reading the disk back",
+                             self.disk['name'])
+                actual = await self._download_checksum(channel, url, transfer, file_size)
+        finally:
+            channel.close()
+
+        if actual is None:
+            logging.warn("Disk %r: cannot read the uploaded disk, the upload was not verified",
+                         self.disk['name'])
+            return
+
+        if actual['checksum'] != expected['checksum']:
+            raise RuntimeError("Disk %r: checksum of the uploaded disk %s does not match %s" % (
+                self.disk['name'], actual['checksum'], expected['checksum']))
+
+        logging.info("Disk %r verified, checksum: %s", self.disk['name'], actual['checksum'])
+
+    # Returns the size of the volume from its extents, or None if the server
+    # cannot report extents
+    async def _volume_size(self, channel, url, transfer):
+        response = await channel.request(
+            'GET',
+            url.path + "/extents",
+            headers={'Authorization': transfer.signed_ticket}
         )
-        proxy_connection.connect()
+        if response.status != 200:
+            logging.debug("Extents request failed, status: %s", response.status)
+            return None
 
-        logging.info("Transferring disk...")
+        try:
+            extents = json.loads(response.body.decode("UTF-8"))
+            return max(e["start"] + e["length"] for e in extents) if extents else 0
+        except (ValueError, KeyError, TypeError):
+            return None
+
+    async def _server_checksum(self, channel, url, transfer):
+        response = await channel.request(
+            'GET',
+            url.path + "/checksum",
+            headers={'Authorization': transfer.signed_ticket}
+        )
+        if response.status != 200:
+            logging.debug("Checksum request failed, status: %s", response.status)
+            return None
+
+        try:
+            return json.loads(response.body.decode("UTF-8"))
+        except ValueError:
+            return None
+
+    async def _download_checksum(self, channel, url, transfer, file_size):
+        h = blkhash.Hash()
+        pos = 0
+        while pos < file_size:
+            length = min(2 * blkhash.BLOCK_SIZE, file_size - pos)
+            response = await channel.request(
+                'GET',
+                url.path,
+                headers={
+                    'Authorization': transfer.signed_ticket,
+                    'Range': "bytes={0}-{1}".format(pos, pos + length - 1)
+                }
+            )
+            if response.status not in (200, 206) or len(response.body) != length:
+                logging.debug("Read request failed, status: %s", response.status)
+                return None
+
+            await transfer_engine.read(h.update, response.body)
+            pos += length
+
+        return h.to_dict()
+
+    # A new connection shows whether the server can be reached, an idle one
+    # from the pool may have been closed by the server
+    async def _connect(self, url, new=False):
+        pool = transfer_engine.connection_pool(url)
+        if new:
+            proxy_connection = await pool.connect(self.CONNECT_TIMEOUT)
+        else:
+            proxy_connection = await pool.get(self.CONNECT_TIMEOUT)
+        if proxy_connection.requests == 0:
+            metrics.metrics.connection_opened(url.netloc, proxy_connection.session_reused)
+            logging.debug("Disk %r: connected to %s%s", self.disk['name'], url.netloc,
+                          ", TLS session resumed" if proxy_connection.session_reused else "")
+        return proxy_connection
+
+    def _release(self, url, proxy_connection):
+        # The connection is kept open for the next request if its last
+        # request completed
+        transfer_engine.connection_pool(url).put(proxy_connection)
+
+    # Returns the features of the image server, or None if the server does
+    # not accept the OPTIONS request. Raises if the server cannot be reached.
+    async def _server_features(self, url, transfer):
+        proxy_connection = await self._connect(url, new=True)
+        try:
+            response = await asyncio.wait_for(proxy_connection.request(
+                'OPTIONS',
+                url.path,
+                headers={'Authorization': transfer.signed_ticket}
+            ), self.CONNECT_TIMEOUT)
+            if response.status != 200:
+                logging.debug("OPTIONS request failed, status: %s", response.status)
+                return None
+
+            features = json.loads(response.body.decode("UTF-8")).get("features", [])
+        except ValueError:
+            return None
+        finally:
+            self._release(url, proxy_connection)
+
+        logging.debug("Image server %s features: %s", url.netloc, features)
+        return features
+
+    async def _send_chunks(self, index, url, transfer, file_size, ready, pool):
+        channel = _Channel(self, url)
 
         transfer_headers = {
             'Authorization': transfer.signed_ticket
         }
 
-        file_size = self.disk['qcow_size']
-        logging.debug("File size: %s", file_size)
-        with open(self.disk['qcow_file'], "rb") as file:
-            start_pos = 0
-            for data in iter(lambda: file.read(self.CHUNK_SIZE), b""):
-                # Refresh ticket
-                transfer_service.extend()
-
-                end_pos = start_pos + len(data) - 1
-                transfer_headers['Content-Range'] = "bytes {0}-{1}/{2}".format(start_pos, end_pos, file_size)
-                start_pos += len(data)
-
-                proxy_connection.request(
-                    'PUT',
-                    url.path,
-                    data,
-                    headers=transfer_headers
-                )
-                logging.info("Progress: {:.2%}".format((end_pos+1) / float(file_size)))
+        sent_bytes = 0
+        start_time = time.time()
+        try:
+            while True:
+                item = await ready.get()
+                if item is None:
+                    break
+
+                start_pos, length, zero, data, buf, size = item
+                try:
+                    self._check_aborted()
+
+                    if zero:
+                        # Zeroing does not flush, the range is recorded
+                        # in the journal after a flush
+                        await self._zero_range(channel, url, transfer, start_pos, length)
+                        self._unflushed.append((start_pos, length))
+                        self._progress.update(length, sent=0)
+                        continue
+
+                    await self._flow.acquire(length)
+
+                    end_pos = start_pos + length - 1
+                    transfer_headers['Content-Range'] = "bytes {0}-{1}/{2}".format(start_pos, end_pos, file_size)
+
+                    # A PUT request flushes, also the ranges zeroed
+                    # before it was sent
+                    flushed = self._unflushed
+                    self._unflushed = []
+                    request_start = time.time()
+                    response = await channel.request(
+                        'PUT',
+                        url.path,
+                        data,
+                        headers=transfer_headers
+                    )
+
+                    check_response(response)
+                    self._chunk_sizer.record(size, length, time.time() - request_start)
+                    self._confirm(start_pos, length)
+                    self._confirm_flushed(flushed)
+
+                    sent_bytes += length
+                    self._progress.update(length)
+                finally:
+                    # The pool may replace the buffer by a larger one, no
+                    # reference may keep the old one alive
+                    item = data = None
+                    if buf is not None:
+                        pool.put(buf)
+                        buf = None
+        finally:
+            channel.close()
+
+        elapsed = max(time.time() - start_time, 1e-6)
+        logging.info(
+            "Disk %r connection %d: sent %d bytes in %.1f s (%.2f MiB/s), %d retries, %d reconnects",
+            self.disk['name'], index, sent_bytes, elapsed, sent_bytes / elapsed / (1024 * 1024),
+            channel.retries, channel.reconnects
+        )
 
-                response = proxy_connection.getresponse()
-                if response.status >= 400:
-                    logging.error("HTTP response status: %s", response.status)
-                    logging.error("HTTP response reason: %s", response.reason)
-                    response_data = response.read(response.length)
-                    logging.error("HTTP response data: %r", response_data.decode("UTF-8"))
-                    raise RuntimeError("Error uploading disk")
+    def _confirm(self, start_pos, length):
+        if self.journal is not None:
+            self.journal.add(self.disk['id'], self._source, start_pos, length)
+
+    def _confirm_flushed(self, ranges):
+        for start_pos, length in ranges:
+            self._confirm(start_pos, length)
+
+    async def _flush(self, channel, url, transfer):
+        check_response(await channel.request(
+            'PATCH',
+            url.path,
+            json.dumps({"op": "flush"}).encode("UTF-8"),
+            headers={
+                'Authorization': transfer.signed_ticket,
+                'Content-Type': 'application/json'
+            }
+        ))
+
+    async def _zero_range(self, channel, url, transfer, start_pos, length):
+        logging.debug("Zeroing %d bytes at offset %d of disk %r", length, start_pos, self.disk['name'])
+        body = json.dumps({
+            "op": "zero",
+            "offset": start_pos,
+            "size": length,
+            "flush": False
+        }).encode("UTF-8")
+
+        response = await channel.request(
+            'PATCH',
+            url.path,
+            body,
+            headers={
+                'Authorization': transfer.signed_ticket,
+                'Content-Type': 'application/json'
+            }
+        )
+        check_response(response)
+
+
+class _Channel(object):
+    # A connection of a transfer to the image server. Requests that fail
+    # with a connection error, a timeout or a server error are sent again
+    # after a growing delay, on a new connection if the old one was closed,
+    # so a flaky link does not fail the whole transfer. Image server
+    # requests are idempotent, sending one again is safe.
+    RETRY_DELAY = 1.0
+    MAX_RETRY_DELAY = 30.0
+
+    def __init__(self, uploader, url):
+        self._uploader = uploader
+        self._url = url
+        self._connection = None
+        self.retries = 0
+        self.reconnects = 0
+
+    async def request(self, method, path, body=None, headers=None):
+        uploader = self._uploader
+        name = uploader.disk['name']
+        attempt = 0
+        while True:
+            try:
+                if self._connection is None:
+                    self._connection = await uploader._connect(self._url)
+
+                response = await asyncio.wait_for(self._connection.request(method, path, body, headers),
+                                                  uploader.options.request_timeout)
+                if response.status < 500:
+                    return response
+                error = "HTTP status %s %s" % (response.status, response.reason)
+            except (OSError, EOFError, asyncio.TimeoutError) as e:
+                error = "%s: %s" % (type(e).__name__, e) if str(e) else type(e).__name__
+
+            if attempt >= uploader.options.retries:
+                raise RuntimeError("Disk %r: %s request failed after %d retries: %s" % (
+                    name, method, attempt, error))
+
+            attempt += 1
+            reconnect = self._connection is None or self._connection.closed
+            if reconnect:
+                self._connection = None
+                self.reconnects += 1
+            self.retries += 1
+            metrics.metrics.disk_retried(uploader.disk['id'], reconnect)
+
+            # The delay is randomized, so the connections of a transfer do
+            # not retry at the same time
+            delay = min(self.RETRY_DELAY * 2 ** (attempt - 1), self.MAX_RETRY_DELAY) * random.uniform(0.5, 1.0)
+            logging.warn("Disk %r: %s request failed: %s, retry %d of %d in %.1f s",
+                         name, method, error, attempt, uploader.options.retries, delay)
+            await asyncio.sleep(delay)
+            uploader._check_aborted()
+
+    def close(self):
+        if self._connection is not None:
+            self._uploader._release(self._url, self._connection)
+            self._connection = None
+
+
+class _Progress(object):
+    # Disks are keyed by ID in the metrics, names of disks of different VMs
+    # may be the same
+    def __init__(self, disk_id, name, total, **labels):
+        self.disk_id = disk_id
+        self.name = name
+        self.total = total
+        self.done = 0
+        self.sent = 0
+        self._lock = threading.Lock()
+        metrics.metrics.disk_started(disk_id, total, name=name, **labels)
+
+    def update(self, count, sent=None, log=True):
+        sent = count if sent is None else sent
+        with self._lock:
+            self.done += count
+            self.sent += sent
+            done = self.done
+
+        metrics.metrics.disk_progress(self.disk_id, count, sent, skipped=not log)
+        if not log:
+            return
+
+        logging.info("Disk {!r} progress: {:.2%}".format(self.name, done / float(self.total)))
+
+
+async def _upload_all(uploaders, max_transfers, abort_event, ready=None):
+    # When one disk fails, transfers that did not start yet are cancelled
+    # and the running ones stop at the next chunk and finalize.
+    semaphore = asyncio.Semaphore(max_transfers)
+    failed_disks = []
+
+    async def upload(uploader):
+        name = uploader.disk['name']
+        if ready is not None and uploader.disk['id'] in ready:
+            # The image is still being converted, the transfer starts when
+            # it is complete
+            try:
+                await asyncio.wrap_future(ready[uploader.disk['id']])
+            except Exception as e:
+                logging.error("Disk %r cannot be uploaded, conversion failed: %s", name, e)
+                failed_disks.append(name)
+                abort_event.set()
+                return
+
+        async with semaphore:
+            if abort_event.is_set():
+                logging.warn("Upload of disk %r was cancelled", name)
+                failed_disks.append(name)
+                return
 
+            try:
+                await uploader.upload_async()
+            except Exception as e:
+                logging.error("Upload of disk %r failed: %s", name, e)
+                failed_disks.append(name)
+                abort_event.set()
 
-def upload_disks(vm, conn):
+    await asyncio.gather(*[upload(uploader) for uploader in uploaders])
+    return failed_disks
+
+
+# `ready` maps disk IDs to futures of conversions that must finish before
+# the disk is uploaded
+def upload_disks(vm, conn, options=None, journal=None, ready=None):
+    if options is None:
+        options = UploadOptions()
+
+    conn = synchronized(conn)
     image_transfers_service = conn.service('imagetransfers')
-    disks_service = conn.service('disks')
 
+    abort_event = threading.Event()
+    uploaders = []
     for disk in vm['disks']:
-        uploader = DiskUploader(disk, image_transfers_service)
-        uploader.upload()
+        if journal is not None and journal.is_finished(disk['id']):
+            logging.info("Disk %r was already uploaded, skipping", disk['name'])
+            continue
 
-    for disk in vm['disks']:
-        wait_for_disk_unlocked(disks_service.service(disk['id']))
+        uploaders.append(DiskUploader(disk, image_transfers_service, options, abort_event, journal,
+                                      vm['storage_domain']))
+
+    # All disks are transferred by the shared engine, together with the
+    # disks of other VMs uploaded at the same time
+    failed_disks = transfer_engine.run(_upload_all(uploaders, options.max_transfers, abort_event, ready))
+    if failed_disks:
+        raise RuntimeError("Failed to upload disks: %s" % ", ".join(repr(d) for d in failed_disks))
+
+    wait_for_disks_unlocked([disk['id'] for disk in vm['disks']], conn)
 
     logging.info("Finished uploading disks")
 
 
+def upload_vm(vm, conn, options=None, ready=None):
+    if options is None:
+        options = UploadOptions()
+
+    journal = UploadJournal(os.path.join(vm['directory'], JOURNAL_FILE), vm['id'], options.resume)
+
+    with metrics.metrics.phase("add_vm", vm=vm['name']):
+        add_vm_to_ovirt(vm, conn, options.resume)
+    with metrics.metrics.phase("add_disks", vm=vm['name']):
+        add_disks_to_ovirt(vm, conn, options.resume)
+    with metrics.metrics.phase("upload_disks", vm=vm['name']):
+        upload_disks(vm, conn, options, journal, ready)
+    with metrics.metrics.phase("attach_disks", vm=vm['name']):
+        attach_disks_to_vm(vm, conn, options.resume)
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Creates the VM in oVirt and uploads the disk images using HTTP."
@@ -275,6 +1669,54 @@ def main():
     parser.add_argument("-v", "--verbose", help="show debug messages", action="store_true")
     parser.add_argument("--name", help="name of the VM. Useful in case the original name is not supported in oVirt.")
 
+    parser.add_argument("--max-transfers", type=int, default=1,
+                        help="maximum number of disks uploaded concurrently (default: 1)")
+    parser.add_argument("--connections", type=int, default=1,
+                        help="number of parallel HTTPS connections used to upload one disk (default: 1)")
+    parser.add_argument("--dense", action="store_true",
+                        help="upload every byte of the images, do not skip zero regions")
+    parser.add_argument("--chunk-size", type=int, default=32,
+                        help="size of the uploaded chunks in MiB (default: 32)")
+    parser.add_argument("--adaptive-chunks", action="store_true",
+                        help="change the chunk size based on the measured request latency")
+    parser.add_argument("--min-chunk-size", type=int, default=4,
+                        help="minimum chunk size in MiB in adaptive mode (default: 4)")
+    parser.add_argument("--max-chunk-size", type=int, default=128,
+                        help="maximum chunk size in MiB in adaptive mode (default: 128)")
+    parser.add_argument("--poll-max-delay", type=float, default=10,
+                        help="maximum seconds between checks of the disk and transfer state (default: 10)")
+    parser.add_argument("--wait-timeout", type=float, default=3600,
+                        help="seconds to wait for a disk or transfer to change state (default: 3600)")
+    parser.add_argument("--engine-events", action="store_true",
+                        help="follow the engine events to notice state changes sooner")
+    parser.add_argument("--transfer-path", choices=["host", "proxy", "probe"], default="host",
+                        help="'host' sends the data directly to the host and falls back to the engine "
+                             "proxy if the host cannot be reached, 'proxy' always uses the proxy, 'probe' "
+                             "measures the read throughput of both and uses the faster (default: host)")
+    parser.add_argument("--max-bandwidth", type=float,
+                        help="upload bandwidth limit in MiB/s shared by all transfers")
+    parser.add_argument("--max-domain-bandwidth", type=float,
+                        help="upload bandwidth limit in MiB/s of each storage domain")
+    parser.add_argument("--max-transfer-bandwidth", type=float,
+                        help="upload bandwidth limit in MiB/s of each disk")
+    parser.add_argument("--bandwidth-file",
+                        help="JSON file with bandwidth limits and weights, read again when it changes or on SIGHUP")
+    parser.add_argument("--retries", type=int, default=5,
+                        help="number of times a failed request is sent again, with a growing delay, "
+                             "before the upload of the disk fails (default: 5)")
+    parser.add_argument("--request-timeout", type=float, default=300,
+                        help="seconds after which a request is considered failed (default: 300)")
+    parser.add_argument("--verify", action="store_true",
+                        help="hash the data while it is sent and compare it with the checksum of the "
+                             "uploaded disk reported by the server, or with the data read back")
+    parser.add_argument("--metrics-file",
+                        help="append phase timings, progress and a summary as JSON lines to this file")
+    parser.add_argument("--prometheus-file",
+                        help="write the metrics in Prometheus text format to this file when finished")
+    parser.add_argument("--resume", action="store_true",
+                        help="resume an interrupted upload. Existing VM and disks are reused "
+                             "and only data missing in the upload journal is sent.")
+
     required_args = parser.add_argument_group("required arguments")
     required_args.add_argument("--engine", help="URL of the oVirt engine API", required=True)
     required_args.add_argument("--user", help="oVirt user name", required=True)
@@ -288,10 +1730,7 @@ def main():
         logging.DEBUG if args.verbose else logging.INFO
     )
 
-    with open(args.vm, "r") as f:
-        vm = json.load(f)
-
-    os.chdir(os.path.dirname(args.vm))
+    vm = load_vm(args.vm)
 
     if args.name:
         vm['name'] = args.name
@@ -304,16 +1743,46 @@ def main():
     )
 
     connection.test(raise_exception=True)
+    connection = synchronized(connection)
+
+    state_waiter.max_delay = args.poll_max_delay
+    state_waiter.timeout = args.wait_timeout
+    if args.engine_events:
+        events = EventWatcher(connection)
+        if events.start():
+            state_waiter.events = events
+
+    vm['cluster'] = resolve_cluster(args.cluster, connection)
+    vm['storage_domain'] = resolve_domain(args.domain, connection)
+
+    options = UploadOptions()
+    options.max_transfers = args.max_transfers
+    options.connections = args.connections
+    options.sparse = not args.dense
+    options.resume = args.resume
+    options.chunk_size = args.chunk_size * 1024 * 1024
+    options.adaptive_chunks = args.adaptive_chunks
+    options.min_chunk_size = args.min_chunk_size * 1024 * 1024
+    options.max_chunk_size = args.max_chunk_size * 1024 * 1024
+    options.verify = args.verify
+    options.retries = args.retries
+    options.request_timeout = args.request_timeout
+    options.transfer_path = args.transfer_path
+    bandwidth.configure(
+        qos.mib_per_second(args.max_bandwidth),
+        qos.mib_per_second(args.max_domain_bandwidth),
+        qos.mib_per_second(args.max_transfer_bandwidth),
+        args.bandwidth_file
+    )
+    if args.bandwidth_file:
+        # Without a control file, SIGHUP keeps its default action
+        signal.signal(signal.SIGHUP, lambda signum, frame: bandwidth.reload())
 
-    vm['cluster'] = args.cluster if is_string_uuid(args.cluster) else get_cluster_id_by_name(args.cluster, connection)
-    vm['storage_domain'] = args.domain if is_string_uuid(args.domain) else get_domain_id_by_name(args.domain, connection)
-
-    check_cluster_exists(vm['cluster'], connection)
-    check_domain_exists(vm['storage_domain'], connection)
-    add_vm_to_ovirt(vm, connection)
-    add_disks_to_ovirt(vm, connection)
-    upload_disks(vm, connection)
-    attach_disks_to_vm(vm, connection)
+    metrics.metrics.configure(args.metrics_file, args.prometheus_file, script="upload")
+    try:
+        upload_vm(vm, connection, options)
+    finally:
+        metrics.metrics.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,269 @@
+import mmap
+import struct
+
+
+SECTOR_SIZE = 512
+FOOTER_SIZE = 512
+DYNAMIC_HEADER_SIZE = 1024
+
+UNALLOCATED = 0xFFFFFFFF
+
+ZERO_BLOCK_SIZE = 1024 * 1024
+
+_ZEROS = bytes(ZERO_BLOCK_SIZE)
+
+
+class DiskType(object):
+    FIXED = 2
+    DYNAMIC = 3
+    DIFFERENCING = 4
+
+
+def vhd_checksum(data, checksum_offset):
+    total = sum(data[:checksum_offset]) + sum(data[checksum_offset + 4:])
+    return ~total & 0xFFFFFFFF
+
+
+# Comparing bytes with bytes uses memcmp(), a memoryview would be compared
+# byte by byte, so other buffers are copied and compared a block at a time.
+def is_zero(data):
+    if isinstance(data, bytes) and len(data) <= ZERO_BLOCK_SIZE:
+        return data == _ZEROS[:len(data)]
+
+    view = memoryview(data)
+    for start in range(0, len(view), ZERO_BLOCK_SIZE):
+        if not is_zero(view[start:start + ZERO_BLOCK_SIZE].tobytes()):
+            return False
+    return True
+
+
+def add_run(runs, first, count, allocated):
+    if runs and runs[-1][2] == allocated:
+        last_first, last_count, _ = runs[-1]
+        runs[-1] = (last_first, last_count + count, allocated)
+    else:
+        runs.append((first, count, allocated))
+
+
+# Reads fixed and dynamic VHD images. The image can be stored inside a larger
+# file, like an OVA archive, starting at `offset` and having `size` bytes.
+class VhdReader(object):
+    def __init__(self, path, offset=0, size=None):
+        self._file = open(path, "rb")
+        try:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except Exception:
+            self._file.close()
+            raise
+
+        self._offset = offset
+        self._size = size if size is not None else len(self._mmap) - offset
+        if self._offset + self._size > len(self._mmap):
+            self.close()
+            raise RuntimeError("VHD image %r is truncated" % path)
+
+        try:
+            self._read_footer()
+            if self.disk_type == DiskType.DYNAMIC:
+                self._read_dynamic_header()
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        try:
+            self._mmap.close()
+        except BufferError:
+            # Buffers returned by read() are still in use, the mapping is
+            # released when they are garbage collected.
+            pass
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _read_footer(self):
+        footer = self._mmap[self._offset + self._size - FOOTER_SIZE:self._offset + self._size]
+        if footer[:8] != b"conectix":
+            raise RuntimeError("VHD footer not found")
+
+        if vhd_checksum(footer, 64) != struct.unpack_from(">I", footer, 64)[0]:
+            raise RuntimeError("VHD footer checksum mismatch")
+
+        (self._data_offset,) = struct.unpack_from(">Q", footer, 16)
+        (self.virtual_size,) = struct.unpack_from(">Q", footer, 48)
+        (self.disk_type,) = struct.unpack_from(">I", footer, 60)
+        self.unique_id = bytes(footer[68:84])
+
+        if self.disk_type == DiskType.FIXED:
+            if self.virtual_size > self._size - FOOTER_SIZE:
+                raise RuntimeError("Fixed VHD image is smaller than its virtual size")
+        elif self.disk_type == DiskType.DIFFERENCING:
+            raise RuntimeError("Differencing VHD images are not supported")
+        elif self.disk_type != DiskType.DYNAMIC:
+            raise RuntimeError("Unknown VHD disk type: %s" % self.disk_type)
+
+    def _read_dynamic_header(self):
+        start = self._offset + self._data_offset
+        header = self._mmap[start:start + DYNAMIC_HEADER_SIZE]
+        if header[:8] != b"cxsparse":
+            raise RuntimeError("VHD dynamic header not found")
+
+        if vhd_checksum(header, 36) != struct.unpack_from(">I", header, 36)[0]:
+            raise RuntimeError("VHD dynamic header checksum mismatch")
+
+        (table_offset,) = struct.unpack_from(">Q", header, 16)
+        (table_entries,) = struct.unpack_from(">I", header, 28)
+        (self.block_size,) = struct.unpack_from(">I", header, 32)
+
+        if self.block_size % SECTOR_SIZE:
+            raise RuntimeError("Invalid VHD block size: %s" % self.block_size)
+
+        if table_entries * self.block_size < self.virtual_size:
+            raise RuntimeError("VHD block table does not cover the whole disk")
+
+        start = self._offset + table_offset
+        self._bat = struct.unpack_from(">%dI" % table_entries, self._mmap, start)
+
+        # The sector bitmap is padded to a sector boundary
+        bitmap_bytes = self.block_size // SECTOR_SIZE // 8
+        self._bitmap_size = (bitmap_bytes + SECTOR_SIZE - 1) // SECTOR_SIZE * SECTOR_SIZE
+
+    # Returns a list of (first sector, sector count, allocated) of a block
+    def _block_runs(self, block):
+        sectors = min(self.block_size, self.virtual_size - block * self.block_size) // SECTOR_SIZE
+        if self._bat[block] == UNALLOCATED:
+            return [(0, sectors, False)]
+
+        start = self._offset + self._bat[block] * SECTOR_SIZE
+        bitmap = self._mmap[start:start + (sectors + 7) // 8]
+
+        if bitmap == b"\xff" * len(bitmap) and sectors % 8 == 0:
+            return [(0, sectors, True)]
+
+        runs = []
+        sector = 0
+        for byte in bitmap:
+            if byte in (0x00, 0xFF) and sector + 8 <= sectors:
+                add_run(runs, sector, 8, byte == 0xFF)
+                sector += 8
+                continue
+
+            for bit in range(8):
+                if sector >= sectors:
+                    break
+
+                add_run(runs, sector, 1, bool(byte & (0x80 >> bit)))
+                sector += 1
+
+        return runs
+
+    def _block_data_offset(self, block, sector):
+        return (self._offset + self._bat[block] * SECTOR_SIZE + self._bitmap_size +
+                sector * SECTOR_SIZE)
+
+    def _block_data(self, block, sector, count):
+        start = self._block_data_offset(block, sector)
+        return memoryview(self._mmap)[start:start + count * SECTOR_SIZE]
+
+    # Asks the kernel to start reading the pages, so the data is in memory
+    # when it is sent.
+    def _prefetch(self, start, length):
+        if not hasattr(mmap, "MADV_WILLNEED"):
+            return
+
+        aligned = start - start % mmap.PAGESIZE
+        self._mmap.madvise(mmap.MADV_WILLNEED, aligned, length + start - aligned)
+
+    # Yields (offset, length, buffer) for the allocated data of the disk
+    def extents(self):
+        if self.disk_type == DiskType.FIXED:
+            for offset, length, zero in self._fixed_extents():
+                if not zero:
+                    yield offset, length, self._fixed_data(offset, length)
+            return
+
+        for block in range(len(self._bat)):
+            block_start = block * self.block_size
+            if block_start >= self.virtual_size:
+                break
+
+            if self._bat[block] == UNALLOCATED:
+                continue
+
+            for sector, count, allocated in self._block_runs(block):
+                if allocated:
+                    yield (block_start + sector * SECTOR_SIZE,
+                           count * SECTOR_SIZE,
+                           self._block_data(block, sector, count))
+
+    # Returns a list of (offset, length, zero) covering the whole disk.
+    # Regions that are not allocated are zero.
+    def allocation_map(self):
+        extents = []
+        pos = 0
+        for offset, length, _ in self.extents():
+            if offset > pos:
+                extents.append((pos, offset - pos, True))
+            elif extents and not extents[-1][2]:
+                start, last_length, _ = extents.pop()
+                offset, length = start, last_length + length
+
+            extents.append((offset, length, False))
+            pos = offset + length
+
+        if pos < self.virtual_size:
+            extents.append((pos, self.virtual_size - pos, True))
+
+        return extents
+
+    def _fixed_data(self, offset, length):
+        return memoryview(self._mmap)[self._offset + offset:self._offset + offset + length]
+
+    def _fixed_extents(self, step=2 * 1024 * 1024):
+        # Fixed images have every block allocated, but blocks that were
+        # never written are all zeros. Comparing with zeros is cheap.
+        for offset in range(0, self.virtual_size, step):
+            length = min(step, self.virtual_size - offset)
+            start = self._offset + offset
+            yield offset, length, is_zero(self._mmap[start:start + length])
+
+    # Returns a list of buffers with the data of the range. Regions that
+    # are not allocated are returned as zeros.
+    def read(self, offset, length, prefetch=False):
+        if offset + length > self.virtual_size:
+            raise ValueError("Read beyond the end of the disk")
+
+        if self.disk_type == DiskType.FIXED:
+            if prefetch:
+                self._prefetch(self._offset + offset, length)
+            return [self._fixed_data(offset, length)]
+
+        buffers = []
+        end = offset + length
+        while offset < end:
+            block = offset // self.block_size
+            block_start = block * self.block_size
+            for sector, count, allocated in self._block_runs(block):
+                run_start = block_start + sector * SECTOR_SIZE
+                run_end = run_start + count * SECTOR_SIZE
+                if run_end <= offset or run_start >= end:
+                    continue
+
+                first = max(run_start, offset)
+                last = min(run_end, end)
+                if allocated:
+                    data = self._block_data(block, sector, count)
+                    buffers.append(data[first - run_start:last - run_start])
+                    if prefetch:
+                        self._prefetch(self._block_data_offset(block, sector) + first - run_start, last - first)
+                else:
+                    buffers.append(bytes(last - first))
+
+            offset = min(block_start + self.block_size, end)
+
+        return buffers
+
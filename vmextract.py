@@ -1,13 +1,22 @@
 
 import argparse
+import blkhash
+import concurrent.futures as futures
+import convcache
+import errno
 import glob
 import json
 import lxml.etree as et
 import logging
+import metrics
+import mmap
 import re
 import subprocess
 import tarfile
+import time
 import os
+import vhd
+import zlib
 
 
 XML_NAMESPACES = {
@@ -80,15 +89,26 @@ class VM(object):
 class OvfReader(object):
     def __init__(self):
         self._vm = VM()
-        self._ovf = None
+        self._disks = {}
+        self._files = {}
 
     def read_xen_ovf(self, ovf_root):
-        self._ovf = ovf_root
-
+        self._index_envelope(ovf_root)
         self._read_ovf_envelope(ovf_root)
         self._check_required_fields()
         return self._vm
 
+    def _index_envelope(self, elem):
+        # Disks and files are looked up for every disk item, the indexes
+        # are built in one pass over the sections
+        for e in elem.iterchildren(prefix_ns("ovf", "References")):
+            for file_elem in e.iterchildren(prefix_ns("ovf", "File")):
+                self._files[file_elem.get(prefix_ns("ovf", "id"))] = file_elem
+
+        for e in elem.iterchildren(prefix_ns("ovf", "DiskSection")):
+            for disk_elem in e.iterchildren(prefix_ns("ovf", "Disk")):
+                self._disks[disk_elem.get(prefix_ns("ovf", "diskId"))] = disk_elem
+
     def _read_ovf_envelope(self, elem):
         for e in elem:
             handle_elem(e, {
@@ -122,7 +142,7 @@ class OvfReader(object):
                 ResourceType.CD_DRIVE: noop_handler,
                 ResourceType.DVD_DRIVE: noop_handler,
                 ResourceType.STORAGE_EXTENT: self._read_hw_disk
-            }, lambda e: int(e.xpath("rasd:ResourceType/text()", namespaces=e.nsmap)[0]))
+            }, lambda e: int(e.findtext(prefix_ns("rasd", "ResourceType"))))
 
         def handle_other_config(elem):
             handle_elem(elem, {
@@ -144,49 +164,42 @@ class OvfReader(object):
         if self._vm.cpu_count is not None:
             raise RuntimeError("OVF contains multiple CPU elements.")
 
-        self._vm.cpu_count = int(elem.xpath("rasd:VirtualQuantity/text()", namespaces=elem.nsmap)[0])
+        self._vm.cpu_count = int(elem.findtext(prefix_ns("rasd", "VirtualQuantity")))
 
     def _read_hw_memory(self, elem):
         if self._vm.memory_bytes is not None:
             raise RuntimeError("OVF contains multiple memory elements.")
 
         # Check if allocation units are MB
-        units = elem.xpath("rasd:AllocationUnits/text()", namespaces=elem.nsmap)[0]
+        units = elem.findtext(prefix_ns("rasd", "AllocationUnits"))
         if units != 'byte * 2^20':
             raise RuntimeError("Memory units are not MB")
 
-        mem_mb = int(elem.xpath("rasd:VirtualQuantity/text()", namespaces=elem.nsmap)[0])
+        mem_mb = int(elem.findtext(prefix_ns("rasd", "VirtualQuantity")))
         self._vm.memory_bytes = mem_mb * 1024 * 1024
 
     def _read_hw_disk(self, elem):
-        disk_id = elem.xpath("rasd:InstanceID/text()", namespaces=elem.nsmap)[0]
+        disk_id = elem.findtext(prefix_ns("rasd", "InstanceID"))
 
-        # Find disk with this ID
-        disk_elem = self._ovf.xpath(
-            "/ovf:Envelope/ovf:DiskSection/ovf:Disk[@ovf:diskId='{disk_id}']".format(
-                disk_id=disk_id
-            ),
-            namespaces=elem.nsmap
-        )[0]
+        disk_elem = self._disks.get(disk_id)
+        if disk_elem is None:
+            raise RuntimeError("Disk %s is not in the OVF DiskSection" % disk_id)
 
         file_id = disk_elem.attrib[prefix_ns("ovf", "fileRef")]
-        file_elem = self._ovf.xpath(
-            "/ovf:Envelope/ovf:References/ovf:File[@ovf:id='{file_id}']".format(
-                file_id=file_id
-            ),
-            namespaces=elem.nsmap
-        )[0]
+        file_elem = self._files.get(file_id)
+        if file_elem is None:
+            raise RuntimeError("File %s is not in the OVF References" % file_id)
 
         self._vm.disks.append({
             'id': disk_id,
-            'name': str(elem.xpath("rasd:ElementName/text()", namespaces=elem.nsmap)[0]),
+            'name': str(elem.findtext(prefix_ns("rasd", "ElementName"))),
             'capacity': int(disk_elem.attrib[prefix_ns("ovf", "capacity")]),
             'bootable': disk_elem.attrib[prefix_ns("xenovf", "isBootable")] in ["true", "True"],
             'file': file_elem.attrib[prefix_ns("ovf", "href")]
         })
 
     def _read_hw_platform(self, elem):
-        info_str = elem.xpath("xenovf:Value/text()", namespaces=elem.nsmap)[0]
+        info_str = elem.findtext(prefix_ns("xenovf", "Value"))
 
         for p in info_str.split(';'):
             if not p:
@@ -211,59 +224,745 @@ class OvfReader(object):
             raise RuntimeError("Memory information is missing!")
 
 
-def convert_disks(vm, skip_conversion):
-    for disk in vm.disks:
-        disk_file = disk["file"]
-        out_file = disk["id"] + ".qcow2"
+def is_within_directory(directory, target):
+    abs_directory = os.path.abspath(directory)
+    abs_target = os.path.abspath(target)
 
-        if skip_conversion:
-            logging.info("Skipping conversion of disk: %s", disk_file)
-            logging.debug("Output assumed to be: %s", out_file)
-            disk["qcow_file"] = out_file
+    # Compared by path components, "/a/dir2" is not within "/a/dir"
+    prefix = os.path.commonpath([abs_directory, abs_target])
+
+    return prefix == abs_directory
+
+
+def safe_extract(tar, path=".", members=None, *, numeric_owner=False):
+    for member in tar.getmembers():
+        member_path = os.path.join(path, member.name)
+        if not is_within_directory(path, member_path):
+            raise Exception("Attempted Path Traversal in Tar File")
+
+    tar.extractall(path, members, numeric_owner=numeric_owner)
+
+
+EXTRACT_PIECE_SIZE = 256 * 1024 * 1024
+ZERO_BLOCK_SIZE = 1024 * 1024
+
+COMPRESSION_MAGIC = (b"\x1f\x8b", b"BZh", b"\xfd7zXZ")
+
+
+def is_compressed(path):
+    with open(path, "rb") as f:
+        return f.read(6).startswith(COMPRESSION_MAGIC)
+
+
+def copy_range(src_fd, dst_fd, src_offset, dst_offset, length):
+    # Copies in the kernel, the data does not pass through Python
+    use_copy_file_range = hasattr(os, "copy_file_range")
+    while length:
+        if use_copy_file_range:
+            try:
+                count = os.copy_file_range(src_fd, dst_fd, length, src_offset, dst_offset)
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                    raise
+                # Not supported between these files, sendfile() is used
+                use_copy_file_range = False
+                continue
+        else:
+            os.lseek(dst_fd, dst_offset, os.SEEK_SET)
+            count = os.sendfile(dst_fd, src_fd, src_offset, length)
+
+        if count == 0:
+            raise RuntimeError("Unexpected end of the OVA file")
+        src_offset += count
+        dst_offset += count
+        length -= count
+
+
+def extract_piece(src_fd, mapping, target, data_offset, start, length):
+    # Copies the data regions of a part of a member. Blocks of zeros are
+    # skipped, so they become holes in the extracted file.
+    written = 0
+    dst_fd = os.open(target, os.O_WRONLY | os.O_NOFOLLOW)
+    try:
+        run_start = None
+        pos = start
+        end = start + length
+        while pos <= end:
+            count = min(ZERO_BLOCK_SIZE, end - pos)
+            zero = pos == end or vhd.is_zero(mapping[data_offset + pos:data_offset + pos + count])
+            if zero and run_start is not None:
+                copy_range(src_fd, dst_fd, data_offset + run_start, run_start, pos - run_start)
+                written += pos - run_start
+                run_start = None
+            elif not zero and run_start is None:
+                run_start = pos
+
+            if pos == end:
+                break
+            pos += count
+    finally:
+        os.close(dst_fd)
+
+    return written
+
+
+def create_target(path, member):
+    target = os.path.join(path, member.name)
+    if not is_within_directory(path, target):
+        raise Exception("Attempted Path Traversal in Tar File")
+
+    parent = os.path.dirname(target)
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    # Directories in the path may be symlinks created before
+    if not is_within_directory(os.path.realpath(path), os.path.realpath(parent)):
+        raise Exception("Attempted Path Traversal in Tar File")
+
+    if os.path.lexists(target):
+        os.unlink(target)
+    fd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, member.mode & 0o755 or 0o644)
+    try:
+        # The size is set first, regions that are not written stay holes
+        os.ftruncate(fd, member.size)
+    finally:
+        os.close(fd)
+
+    return target
+
+
+# Extracts an uncompressed OVA using the offsets of the members in the
+# archive. Members are split into pieces copied by `jobs` threads.
+def extract_ova(ova_file, tar_file, path, jobs=1):
+    members = tar_file.getmembers()
+    pieces = []
+    sparse_members = []
+    targets = []
+    for member in members:
+        if member.isdir():
+            if not is_within_directory(path, os.path.join(path, member.name)):
+                raise Exception("Attempted Path Traversal in Tar File")
+            continue
+
+        if not member.isfile():
+            logging.warn("Skipping OVA member %r, it is not a regular file", member.name)
+            continue
+
+        if member.issparse():
+            # Only tarfile knows the layout of sparse members
+            sparse_members.append(member)
+            continue
+
+        target = create_target(path, member)
+        targets.append((target, member))
+        for start in range(0, member.size, EXTRACT_PIECE_SIZE):
+            pieces.append((target, member.offset_data, start, min(EXTRACT_PIECE_SIZE, member.size - start)))
+
+    for member in sparse_members:
+        if not is_within_directory(path, os.path.join(path, member.name)):
+            raise Exception("Attempted Path Traversal in Tar File")
+        tar_file.extract(member, path)
+
+    written = 0
+    size = sum(length for _, _, _, length in pieces)
+    if size:
+        # Zero blocks are detected in the mapped archive, the data is
+        # copied by the kernel
+        with open(ova_file, "rb") as f:
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                with futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+                    copies = [executor.submit(extract_piece, f.fileno(), mapping, *piece) for piece in pieces]
+                for copy in copies:
+                    written += copy.result()
+            finally:
+                mapping.close()
+
+    for target, member in targets:
+        os.utime(target, (member.mtime, member.mtime))
+
+    logging.info("Extracted %d files: %d bytes, %d bytes of zeros skipped", len(targets), size, size - written)
+
+
+def index_ova(tar_file):
+    index = {}
+    for member in tar_file.getmembers():
+        if not member.isfile():
             continue
 
-        logging.info("Converting disk: %s", disk_file)
+        index[member.name] = member
+
+    return index
+
+
+def extract_ovf(tar_file, index, path):
+    ovf_members = [m for name, m in index.items() if name.lower().endswith(".ovf")]
+    for member in ovf_members:
+        if not is_within_directory(path, os.path.join(path, member.name)):
+            raise Exception("Attempted Path Traversal in Tar File")
+
+        tar_file.extract(member, path)
+
+
+def locate_disks_in_ova(vm, ova_file, index):
+    for disk in vm.disks:
+        member = index.get(disk["file"])
+        if member is None:
+            raise RuntimeError("Disk file %r was not found in the OVA" % disk["file"])
+
+        if member.issparse():
+            raise RuntimeError("Disk file %r is stored as a sparse tar member and cannot be read in place" % disk["file"])
+
+        disk["ova_file"] = ova_file
+        disk["ova_offset"] = member.offset_data
+        disk["ova_size"] = member.size
+
+
+def disk_source(disk):
+    # Paths are relative to the directory of the OVF
+    if "ova_file" not in disk:
+        return ["-f", "vpc", disk["file"]]
+
+    # Read the VHD directly from its location inside the OVA archive
+    source = {
+        "driver": "vpc",
+        "file": {
+            "driver": "raw",
+            "offset": disk["ova_offset"],
+            "size": disk["ova_size"],
+            "file": {
+                "driver": "file",
+                "filename": disk["ova_file"]
+            }
+        }
+    }
+    return ["json:" + json.dumps(source)]
+
+
+FORMATS = ["raw", "qcow2", "compressed", "auto"]
+
+
+class ConversionOptions(object):
+    def __init__(self):
+        self.native = False
+        self.jobs = 1
+        self.coroutines = None
+        self.out_of_order = False
+        self.source_cache = None
+        self.cache = None
+        self.preallocation = None
+        self.format = "qcow2"
+        self.compression_type = None
+        # Upload throughput in bytes per second, used by the auto format
+        self.link_throughput = None
+        self.checksum = False
+        self.conversion_cache = None
+
+    def qemu_img_args(self, image_format="qcow2"):
+        args = ["-O", "raw" if image_format == "raw" else "qcow2"]
+        if self.coroutines is not None:
+            args += ["-m", str(self.coroutines)]
+
+        if self.out_of_order:
+            args.append("-W")
+
+        if self.source_cache is not None:
+            args += ["-T", self.source_cache]
+
+        if self.cache is not None:
+            args += ["-t", self.cache]
+
+        if image_format == "compressed":
+            # Compressed clusters cannot be preallocated
+            args.append("-c")
+            if self.compression_type is not None:
+                args += ["-o", "compression_type=" + self.compression_type]
+        elif self.preallocation is not None:
+            args += ["-o", "preallocation=" + self.preallocation]
+
+        return args
+
+
+def source_size(disk, directory):
+    if "ova_file" in disk:
+        return disk["ova_size"]
+
+    return os.path.getsize(os.path.join(directory, disk["file"]))
+
+
+def file_checksum(path):
+    h = blkhash.Hash()
+    buf = bytearray(blkhash.BLOCK_SIZE)
+    with open(path, "rb") as f:
+        while True:
+            count = f.readinto(buf)
+            if not count:
+                break
+            h.update(memoryview(buf)[:count])
+
+    return h.to_dict()
+
+
+def vhd_source(disk, directory):
+    if "ova_file" in disk:
+        return disk["ova_file"], disk["ova_offset"], disk["ova_size"]
+
+    return os.path.join(directory, disk["file"]), 0, None
+
+
+def output_file(disk, image_format="qcow2"):
+    return disk["id"] + (".raw" if image_format == "raw" else ".qcow2")
+
+
+def set_output(disk, image_format, out_file):
+    # Raw images are uploaded as raw disks, qcow2 images, compressed or
+    # not, as they are
+    disk.pop("raw_file", None)
+    disk.pop("qcow_file", None)
+    disk["raw_file" if image_format == "raw" else "qcow_file"] = out_file
+    disk["image_format"] = image_format
+
+
+# Auto format selection compresses samples of the allocated data
+COMPRESSION_SAMPLE_COUNT = 32
+COMPRESSION_SAMPLE_SIZE = 1024 * 1024
+# Compression that saves less than this fraction of the data is not used
+MIN_COMPRESSION_SAVING = 0.1
+
+
+def sample_compression(disk, directory):
+    # Compresses evenly spaced samples of the allocated data cluster by
+    # cluster, like qemu-img convert -c with zlib. Returns the allocated
+    # bytes, the ratio of compressed to original bytes and the compression
+    # throughput of one thread.
+    with vhd.VhdReader(*vhd_source(disk, directory)) as reader:
+        extents = [(offset, length) for offset, length, zero in reader.allocation_map() if not zero]
+        allocated = sum(length for _, length in extents)
+        if allocated == 0:
+            return 0, None, None
+
+        step = max(allocated // COMPRESSION_SAMPLE_COUNT, COMPRESSION_SAMPLE_SIZE)
+        original = 0
+        compressed = 0
+        seconds = 0.0
+        pos = 0
+        sample = 0
+        for offset, length in extents:
+            # `pos` and `sample` are positions in the allocated data
+            while sample < pos + length:
+                start = offset + sample - pos
+                data = b"".join(reader.read(start, min(COMPRESSION_SAMPLE_SIZE, offset + length - start)))
+                start_time = time.perf_counter()
+                for i in range(0, len(data), QCOW2_CLUSTER_SIZE):
+                    cluster = data[i:i + QCOW2_CLUSTER_SIZE]
+                    compressor = zlib.compressobj(wbits=-12)
+                    size = len(compressor.compress(cluster)) + len(compressor.flush())
+                    # Clusters that do not compress are stored as they are
+                    compressed += min(size, len(cluster))
+                seconds += time.perf_counter() - start_time
+                original += len(data)
+                sample += step
+            pos += length
+
+    return allocated, compressed / float(original), original / seconds if seconds > 0 else None
+
+
+def choose_format(disk, options, directory):
+    with metrics.metrics.phase("format_selection", disk=disk["file"]):
+        allocated, ratio, speed = sample_compression(disk, directory)
+
+    link = options.link_throughput
+    if ratio is None or ratio > 1 - MIN_COMPRESSION_SAVING:
+        image_format = "qcow2"
+    elif link is None or speed is None:
+        image_format = "compressed"
+    else:
+        # The conversion gets slower by the time spent compressing, it pays
+        # off when the upload gets faster by more than that
+        image_format = "compressed" if 1 / speed + ratio / link < 1 / link else "qcow2"
+
+    disk["format_selection"] = {
+        "allocated_bytes": allocated,
+        "compression_ratio": ratio,
+        "compression_bytes_per_second": speed,
+        "link_bytes_per_second": link
+    }
+    metrics.metrics.event("format_selected", disk=disk["file"], format=image_format, **disk["format_selection"])
+    logging.info("Using %s format for disk %s, compression ratio: %s, link throughput: %s",
+                 image_format, disk["file"], "%.2f" % ratio if ratio is not None else "unknown",
+                 "%.1f MiB/s" % (link / 1024.0 ** 2) if link is not None else "unknown")
+    return image_format
+
+
+def target_format(disk, options, directory):
+    # Chosen once, a disk measured before the conversion keeps its format
+    if "image_format" not in disk:
+        image_format = options.format
+        if image_format == "auto":
+            image_format = choose_format(disk, options, directory)
+        disk["image_format"] = image_format
+
+    return disk["image_format"]
+
+
+def cache_key(disk, options, directory, image_format):
+    cache = options.conversion_cache
+    try:
+        with metrics.metrics.phase("fingerprint", disk=disk["file"]):
+            fingerprint = convcache.fingerprint(*vhd_source(disk, directory), full_hash=cache.full_hash)
+    except (OSError, RuntimeError) as e:
+        logging.warn("Cannot compute fingerprint of disk %s, it will not be cached: %s", disk["file"], e)
+        return None
+
+    # Only the options that change the output are part of the key
+    if image_format == "compressed":
+        variant = {"format": "qcow2", "compressed": True, "compression_type": options.compression_type}
+    else:
+        variant = {"format": image_format, "preallocation": options.preallocation}
+    return cache.key(fingerprint, variant)
+
+
+def use_cached_disk(disk, options, directory, key, image_format):
+    out_file = output_file(disk, image_format)
+    entry = options.conversion_cache.lookup(key, os.path.join(directory, out_file))
+    if entry is None:
+        return False
+
+    logging.info("Using cached conversion of disk %s. Output: %s", disk["file"], out_file)
+    set_output(disk, image_format, out_file)
+    disk["conversion"] = {
+        "cached": True,
+        "cache_key": key,
+        "source_bytes": source_size(disk, directory)
+    }
+    if entry.get("checksum"):
+        disk["checksum"] = entry["checksum"]
+    elif options.checksum:
+        compute_checksum(disk, directory)
+    return True
+
+
+def compute_checksum(disk, directory):
+    # qemu-img cannot report a digest of what it writes. The output was
+    # just written, so it is read back from the page cache.
+    out_file = disk.get("qcow_file") or disk["raw_file"]
+    start_time = time.time()
+    with metrics.metrics.phase("checksum", disk=disk["file"]):
+        disk["checksum"] = file_checksum(os.path.join(directory, out_file))
+    logging.info("Checksum of %s computed in %.1f s: %s", out_file, time.time() - start_time,
+                 disk["checksum"]["checksum"])
+
+
+def convert_disk(disk, options, directory):
+    disk_file = disk["file"]
+    image_format = target_format(disk, options, directory)
+    out_file = output_file(disk, image_format)
+
+    key = None
+    if options.conversion_cache is not None:
+        key = cache_key(disk, options, directory, image_format)
+        if key is not None and use_cached_disk(disk, options, directory, key, image_format):
+            return
+
+    logging.info("Converting disk %s to %s format", disk_file, image_format)
+    qemu_img_args = options.qemu_img_args(image_format)
+    # The output is renamed when it is complete, so an interrupted
+    # conversion does not leave a truncated image behind. It also gets a
+    # new inode and does not change a hard link in the conversion cache.
+    part_file = out_file + ".part"
+    start_time = time.time()
+    with metrics.metrics.phase("conversion", disk=disk_file):
         err = subprocess.call([
             "qemu-img",
-            "convert",
-            "-f", "vpc",
-            "-O", "qcow2",
-            disk_file,
-            out_file
-        ])
+            "convert"
+        ] + qemu_img_args + disk_source(disk) + [
+            part_file
+        ], cwd=directory)
+
+    if err != 0:
+        raise RuntimeError("Disk conversion failed: %s" % disk_file)
+
+    os.replace(os.path.join(directory, part_file), os.path.join(directory, out_file))
+    elapsed = time.time() - start_time
+    size = source_size(disk, directory)
+    logging.info("Conversion succeeded in %.1f s. Output: %s", elapsed, out_file)
+    set_output(disk, image_format, out_file)
+    disk["conversion"] = {
+        "qemu_img_args": qemu_img_args,
+        "seconds": elapsed,
+        "source_bytes": size,
+        "bytes_per_second": size / elapsed if elapsed > 0 else None
+    }
+
+    if options.checksum:
+        compute_checksum(disk, directory)
+
+    if key is not None:
+        options.conversion_cache.store(key, os.path.join(directory, out_file), {
+            "format": "raw" if image_format == "raw" else "qcow2",
+            "source": disk_file,
+            "checksum": disk.get("checksum")
+        })
+
+
+QCOW2_CLUSTER_SIZE = 64 * 1024
+
+
+def estimate_qcow2_size(disk, directory):
+    # Upper bound of the qcow2 image size from the VHD allocation map: the
+    # allocated data in whole clusters, plus the L1, L2 and refcount tables
+    cluster = QCOW2_CLUSTER_SIZE
+    with vhd.VhdReader(*vhd_source(disk, directory)) as reader:
+        virtual_size = reader.virtual_size
+        data_clusters = sum((length + 2 * cluster - 1) // cluster
+                            for _, length, zero in reader.allocation_map() if not zero)
+
+    l2_clusters = (virtual_size + cluster - 1) // cluster * 8 // cluster + 1
+    l1_clusters = l2_clusters * 8 // cluster + 1
+    clusters = data_clusters + l2_clusters + l1_clusters + 4
+    refcount_clusters = clusters * 2 // cluster + 2
+    return (clusters + refcount_clusters) * cluster
+
+
+def measure_disk(disk, options, directory):
+    # Size of the image before it is converted, so the disk can be created
+    # in oVirt while the conversion runs. A raw image has the size of the
+    # disk. Compressed qcow2 images are measured uncompressed, which is an
+    # upper bound.
+    image_format = target_format(disk, options, directory)
+    if image_format == "raw":
+        size = disk["capacity"]
+    else:
+        args = ["qemu-img", "measure", "--output=json", "-O", "qcow2"]
+        if options.preallocation is not None and image_format != "compressed":
+            args += ["-o", "preallocation=" + options.preallocation]
+
+        try:
+            output = subprocess.check_output(args + disk_source(disk), cwd=directory)
+            size = json.loads(output.decode("UTF-8"))["required"]
+        except (OSError, subprocess.CalledProcessError, ValueError, KeyError) as e:
+            logging.warn("Cannot measure disk %s, estimating its size from the VHD metadata: %s", disk["file"], e)
+            size = estimate_qcow2_size(disk, directory)
+
+    logging.info("Disk %s will need at most %d bytes", disk["file"], size)
+    disk["measured_size"] = size
+    set_output(disk, image_format, output_file(disk, image_format))
+
+
+def measure_disks(vm, options, directory):
+    with metrics.metrics.phase("measure", disks=len(vm.disks)):
+        for disk in vm.disks:
+            measure_disk(disk, options, directory)
+
+
+def use_native_disk(disk, directory):
+    if "ova_file" in disk:
+        disk["vhd_file"] = disk["ova_file"]
+        disk["vhd_offset"] = disk["ova_offset"]
+        disk["vhd_size"] = disk["ova_size"]
+    else:
+        disk["vhd_file"] = disk["file"]
+        disk["vhd_offset"] = 0
+        disk["vhd_size"] = source_size(disk, directory)
+
+    vhd_path = os.path.join(directory, disk["vhd_file"])
+    with vhd.VhdReader(vhd_path, disk["vhd_offset"], disk["vhd_size"]) as reader:
+        if reader.virtual_size != disk["capacity"]:
+            raise RuntimeError("Disk %s has virtual size %d, but OVF capacity is %d" % (
+                disk["file"], reader.virtual_size, disk["capacity"]))
+
+    logging.info("Disk %s will be uploaded directly from the VHD image", disk["file"])
+    # The checksum of native disks is computed by upload.py while reading them
+
+
+def convert_disks(vm, skip_conversion, options=None, directory=".", executor=None):
+    if options is None:
+        options = ConversionOptions()
+
+    if options.native:
+        for disk in vm.disks:
+            use_native_disk(disk, directory)
+        return
 
-        if err != 0:
-            raise RuntimeError("Disk conversion failed")
+    if skip_conversion:
+        for disk in vm.disks:
+            # Compressed or not, a qcow2 image is uploaded the same way, so
+            # the auto format does not need to be chosen again
+            image_format = "qcow2" if options.format == "auto" else options.format
+            out_file = output_file(disk, image_format)
+            logging.info("Skipping conversion of disk: %s", disk["file"])
+            if not os.path.exists(os.path.join(directory, out_file)):
+                key = None
+                if options.conversion_cache is not None and options.format != "auto":
+                    key = cache_key(disk, options, directory, image_format)
+                if key is None or not use_cached_disk(disk, options, directory, key, image_format):
+                    raise RuntimeError("Converted disk %s does not exist" % out_file)
+            logging.debug("Output assumed to be: %s", out_file)
+            set_output(disk, image_format, out_file)
+        return
 
-        logging.info("Conversion succeeded. Output: %s", out_file)
-        disk["qcow_file"] = out_file
+    # A shared executor limits the conversions running across several VMs
+    if executor is None:
+        with futures.ThreadPoolExecutor(max_workers=options.jobs) as executor:
+            conversions = [executor.submit(convert_disk, disk, options, directory) for disk in vm.disks]
+    else:
+        conversions = [executor.submit(convert_disk, disk, options, directory) for disk in vm.disks]
+        futures.wait(conversions)
 
+    errors = [c.exception() for c in conversions if c.exception() is not None]
+    for error in errors:
+        logging.error("%s", error)
 
-def read_ovf(ovf_file):
-    with open(ovf_file, "r") as f:
-        contents = f.read()
+    if errors:
+        raise RuntimeError("Disk conversion failed")
+
+
+OVF_READ_SIZE = 1024 * 1024
 
-    version_tag_pattern = r'^\s*<\?xml\s*version="[^"]*"\s*encoding="([^"]*)"\s*\?>'
 
-    # Checking the utf versuion in the header
-    match = re.match(version_tag_pattern, contents)
-    if match and match.group(1) == 'utf-16':
+def parse_ovf(f):
+    head = f.read(OVF_READ_SIZE)
+
+    # Checking the utf version in the header
+    encoding = None
+    match = re.match(br'\s*<\?xml\s+version="[^"]*"\s+encoding="([^"]*)"', head)
+    if match and match.group(1).lower() == b'utf-16' and not head.startswith((b'\xff\xfe', b'\xfe\xff')):
         # The OVF is probably not stored in UTF-16 format.
         logging.warn('XML contains encoding="utf-16, ignoring"')
+        encoding = "utf-8"
+
+    # The file is parsed as it is read, without keeping its contents
+    parser = et.XMLParser(encoding=encoding, huge_tree=True)
+    while head:
+        parser.feed(head)
+        head = f.read(OVF_READ_SIZE)
+
+    return parser.close()
+
+
+def read_ovf(ovf_file):
+    with open(ovf_file, "rb") as f:
+        return parse_ovf(f)
+
+
+def open_ova(path, no_extract=False, directory=None, jobs=1):
+    # By default, the OVA is extracted next to the archive
+    ova_dir = directory or os.path.dirname(os.path.abspath(path))
+    ova_filename, ova_ext = os.path.splitext(path)
+
+    if ova_ext.lower() != '.ova':
+        raise RuntimeError("File is not an OVA")
+
+    ova_file = os.path.abspath(path)
+    ova_index = None
+    with metrics.metrics.phase("extract", ova=ova_file), tarfile.open(path) as tar_file:
+        compressed = is_compressed(path)
+        if no_extract and compressed:
+            # Offsets of the members are in the decompressed stream, the
+            # disks cannot be read from the archive file
+            logging.warn("OVA %s is compressed, extracting it although --no-extract was given", path)
+            no_extract = False
+
+        if no_extract:
+            logging.info("Extracting OVF from the OVA archive...")
+            ova_index = index_ova(tar_file)
+            extract_ovf(tar_file, ova_index, ova_dir)
+        elif compressed:
+            # Members of a compressed archive cannot be copied by offset
+            logging.info("Extracting compressed OVA archive...")
+            safe_extract(tar_file, path=ova_dir)
+        else:
+            logging.info("Extracting OVA archive...")
+            extract_ova(ova_file, tar_file, ova_dir, jobs)
+        logging.info("Extraction finished.")
+
+    return ova_dir, ova_file, ova_index
+
+
+def find_ovf(directory):
+    ovf_files = glob.glob(os.path.join(glob.escape(directory), '*.ovf'))
+    return ovf_files[0] if ovf_files else None
+
+
+def read_vm(ovf_file, ova_file=None, ova_index=None):
+    with metrics.metrics.phase("read_ovf", ovf=ovf_file):
+        ovf_root = read_ovf(ovf_file)
+        vm = OvfReader().read_xen_ovf(ovf_root)
+
+    if ova_index is not None:
+        locate_disks_in_ova(vm, ova_file, ova_index)
+
+    return vm
 
-    # Strip the encoding tag
-    return re.sub(version_tag_pattern, '', contents)
+
+def write_vm(vm, directory):
+    vm_file = os.path.join(directory, "vm.json")
+    with open(vm_file, "w") as f:
+        json.dump(vm.to_dict(), f, indent=4)
+
+    return vm_file
 
 
 def main():
     parser = argparse.ArgumentParser(
-        description="Extracts the OVA file, reads information from the OVF and converts disks from vhd format to qcow2."
+        description="Extracts the OVA file, reads information from the OVF and converts disks from vhd format to qcow2 or raw."
     )
     parser.add_argument("-v", "--verbose", help="Show debug messages", action="store_true")
     parser.add_argument("-s", "--skip-disk-conversion",
                         help="Do not call qemu-img to convert disks",
                         action="store_true")
 
+    parser.add_argument("-n", "--no-extract",
+                        help="Extract only the OVF file and convert disks directly from the OVA archive",
+                        action="store_true")
+
+    parser.add_argument("--extract-threads", type=int, default=4,
+                        help="Number of threads copying the files out of an uncompressed OVA (default: 4)")
+
+    parser.add_argument("--native-vhd",
+                        help="Do not convert disks, upload.py will read the VHD images directly",
+                        action="store_true")
+
+    conversion_args = parser.add_argument_group("conversion options")
+    conversion_args.add_argument("-j", "--jobs", type=int, default=1,
+                                 help="Number of disks converted in parallel (default: 1)")
+    conversion_args.add_argument("--coroutines", type=int,
+                                 help="Number of parallel coroutines used by qemu-img for one disk (-m)")
+    conversion_args.add_argument("--out-of-order", action="store_true",
+                                 help="Allow qemu-img to write out of order (-W)")
+    conversion_args.add_argument("--source-cache",
+                                 choices=["none", "writeback", "writethrough", "directsync", "unsafe"],
+                                 help="Cache mode of the source image (-T)")
+    conversion_args.add_argument("--cache",
+                                 choices=["none", "writeback", "writethrough", "directsync", "unsafe"],
+                                 help="Cache mode of the output image (-t)")
+    conversion_args.add_argument("--preallocation", choices=["off", "metadata", "falloc", "full"],
+                                 help="Preallocation mode of the output, not used for compressed images")
+    conversion_args.add_argument("--format", choices=FORMATS, default="qcow2",
+                                 help="Format of the converted images: sparse raw, qcow2, compressed qcow2, "
+                                      "or auto to compress only when it makes the upload faster "
+                                      "(default: qcow2)")
+    conversion_args.add_argument("--compression-type", choices=["zlib", "zstd"],
+                                 help="Compression of compressed qcow2 images (default: the qemu-img default)")
+    conversion_args.add_argument("--link-throughput", type=float,
+                                 help="Upload throughput in MiB/s used by the auto format, without it the "
+                                      "auto format compresses every disk that compresses well")
+    conversion_args.add_argument("--checksum", action="store_true",
+                                 help="Store a checksum of each converted image in vm.json, "
+                                      "upload.py --verify compares it with the uploaded disk")
+    conversion_args.add_argument("--conversion-cache",
+                                 help="Directory where converted images are kept and reused when the same "
+                                      "VHD is converted again")
+    conversion_args.add_argument("--conversion-cache-size", type=float, default=100,
+                                 help="Size limit of the conversion cache in GiB, least recently used "
+                                      "images are removed first (default: 100)")
+    conversion_args.add_argument("--conversion-cache-full-hash", action="store_true",
+                                 help="Hash the whole VHD to identify it in the cache, not only samples")
+
+    parser.add_argument("--metrics-file",
+                        help="Append phase timings and a summary as JSON lines to this file")
+    parser.add_argument("--prometheus-file",
+                        help="Write the metrics in Prometheus text format to this file when finished")
+
     parser.add_argument("filename", help="Xen OVA file or a directory containing the OVF file")
     args = parser.parse_args()
 
@@ -271,55 +970,49 @@ def main():
         logging.DEBUG if args.verbose else logging.INFO
     )
 
-    path = args.filename
-    if os.path.isfile(path):
-        ova_dir = os.path.dirname(path)
-        ova_filename, ova_ext = os.path.splitext(path)
-
-        if ova_ext.lower() != '.ova':
-            raise RuntimeError("File is not an OVA")
-
-        with tarfile.open(path) as tar_file:
-            logging.info("Extracting OVA archive...")
-            def is_within_directory(directory, target):
-                
-                abs_directory = os.path.abspath(directory)
-                abs_target = os.path.abspath(target)
-            
-                prefix = os.path.commonprefix([abs_directory, abs_target])
-                
-                return prefix == abs_directory
-            
-            def safe_extract(tar, path=".", members=None, *, numeric_owner=False):
-            
-                for member in tar.getmembers():
-                    member_path = os.path.join(path, member.name)
-                    if not is_within_directory(path, member_path):
-                        raise Exception("Attempted Path Traversal in Tar File")
-            
-                tar.extractall(path, members, numeric_owner=numeric_owner) 
-                
-            
-            safe_extract(tar_file, path=ova_dir)
-            logging.info("Extraction finished.")
+    metrics.metrics.configure(args.metrics_file, args.prometheus_file, script="vmextract")
+    try:
+        return extract(args)
+    finally:
+        metrics.metrics.close()
 
-        path = ova_dir
 
-    os.chdir(path)
+def extract(args):
+    path = args.filename
+    ova_file = None
+    ova_index = None
+    if os.path.isfile(path):
+        path, ova_file, ova_index = open_ova(path, args.no_extract, jobs=args.extract_threads)
 
-    ovf_files = glob.glob('*.ovf')
-    if not ovf_files:
+    ovf_file = find_ovf(path)
+    if ovf_file is None:
         logging.error("Directory %s does not contain an OVF file.", path)
         return 1
 
-    ovf_contents = read_ovf(ovf_files[0])
-    ovf_root = et.fromstring(ovf_contents)
-
-    vm = OvfReader().read_xen_ovf(ovf_root)
-    convert_disks(vm, args.skip_disk_conversion)
-
-    with open("vm.json", "w") as f:
-        json.dump(vm.to_dict(), f, indent=4)
+    vm = read_vm(ovf_file, ova_file, ova_index)
+
+    options = ConversionOptions()
+    options.native = args.native_vhd
+    options.jobs = args.jobs
+    options.coroutines = args.coroutines
+    options.out_of_order = args.out_of_order
+    options.source_cache = args.source_cache
+    options.cache = args.cache
+    options.preallocation = args.preallocation
+    options.format = args.format
+    options.compression_type = args.compression_type
+    if args.link_throughput:
+        options.link_throughput = args.link_throughput * 1024 ** 2
+    options.checksum = args.checksum
+    if args.conversion_cache:
+        options.conversion_cache = convcache.ConversionCache(
+            os.path.abspath(args.conversion_cache),
+            int(args.conversion_cache_size * 1024 ** 3),
+            args.conversion_cache_full_hash
+        )
+
+    convert_disks(vm, args.skip_disk_conversion, options, path)
+    write_vm(vm, path)
 
 
 if __name__ == '__main__':